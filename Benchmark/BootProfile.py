@@ -0,0 +1,105 @@
+'''
+main.py の起動(import)時間を計測し、どのモジュールの読み込みに時間がかかっているかを表示する。
+python -X importtime の結果を、main.py が直接読み込むモジュールごとにまとめる。
+
+実行方法 (リポジトリのルートで)
+    python Benchmark/BootProfile.py                                   # 5回計測して中央値を表示
+    python Benchmark/BootProfile.py --runs 10 --history boot.jsonl    # 結果を1行のJSONとして追記し、リリースごとに比較する
+
+DBはコピーを使い、.envがなくても起動できるよう環境変数にダミーの値を設定する。
+'''
+import argparse
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+
+root_directory = Path(__file__).resolve().parent.parent
+SOURCE_DATABASE_PATH = root_directory / 'Database' / 'sqlite_database.db'
+DEFAULT_RUN_QUANTITY = 5
+TOP_MODULE_QUANTITY = 15
+
+# import main の所要時間(ms)を標準出力に出す
+IMPORT_MAIN_CODE = 'import time; start = time.perf_counter(); import main; print((time.perf_counter() - start) * 1000)'
+
+
+def profile_import(environment: dict) -> tuple:
+    '''
+    新しいプロセスで import main を1回実行し、(所要時間ms, main.pyが直接読み込むモジュール → 累積時間ms, mainの自身の時間ms) を返す。
+    '''
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', IMPORT_MAIN_CODE],
+        cwd=root_directory, env=environment, capture_output=True, text=True, check=True,
+    )
+    elapsed_ms = float(completed.stdout.strip().splitlines()[-1])
+
+    # "import time:  self [us] | cumulative | imported package" の行を、main の直下(インデント2)のみ集計する
+    direct_imports = {}
+    main_self_ms = 0.0
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        indent = len(name) - len(name.lstrip(' '))
+        if name.strip() == 'main' and indent == 1:
+            main_self_ms = int(self_us) / 1000
+        elif indent == 3: # main の直下
+            direct_imports[name.strip()] = int(cumulative_us) / 1000
+
+    return elapsed_ms, direct_imports, main_self_ms
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_directory,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+if __name__ == "__main__":
+
+    argument_parser = argparse.ArgumentParser(description='main.py の起動時間の計測')
+    argument_parser.add_argument('--runs', type=int, default=DEFAULT_RUN_QUANTITY, help='計測回数 (中央値を表示)')
+    argument_parser.add_argument('--history', help='結果を1行のJSONとして追記するファイル')
+    arguments = argument_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        database_path = os.path.join(temporary_directory, 'boot.db')
+        shutil.copy(SOURCE_DATABASE_PATH, database_path)
+        environment = dict(os.environ, DATABASE_PATH=database_path)
+        for name in ['LINE_BOT_CHANNEL_ACCESS_TOKEN', 'LINE_BOT_CHANNEL_SECRET', 'SEARCH_FORM_LIFF', 'SHARE_LIFF_BASE_URI', 'HOTPEPPRE_API_KEY']:
+            environment.setdefault(name, 'boot-profile')
+
+        # 1回目はスキーマの作成・.pycの作成を含むため、計測から除く
+        profile_import(environment)
+        profiles = [profile_import(environment) for _ in range(arguments.runs)]
+
+    elapsed_ms = statistics.median(profile[0] for profile in profiles)
+    main_self_ms = statistics.median(profile[2] for profile in profiles)
+    module_names = profiles[0][1].keys()
+    modules_ms = {name: statistics.median(profile[1].get(name, 0.0) for profile in profiles) for name in module_names}
+
+    print(f'import main: {elapsed_ms:.1f} ms (median of {arguments.runs} runs)')
+    print(f'  {"main.py itself (module body, setup_database)":<48}{main_self_ms:8.1f} ms')
+    for name, module_ms in sorted(modules_ms.items(), key=lambda item: item[1], reverse=True)[:TOP_MODULE_QUANTITY]:
+        print(f'  {name:<48}{module_ms:8.1f} ms')
+
+    if arguments.history:
+        record = {
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'import_main_ms': round(elapsed_ms, 1),
+            'main_self_ms': round(main_self_ms, 1),
+            'modules_ms': {name: round(module_ms, 1) for name, module_ms in modules_ms.items()},
+        }
+        with open(arguments.history, 'a', encoding='utf-8') as history_file:
+            history_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        print(f'appended to {arguments.history}')
@@ -0,0 +1,118 @@
+'''
+1リクエスト(新規検索 + 店舗紹介)で行うDB操作の所要時間を、
+呼び出しごとに接続する従来方式と、永続接続(接続プール + リクエスト単位の接続固定)で比較する。
+
+実行方法 (リポジトリのルートで)
+    python Benchmark/DatabaseBenchmark.py [リクエスト数]
+'''
+import contextlib
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# ルートディレクトリをsys.pathに追加
+root_directory = Path(__file__).resolve().parent.parent
+sys.path.append(str(root_directory))
+
+from Database import sqlite as db
+
+
+SOURCE_DATABASE_PATH = str(root_directory / 'Database' / 'sqlite_database.db')
+DEFAULT_REQUEST_QUANTITY = 200
+SEARCH_HIT_SHOP_QUANTITY = 60 # 1回の検索で保持する店舗数 (3ページ分)
+DISPLAY_SHOP_QUANTITY = 5
+
+
+class BenchmarkShopRecord:
+    """db.upsert_shop_records に渡すための最低限のShopRecord
+    """
+    def __init__(self, shop_id):
+        self.shop_id = shop_id
+        self.name = 'shop ' + shop_id
+        self.img_url = 'https://example.com/' + shop_id + '.jpg'
+        self.access = 'access ' + shop_id
+        self.affiliate_url = 'https://example.com/str' + shop_id
+        self.review_score = 4.0
+        self.review_quantity = 10
+        self.update_date = None
+
+
+def run_request(DATABASE_PATH: str, user_id: str, request_index: int, use_transaction: bool):
+    '''
+    handle_message → introduce_shops_by_user_id で行われるDB操作を順に実行する。
+    '''
+    input_queries = ['', '新橋', '', f'居酒屋{request_index % 10}']
+    shop_ids = [f'B{request_index:05d}{n:04d}' for n in range(SEARCH_HIT_SHOP_QUANTITY)]
+    transaction = db.transaction if use_transaction else (lambda DATABASE_PATH: contextlib.nullcontext())
+
+    # 検索条件の更新
+    with transaction(DATABASE_PATH):
+        if db.is_new_user(DATABASE_PATH, user_id):
+            db.add_user_record(DATABASE_PATH, user_id)
+            db.add_empty_query_record(DATABASE_PATH, user_id)
+        db.update_query(DATABASE_PATH, user_id, input_queries)
+        db.get_user_queries(DATABASE_PATH, user_id)
+
+    # Searchレコードの更新
+    with transaction(DATABASE_PATH):
+        db.delete_all_search_records(DATABASE_PATH, user_id)
+        db.add_search_records(DATABASE_PATH, user_id, shop_ids)
+
+    # 店舗紹介
+    selected_search_record_ids, selected_shop_ids = db.select_shop(DATABASE_PATH, user_id, DISPLAY_SHOP_QUANTITY)
+    db.fetch_query_record_as_list(DATABASE_PATH, user_id)
+    registered_shop_ids = [shop_record[0] for shop_record in db.fetch_shop_records_as_list(DATABASE_PATH, selected_shop_ids)]
+    new_shop_ids = [shop_id for shop_id in selected_shop_ids if shop_id not in registered_shop_ids]
+    db.upsert_shop_records(DATABASE_PATH, [BenchmarkShopRecord(shop_id) for shop_id in new_shop_ids])
+    db.delete_select_search_record(DATABASE_PATH, selected_search_record_ids)
+    db.has_search_record(DATABASE_PATH, user_id)
+
+
+def measure(label: str, DATABASE_PATH: str, request_quantity: int, persistent: bool) -> list:
+    '''
+    request_quantity回のリクエストを実行し、1リクエストあたりの所要時間(ms)のリストを返す。
+    '''
+    db.PERSISTENT_CONNECTION = persistent
+    db.setup_database(DATABASE_PATH)
+
+    elapsed_times = []
+    for request_index in range(request_quantity):
+        user_id = f'Ubenchmark{request_index % 20}'
+        start = time.perf_counter()
+        if persistent:
+            with db.request_connection(DATABASE_PATH):
+                run_request(DATABASE_PATH, user_id, request_index, use_transaction=True)
+        else:
+            run_request(DATABASE_PATH, user_id, request_index, use_transaction=False)
+        elapsed_times.append((time.perf_counter() - start) * 1000)
+
+    db.close_all_connections()
+    report(label, elapsed_times)
+    return elapsed_times
+
+
+def report(label: str, elapsed_times: list) -> None:
+    sorted_times = sorted(elapsed_times)
+    p95 = sorted_times[int(len(sorted_times) * 0.95) - 1]
+    print(f'{label:<28} mean {statistics.mean(elapsed_times):7.2f} ms   p50 {statistics.median(elapsed_times):7.2f} ms   p95 {p95:7.2f} ms')
+
+
+if __name__ == "__main__":
+
+    request_quantity = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_REQUEST_QUANTITY
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        # 元のDBを汚さないよう、方式ごとにコピーしたDBで計測する
+        before_database_path = os.path.join(temporary_directory, 'before.db')
+        after_database_path = os.path.join(temporary_directory, 'after.db')
+        shutil.copy(SOURCE_DATABASE_PATH, before_database_path)
+        shutil.copy(SOURCE_DATABASE_PATH, after_database_path)
+
+        print(f'DB operations per request ({request_quantity} requests)')
+        before = measure('before: connect per call', before_database_path, request_quantity, persistent=False)
+        after = measure('after: pooled + WAL', after_database_path, request_quantity, persistent=True)
+        print(f'speedup (mean): {statistics.mean(before) / statistics.mean(after):.1f}x')
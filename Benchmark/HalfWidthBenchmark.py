@@ -0,0 +1,80 @@
+'''
+全角→半角変換 (SearchQuery.convert_to_half_width / standardize_message) について、
+1文字ずつNFKC正規化して連結する従来の変換と、変換表によるstr.translateでの変換を比較する。
+
+・BMPの全文字 (サロゲートを除く) と、SearchQueryBenchmarkのメッセージで、変換結果が一致することを確認する。
+・メッセージの種類ごとに、1呼び出しあたりの所要時間を表示する。
+
+実行方法 (リポジトリのルートで)
+    python Benchmark/HalfWidthBenchmark.py
+'''
+import statistics
+import sys
+import time
+import unicodedata
+from pathlib import Path
+
+# ルートディレクトリをsys.pathに追加
+root_directory = Path(__file__).resolve().parent.parent
+sys.path.append(str(root_directory))
+
+import jaconv
+
+from SearchQuery import SearchQuery
+from SearchQueryBenchmark import CORPUS
+
+
+REPEAT_QUANTITY = 7 # 計測の繰り返し回数 (最も速かった回を採用)
+LOOP_QUANTITY = 500 # 1回の計測で呼び出す回数
+
+
+# ---- 従来の変換 ----
+def legacy_convert_to_half_width(text):
+    converted_text = ""
+    for char in text:
+        if char in ["＼", "\\", "￥"]:
+            char = "¥"
+        char = unicodedata.normalize("NFKC", char)
+        converted_text += char
+    return jaconv.z2h(converted_text, digit=True, ascii=True, kana=False)
+
+
+def legacy_standardize_message(text):
+    return legacy_convert_to_half_width(text.replace("\n", ""))
+
+
+def check_identical() -> None:
+    '''
+    従来の変換と結果が一致しない文字・メッセージがあれば終了する。
+    '''
+    all_chars = [chr(code_point) for code_point in range(0x10000) if not 0xD800 <= code_point <= 0xDFFF]
+    texts = all_chars + [''.join(all_chars)] + [message for messages in CORPUS.values() for message in messages]
+
+    for text in texts:
+        for legacy, current in [(legacy_convert_to_half_width, SearchQuery.convert_to_half_width),
+                                (legacy_standardize_message, SearchQuery.standardize_message)]:
+            if legacy(text) != current(text):
+                sys.exit(f'result mismatch: {current.__name__}({text[:20]!r})')
+
+    print(f'identical results for {len(all_chars)} characters and {len(texts) - len(all_chars)} messages')
+
+
+def measure_time_us(convert, text: str) -> float:
+    best = float('inf')
+    for _ in range(REPEAT_QUANTITY):
+        start = time.perf_counter()
+        for _ in range(LOOP_QUANTITY):
+            convert(text)
+        best = min(best, (time.perf_counter() - start) / LOOP_QUANTITY)
+    return best * 1_000_000
+
+
+if __name__ == "__main__":
+
+    check_identical()
+
+    print(f'{"standardize_message":<14}{"before":>12}{"after":>12}{"speedup":>10}')
+    for category, messages in CORPUS.items():
+        before = statistics.mean(measure_time_us(legacy_standardize_message, message) for message in messages)
+        after = statistics.mean(measure_time_us(SearchQuery.standardize_message, message) for message in messages)
+        print(f'{category:<14}{before:9.2f} us{after:9.2f} us{before / after:9.1f}x')
@@ -0,0 +1,117 @@
+'''
+保存したHTMLフィクスチャを使って、ページ全体をhtml.parserで解析する従来の抽出と、
+HotPepper.HtmlExtractor による対象要素のみの抽出を比較する。
+抽出結果が一致することを確認した上で、1ページあたりの解析時間とピークメモリを表示する。
+
+実行方法 (リポジトリのルートで)
+    python Benchmark/HtmlExtractorBenchmark.py [繰り返し回数]
+
+Benchmark/HtmlFixtures のHTMLは、実際のページと同じ要素構造を持つ検索結果ページ・店舗ページ。
+実ページを保存したファイルを同じディレクトリに同じ名前で置き換えれば、そのまま計測できる。
+'''
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+# ルートディレクトリをsys.pathに追加
+root_directory = Path(__file__).resolve().parent.parent
+sys.path.append(str(root_directory))
+
+from bs4 import BeautifulSoup
+
+from HotPepper import HtmlExtractor
+
+
+FIXTURE_DIRECTORY = root_directory / 'Benchmark' / 'HtmlFixtures'
+DEFAULT_REPEAT_QUANTITY = 20
+
+
+# ---- 従来の抽出 (ページ全体をhtml.parserで解析してからfindする) ----
+def legacy_extract_shop_ids(search_page_html: str) -> list:
+    soup = BeautifulSoup(search_page_html, 'html.parser')
+    html_shop_lists = soup.find_all('h3', class_='shopDetailStoreName')
+    if not html_shop_lists:
+        return
+    shop_ids = []
+    for html_shop_list in html_shop_lists:
+        current_href_shop_id = html_shop_list.find('a')['href']
+        shop_ids.append(current_href_shop_id[4:len(current_href_shop_id) - 1])
+    return shop_ids
+
+
+def legacy_extract_shop_review(shop_page_html: str) -> tuple:
+    soup = BeautifulSoup(shop_page_html, 'html.parser')
+    rating_wrap_element = soup.find('div', class_='ratingWrap')
+    if not rating_wrap_element:
+        return None, None, None
+    review_score = float(rating_wrap_element.find('span', class_='ratingScoreValue').text)
+    reputation = rating_wrap_element.find('span', class_='ratingScoreText').text
+    review_quantity_str = rating_wrap_element.find('span', class_='ratingReivew').text
+    return review_score, reputation, HtmlExtractor.extract_number_from_string(review_quantity_str)
+
+
+def legacy_extract_search_page_info(search_page_html: str) -> tuple:
+    soup = BeautifulSoup(search_page_html, 'html.parser')
+    page_quantity_element = soup.find('li', class_='lh27')
+    if page_quantity_element is None:
+        return None, None
+    page_quantity_sentence = page_quantity_element.text
+    hit_search_page_quantity = int(page_quantity_sentence[len("1/") : len(page_quantity_sentence)-len("ページ")])
+    if hit_search_page_quantity == 1:
+        return 1, None
+    lis = soup.find('ul', class_='pageLinkLinearBasic cf').find_all('li')
+    number2_nubering_search_url = lis[2].find('a')['href']
+    return hit_search_page_quantity, HtmlExtractor.HOTPEPPER_URL_DOMAIN + number2_nubering_search_url[:len(number2_nubering_search_url)-2]
+
+
+# (フィクスチャ名, 従来の抽出, 新しい抽出)
+CASES = [
+    ('search_page.html', legacy_extract_shop_ids, HtmlExtractor.extract_shop_ids),
+    ('search_page.html', legacy_extract_search_page_info, HtmlExtractor.extract_search_page_info),
+    ('search_page_no_hit.html', legacy_extract_shop_ids, HtmlExtractor.extract_shop_ids),
+    ('search_page_no_hit.html', legacy_extract_search_page_info, HtmlExtractor.extract_search_page_info),
+    ('shop_page.html', legacy_extract_shop_review, HtmlExtractor.extract_shop_review),
+    ('shop_page_without_review.html', legacy_extract_shop_review, HtmlExtractor.extract_shop_review),
+]
+
+
+def measure(extract, html: str, repeat_quantity: int) -> tuple:
+    '''
+    extract(html) をrepeat_quantity回実行し、(抽出結果, 平均時間ms, ピークメモリKiB) を返す。
+    '''
+    elapsed_times = []
+    for _ in range(repeat_quantity):
+        start = time.perf_counter()
+        result = extract(html)
+        elapsed_times.append((time.perf_counter() - start) * 1000)
+
+    # メモリは時間計測とは別に1回だけ計測する (tracemallocは実行を遅くするため)
+    tracemalloc.start()
+    extract(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, statistics.mean(elapsed_times), peak / 1024
+
+
+if __name__ == "__main__":
+
+    repeat_quantity = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_REPEAT_QUANTITY
+    print(f'parser: {HtmlExtractor.get_html_parser()}  ({repeat_quantity} runs per case)')
+
+    for fixture_name, legacy_extract, extract in CASES:
+        html = (FIXTURE_DIRECTORY / fixture_name).read_text(encoding='utf-8')
+
+        before_result, before_time, before_peak = measure(legacy_extract, html, repeat_quantity)
+        after_result, after_time, after_peak = measure(extract, html, repeat_quantity)
+
+        # 高速化で抽出結果が変わっていないことを確認
+        if before_result != after_result:
+            sys.exit(f'result mismatch: {fixture_name} {extract.__name__}\n  before: {before_result}\n  after : {after_result}')
+
+        print(f'{fixture_name:<30} {extract.__name__:<26}'
+              f' before {before_time:7.2f} ms {before_peak:8.0f} KiB'
+              f'   after {after_time:7.2f} ms {after_peak:8.0f} KiB'
+              f'   {before_time / after_time:5.1f}x')
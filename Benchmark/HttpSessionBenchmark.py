@@ -0,0 +1,179 @@
+'''
+外部通信の接続を、リクエストごとに作り直す場合 (以前の requests.get と同じ) と、
+HotPepper.OutboundClient.create_http_session の接続プールで使い回す場合を比較する。
+
+LoadTest/StandInServer.py の代替サーバーに対して、日付指定の新規検索1回分と同じ通信を繰り返す。
+    検索結果ページ 1 + ナンバリングページ 3 + 5店舗 × (グルメAPI + 店舗ページ) = 14リクエスト
+検索1回あたりの所要時間と、作成した接続数・接続の確立にかかった時間を表示する。
+opensslがある場合は自己署名証明書を作成してHTTPSで通信する (TLSハンドシェイクを含めて比較する)。
+
+実行方法 (リポジトリのルートで)
+    python Benchmark/HttpSessionBenchmark.py [--searches 50] [--no-tls]
+'''
+import argparse
+import asyncio
+import os
+import shutil
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# ルートディレクトリをsys.pathに追加
+root_directory = Path(__file__).resolve().parent.parent
+sys.path.append(str(root_directory))
+sys.path.append(str(root_directory / 'LoadTest'))
+
+import aiohttp
+
+from HotPepper import OutboundClient
+from StandInServer import StandInConfig, shop_id_of, start_stand_in_server
+
+
+HOST = '127.0.0.1'
+PORT = 8092
+NUMBERING_PAGE_QUANTITY = 3 # main.MAX_HIT_PAGE_STOCK_QUANTITY
+SHOP_QUANTITY = 5 # main.MAX_DISPLAY_SHOP_QUANTITY
+
+# main.py の既定値と同じ接続プールの設定
+HTTP_CONNECTION_LIMIT = 100
+HTTP_CONNECTION_LIMIT_PER_HOST = 30
+HTTP_KEEPALIVE_TIMEOUT_SECONDS = 30
+HTTP_DNS_CACHE_TTL_SECONDS = 300
+
+
+def create_certificate(directory: str) -> tuple:
+    '''
+    opensslで127.0.0.1の自己署名証明書を作成し、(サーバー用, クライアント用) のSSLContextを返す。
+    '''
+    certificate_path = os.path.join(directory, 'cert.pem')
+    key_path = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', f'/CN={HOST}',
+         '-addext', f'subjectAltName=IP:{HOST}', '-keyout', key_path, '-out', certificate_path],
+        check=True, capture_output=True,
+    )
+    server_ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_ssl_context.load_cert_chain(certificate_path, key_path)
+    client_ssl_context = ssl.create_default_context(cafile=certificate_path)
+    return server_ssl_context, client_ssl_context
+
+
+def create_trace_config(connection_stats: dict) -> aiohttp.TraceConfig:
+    '''
+    新しく作成した接続の数と、接続の確立(TCP・TLS)にかかった時間を記録するTraceConfig。
+    '''
+    async def on_connection_create_start(session, context, params):
+        context.connection_started_at = time.perf_counter()
+
+    async def on_connection_create_end(session, context, params):
+        connection_stats['connections'] += 1
+        connection_stats['connect_ms'] += (time.perf_counter() - context.connection_started_at) * 1000
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+def search_requests(base_url: str, keyword: str) -> tuple:
+    '''
+    新規検索1回分の (検索結果ページのURLリスト, 店舗ごとの (グルメAPIのURL, params, 店舗ページのURL) リスト) を返す。
+    '''
+    page_urls = [f'{base_url}/CSP/psh010/doBasic?FWT={keyword}'] + [
+        f'{base_url}/SA11/fwt{keyword}/bgn{page}/' for page in range(1, NUMBERING_PAGE_QUANTITY + 1)
+    ]
+    shop_requests = [
+        (f'{base_url}/hotpepper/gourmet/v1/', {'id': shop_id, 'format': 'json'}, f'{base_url}/str{shop_id}/')
+        for shop_id in [shop_id_of(keyword, index) for index in range(SHOP_QUANTITY)]
+    ]
+    return page_urls, shop_requests
+
+
+async def run_search(fetch, base_url: str, keyword: str) -> float:
+    '''
+    main.py と同じ順序・並行度で新規検索1回分の通信を行い、所要時間(ms)を返す。
+    '''
+    page_urls, shop_requests = search_requests(base_url, keyword)
+    start = time.perf_counter()
+
+    await fetch(page_urls[0])
+    await asyncio.gather(*[fetch(page_url) for page_url in page_urls[1:]])
+    await asyncio.gather(*[
+        asyncio.gather(fetch(api_url, params), fetch(shop_url)) for api_url, params, shop_url in shop_requests
+    ])
+
+    return (time.perf_counter() - start) * 1000
+
+
+async def measure(mode: str, base_url: str, client_ssl_context, search_quantity: int) -> dict:
+    '''
+    mode ('per request' / 'pooled') の通信でsearch_quantity回検索し、所要時間と接続の統計を返す。
+    '''
+    connection_stats = {'connections': 0, 'connect_ms': 0.0}
+    trace_config = create_trace_config(connection_stats)
+
+    if mode == 'per request':
+        # リクエストごとに新しい接続を作り、使い終わったら閉じる
+        async def fetch(url, params=None):
+            connector = aiohttp.TCPConnector(force_close=True)
+            async with aiohttp.ClientSession(connector=connector, trace_configs=[trace_config]) as session:
+                async with session.get(url, params=params, ssl=client_ssl_context) as response:
+                    return await response.read()
+
+        elapsed_times = [await run_search(fetch, base_url, f'kw{index}') for index in range(search_quantity)]
+
+    else:
+        session = OutboundClient.create_http_session(
+            HTTP_CONNECTION_LIMIT, HTTP_CONNECTION_LIMIT_PER_HOST, HTTP_KEEPALIVE_TIMEOUT_SECONDS, HTTP_DNS_CACHE_TTL_SECONDS,
+        )
+        session.trace_configs.append(trace_config)
+        trace_config.freeze()
+
+        async def fetch(url, params=None):
+            async with session.get(url, params=params, ssl=client_ssl_context) as response:
+                return await response.read()
+
+        try:
+            elapsed_times = [await run_search(fetch, base_url, f'kw{index}') for index in range(search_quantity)]
+        finally:
+            await session.close()
+
+    return {
+        'mean_ms': statistics.mean(elapsed_times),
+        'p95_ms': statistics.quantiles(elapsed_times, n=20)[-1],
+        'connections': connection_stats['connections'],
+        'connect_ms': connection_stats['connect_ms'],
+    }
+
+
+async def main(arguments: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        server_ssl_context, client_ssl_context = None, None
+        if not arguments.no_tls and shutil.which('openssl'):
+            server_ssl_context, client_ssl_context = create_certificate(temporary_directory)
+        scheme = 'https' if server_ssl_context else 'http'
+        base_url = f'{scheme}://{HOST}:{PORT}'
+
+        # 通信以外の待ち時間を除くため、代替サーバーの応答遅延はなしにする
+        runner, _ = await start_stand_in_server(StandInConfig(latency_ms=0, jitter_ms=0, line_latency_ms=0), HOST, PORT, server_ssl_context)
+        try:
+            print(f'{scheme}, {arguments.searches} searches x 14 requests')
+            print(f'{"":<14}{"mean ms":>10}{"p95 ms":>10}{"connections":>14}{"connect ms":>13}')
+            for mode in ['per request', 'pooled']:
+                await measure(mode, base_url, client_ssl_context, 3) # ウォームアップ
+                result = await measure(mode, base_url, client_ssl_context, arguments.searches)
+                print(f'{mode:<14}{result["mean_ms"]:10.2f}{result["p95_ms"]:10.2f}{result["connections"]:14d}{result["connect_ms"]:13.1f}')
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+
+    argument_parser = argparse.ArgumentParser(description='接続プールの有無による外部通信の比較')
+    argument_parser.add_argument('--searches', type=int, default=50, help='計測する検索の回数')
+    argument_parser.add_argument('--no-tls', action='store_true', help='HTTPで通信する')
+    asyncio.run(main(argument_parser.parse_args()))
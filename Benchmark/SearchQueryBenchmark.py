@@ -0,0 +1,198 @@
+'''
+メッセージの解析処理 (SearchQuery.standardize_message → has_query_marks → split_to_each_query_texts → place_resolver.resolve) の
+1呼び出しあたりの所要時間とメモリ確保量を、メッセージの種類ごとに計測する。
+
+保存したベースライン (Benchmark/SearchQueryBaseline.json) と比較し、
+・解析結果が変わった場合
+・所要時間かメモリ確保量が許容範囲を超えて増えた場合
+に終了コード1で終了する。
+
+実行方法 (リポジトリのルートで)
+    python Benchmark/SearchQueryBenchmark.py                    # ベースラインと比較
+    python Benchmark/SearchQueryBenchmark.py --update-baseline  # 現在の結果をベースラインとして保存
+    python Benchmark/SearchQueryBenchmark.py --tolerance 0.3    # 所要時間の許容増加率 (既定 1.0 = 2倍)
+
+所要時間はマシンに依存するため、ベースラインは比較するマシンと同じマシンで作成すること。
+'''
+import argparse
+import contextlib
+import io
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+# ルートディレクトリをsys.pathに追加
+root_directory = Path(__file__).resolve().parent.parent
+sys.path.append(str(root_directory))
+
+from SearchQuery import SearchQuery
+
+
+BASELINE_PATH = root_directory / 'Benchmark' / 'SearchQueryBaseline.json'
+QUERY_MARKS = [["/", False], ["+", False], ["¥", False], ["=", True]] # main.pyと同じ
+REPEAT_QUANTITY = 7 # 計測の繰り返し回数 (最も速かった回を採用)
+LOOP_QUANTITY = 200 # 1回の計測で呼び出す回数
+DEFAULT_TOLERANCE = 1.0 # 所要時間の許容増加率 (計測のぶれで誤検知しないよう、2倍を超えたら退行とする)
+MEMORY_TOLERANCE = 0.1 # メモリ確保量の許容増加率
+
+# 種類ごとのメッセージ
+CORPUS = {
+    'short': [
+        '+新橋',
+        '=焼肉',
+        '¥3000',
+        '次の5件',
+        'お気に入り店舗一覧',
+        'こんにちは',
+    ],
+    'full-width': [
+        '＋新橋　＝海鮮　個室',
+        '／２０２４－１２－２４　＋渋谷　￥３０００',
+        '＼５０００＝イタリアン　ワイン',
+        '＋ｓｈｉｎｊｕｋｕ　＝ＢＡＲ',
+        '次の５件',
+    ],
+    'long': [
+        '/2024-12-24\n+新橋\n¥5000\n=海鮮 個室 飲み放題 日本酒 禁煙 駅近 カード可 記念日 誕生日 サプライズ',
+        '=' + '落ち着いた雰囲気で会話を楽しめる 個室 ' * 10,
+        '今度の金曜日に同僚と飲みに行くのでお店を探しています。' * 5 + '+有楽町 ¥4000 =焼き鳥',
+        '+' + '新橋' * 50 + ' =' + 'もつ鍋 ' * 30,
+    ],
+    'mark-heavy': [
+        '/+¥=',
+        '++新橋 +渋谷 ==焼肉=寿司 ¥¥3000',
+        '=a+b/c¥d=e+f/g¥h',
+        '+ 新橋 = ',
+        '#+新橋=海鮮 個室',
+        '/20241224+新橋¥3000=海鮮 個室',
+    ],
+}
+
+# 計測する処理。 (名前, 入力の準備(計測対象外), 計測する関数)
+STAGES = [
+    ('standardize_message', lambda message: message, SearchQuery.standardize_message),
+    ('has_query_marks', SearchQuery.standardize_message, lambda text: SearchQuery.has_query_marks(text, QUERY_MARKS)),
+    ('split_to_each_query_texts', SearchQuery.standardize_message, lambda text: SearchQuery.split_to_each_query_texts(text, QUERY_MARKS)),
+    ('parse_message', lambda message: message, lambda message: parse_message(message)),
+    ('place_resolver.resolve', lambda message: (parse_message(message) or ['', ''])[1], SearchQuery.place_resolver.resolve),
+]
+
+
+def parse_message(message: str) -> list:
+    '''
+    main.handle_message と同じ順で、メッセージから検索条件リストを取り出す。検索条件記号がない場合はNone
+    '''
+    standardized_message = SearchQuery.standardize_message(message)
+    if not SearchQuery.has_query_marks(standardized_message, QUERY_MARKS):
+        return None
+    return SearchQuery.split_to_each_query_texts(standardized_message, QUERY_MARKS)
+
+
+def measure_time_us(stage, stage_input: str) -> float:
+    '''
+    1呼び出しあたりの所要時間(μs)
+    '''
+    best = float('inf')
+    for _ in range(REPEAT_QUANTITY):
+        start = time.perf_counter()
+        for _ in range(LOOP_QUANTITY):
+            stage(stage_input)
+        best = min(best, (time.perf_counter() - start) / LOOP_QUANTITY)
+    return best * 1_000_000
+
+
+def measure_peak_bytes(stage, stage_input: str) -> int:
+    '''
+    1呼び出しで確保されたメモリの最大量(byte)
+    '''
+    tracemalloc.start()
+    stage(stage_input)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run_benchmark() -> dict:
+    '''
+    全メッセージを計測し、{'results': メッセージ→解析結果, 'stages': 処理→種類→{time_us, peak_bytes}} を返す。
+    '''
+    results = {}
+    stages = {}
+    # split_to_each_query_texts のprintを計測結果の表示に混ぜない
+    with contextlib.redirect_stdout(io.StringIO()):
+        for category, messages in CORPUS.items():
+            for message in messages:
+                results[message] = parse_message(message)
+
+        for stage_name, prepare, stage in STAGES:
+            stages[stage_name] = {}
+            for category, messages in CORPUS.items():
+                inputs = [prepare(message) for message in messages]
+                stages[stage_name][category] = {
+                    'time_us': statistics.mean(measure_time_us(stage, stage_input) for stage_input in inputs),
+                    'peak_bytes': max(measure_peak_bytes(stage, stage_input) for stage_input in inputs),
+                }
+
+    return {'results': results, 'stages': stages}
+
+
+def compare_with_baseline(current: dict, baseline: dict, tolerance: float) -> list:
+    '''
+    ベースラインからの退行を文字列のリストで返す。
+    '''
+    regressions = []
+
+    for message, result in current['results'].items():
+        if message in baseline['results'] and baseline['results'][message] != result:
+            regressions.append(f'result changed: {message!r}\n    baseline: {baseline["results"][message]}\n    current : {result}')
+
+    for stage_name, categories in current['stages'].items():
+        for category, measurement in categories.items():
+            baseline_measurement = baseline['stages'].get(stage_name, {}).get(category)
+            if baseline_measurement is None:
+                continue
+            if measurement['time_us'] > baseline_measurement['time_us'] * (1 + tolerance):
+                regressions.append(f'slower: {stage_name} [{category}] {baseline_measurement["time_us"]:.2f} us -> {measurement["time_us"]:.2f} us')
+            if measurement['peak_bytes'] > baseline_measurement['peak_bytes'] * (1 + MEMORY_TOLERANCE):
+                regressions.append(f'more memory: {stage_name} [{category}] {baseline_measurement["peak_bytes"]} B -> {measurement["peak_bytes"]} B')
+
+    return regressions
+
+
+def report(current: dict, baseline: dict) -> None:
+    print(f'{"stage":<28}{"messages":<12}{"time/call":>12}{"baseline":>12}{"peak":>10}{"baseline":>10}')
+    for stage_name, categories in current['stages'].items():
+        for category, measurement in categories.items():
+            baseline_measurement = (baseline or {}).get('stages', {}).get(stage_name, {}).get(category)
+            baseline_time = f'{baseline_measurement["time_us"]:9.2f} us' if baseline_measurement else ''
+            baseline_peak = f'{baseline_measurement["peak_bytes"]:8d} B' if baseline_measurement else ''
+            print(f'{stage_name:<28}{category:<12}{measurement["time_us"]:9.2f} us{baseline_time:>12}'
+                  f'{measurement["peak_bytes"]:8d} B{baseline_peak:>10}')
+
+
+if __name__ == "__main__":
+
+    argument_parser = argparse.ArgumentParser(description='SearchQueryのメッセージ解析のベンチマーク')
+    argument_parser.add_argument('--update-baseline', action='store_true', help='現在の結果をベースラインとして保存する')
+    argument_parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='所要時間の許容増加率')
+    arguments = argument_parser.parse_args()
+
+    current = run_benchmark()
+    baseline = json.loads(BASELINE_PATH.read_text(encoding='utf-8')) if BASELINE_PATH.exists() else None
+    report(current, baseline)
+
+    if arguments.update_baseline:
+        BASELINE_PATH.write_text(json.dumps(current, ensure_ascii=False, indent=2) + '\n', encoding='utf-8')
+        print(f'baseline saved: {BASELINE_PATH}')
+        sys.exit(0)
+
+    if baseline is None:
+        sys.exit(f'no baseline: run with --update-baseline to create {BASELINE_PATH}')
+
+    regressions = compare_with_baseline(current, baseline, arguments.tolerance)
+    for regression in regressions:
+        print('REGRESSION', regression)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+
+class LruTtlCache:
+    """件数上限(LRU)と有効期限(TTL)のあるインメモリキャッシュ。
+    プロセス内で共有するため、操作はロックで保護する。
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        """
+        Args:
+            max_size (int): 保持する最大件数。超えた場合は最も長く使われていないものから削除する。
+            ttl_seconds (float): 保存してから有効な秒数。
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0 # キャッシュから返せた回数
+        self.misses = 0 # キャッシュになかった(もしくは期限切れだった)回数
+        self._entries = OrderedDict() # key : (有効期限, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """keyに対応する値を返す。ない場合や期限切れの場合はdefaultを返す。
+
+        Args:
+            key (Any): キー
+            default (Any, optional): キャッシュにない場合に返す値。
+
+        Returns:
+            Any: キャッシュされた値
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            # キャッシュにない場合
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            # 期限切れの場合は削除
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            # 最近使われたものとして末尾に移動
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        """keyに値を保存する。件数上限を超えた場合は最も古いものを削除する。
+
+        Args:
+            key (Any): キー
+            value (Any): 保存する値
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Any) -> None:
+        """keyの値を削除する（なければ何もしない）。
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """全ての値と統計を削除する。
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """件数とヒット率などの統計を返す。
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
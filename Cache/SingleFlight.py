@@ -0,0 +1,76 @@
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable
+
+from Deadline import EventDeadline
+
+
+class SingleFlight:
+    """同じキーの処理が実行中の場合、新しく実行せずにその結果を待って共有する。
+    (同じ検索条件・同じ店舗の取得が同時に来た場合に、外部への通信を1回にまとめる)
+    結果は保存しないため、完了後に同じキーで呼び出すと再び実行する。
+    """
+
+    def __init__(self):
+        self.executed = 0 # 実際に実行した回数
+        self.shared = 0 # 実行中の処理の結果を共有した回数
+        self._flights = {} # key : 実行中のタスク
+
+    async def do(self, key: Any, coroutine_function: Callable[..., Awaitable], *args, timeout: float = None) -> Any:
+        """keyの処理が実行中ならその結果を、なければcoroutine_function(*args)を実行した結果を返す。
+        例外も同じように共有する。
+        処理はどの呼び出し元のイベントの期限にも縛られないよう、空のコンテキストで実行する。
+        呼び出し元ごとに、自分のイベントの期限(timeoutの指定があればtimeout秒)までしか結果を待たない。
+
+        Args:
+            key (Any): 処理を識別するキー (検索条件、shop_idなど)
+            coroutine_function (Callable[..., Awaitable]): 実行するコルーチン関数
+            *args: coroutine_functionの引数
+            timeout (float, optional): 結果を待つ秒数。 省略時はイベントの期限まで(イベントの処理中でなければ完了まで)
+
+        Returns:
+            Any: coroutine_functionの結果
+
+        Raises:
+            asyncio.TimeoutError: 待つ時間内に処理が終わらなかった場合（処理は続ける）
+        """
+        task = self._flights.get(key)
+        if task is None:
+            task = contextvars.Context().run(asyncio.create_task, coroutine_function(*args))
+            self._flights[key] = task
+            task.add_done_callback(lambda done_task: self._discard(key, done_task))
+            self.executed += 1
+        else:
+            self.shared += 1
+
+        # 呼び出し元の1つがキャンセルされたり、待つのをやめても、他の呼び出し元が待つ処理は続ける
+        if timeout is None:
+            deadline = EventDeadline.current_deadline()
+            if deadline is None:
+                return await asyncio.shield(task)
+            timeout = deadline.remaining()
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+
+    def _discard(self, key: Any, task: asyncio.Task) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # 待つ呼び出し元がいなくなった場合に、未取得の例外として警告されないようにする
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        """実行中のキーの数と、実行・共有の回数を返す。
+        """
+        return {
+            'in_flight': len(self._flights),
+            'executed': self.executed,
+            'shared': self.shared,
+        }
+
+    def __contains__(self, key: Any) -> bool:
+        """keyの処理が実行中かを返す。
+        """
+        return key in self._flights
+
+    def __len__(self) -> int:
+        return len(self._flights)
@@ -1,4 +1,7 @@
 import sqlite3
+import threading
+import contextlib
+import contextvars
 
 
 import sys
@@ -12,6 +15,229 @@ root_directory = current_directory.parent
 sys.path.append(str(root_directory))
 
 
+### ------------------- DB接続の管理 ------------------- ###
+
+PERSISTENT_CONNECTION = True # Falseの場合、従来通り呼び出しごとに接続・切断する（ベンチマークでの比較用）
+MAX_IDLE_CONNECTION_QUANTITY = 8 # 接続プールに保持しておく接続数の上限
+
+# 接続を作成した時に1度だけ設定するPRAGMA
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL', # 読み込みと書き込みを同時に行えるようにする
+    'synchronous': 'NORMAL', # WALではNORMALでも破損しない。コミットごとのfsyncを減らす
+    'mmap_size': 268435456, # 256MBまでメモリマップで読み込む
+    'cache_size': -16000, # ページキャッシュ 16MB (負の値はKB単位)
+    'temp_store': 'MEMORY', # 一時テーブルをメモリに置く
+    'busy_timeout': 5000, # 書き込みロック待ちの上限(ms)
+}
+
+
+class ConnectionPool:
+    """1つのDBファイルに対する、永続的な接続のプール。
+    接続はスレッドをまたいで使い回すため check_same_thread=False で作成する。
+    """
+
+    def __init__(self, DATABASE_PATH: str, max_idle_connection_quantity: int = MAX_IDLE_CONNECTION_QUANTITY):
+        self.database_path = DATABASE_PATH
+        self.max_idle_connection_quantity = max_idle_connection_quantity
+        self._idle_connections = [] # 使用されていない接続
+        self._lock = threading.Lock()
+
+    def create_connection(self) -> sqlite3.Connection:
+        """新しい接続を作成し、PRAGMAを設定する。
+        """
+        connect = sqlite3.connect(self.database_path, check_same_thread=False)
+        for pragma, value in CONNECTION_PRAGMAS.items():
+            connect.execute(f'PRAGMA {pragma} = {value}')
+        return connect
+
+    def checkout(self) -> sqlite3.Connection:
+        """プールから接続を取り出す。空いている接続がなければ新しく作成する。
+        """
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop()
+        return self.create_connection()
+
+    def release(self, connect: sqlite3.Connection) -> None:
+        """使い終わった接続をプールに戻す。上限を超える場合は切断する。
+        """
+        # 未確定のトランザクションが残っていれば破棄してから戻す
+        if connect.in_transaction:
+            connect.rollback()
+
+        with self._lock:
+            if len(self._idle_connections) < self.max_idle_connection_quantity:
+                self._idle_connections.append(connect)
+                return
+        connect.close()
+
+    def close_all(self) -> None:
+        """プール中の接続を全て切断する。
+        """
+        with self._lock:
+            idle_connections, self._idle_connections = self._idle_connections, []
+        for connect in idle_connections:
+            connect.close()
+
+
+class BoundConnection:
+    """1リクエストの間、固定して使う接続。
+    """
+
+    def __init__(self, DATABASE_PATH: str, connect: sqlite3.Connection):
+        self.database_path = DATABASE_PATH
+        self.connection = connect
+        self.transaction_depth = 0 # transaction()の入れ子の深さ
+        self.lock = threading.RLock() # 同じ接続を複数スレッドから同時に使わないためのロック
+
+
+_connection_pools = {} # DBのパス : ConnectionPool
+_connection_pools_lock = threading.Lock()
+_bound_connection = contextvars.ContextVar('bound_connection', default=None) # リクエスト中に固定された接続
+
+
+def get_connection_pool(DATABASE_PATH: str) -> ConnectionPool:
+    """DBのパスに対応する接続プールを返す（なければ作成）。
+    """
+    with _connection_pools_lock:
+        if DATABASE_PATH not in _connection_pools:
+            _connection_pools[DATABASE_PATH] = ConnectionPool(DATABASE_PATH)
+        return _connection_pools[DATABASE_PATH]
+
+
+def close_all_connections() -> None:
+    """全ての接続プールの接続を切断する（終了時やベンチマーク用）。
+    """
+    with _connection_pools_lock:
+        connection_pools = list(_connection_pools.values())
+    for connection_pool in connection_pools:
+        connection_pool.close_all()
+
+
+def checkout_connection(DATABASE_PATH: str) -> sqlite3.Connection:
+    """接続を取得する。PERSISTENT_CONNECTIONがFalseの場合は毎回新しく接続する。
+    """
+    if not PERSISTENT_CONNECTION:
+        return sqlite3.connect(DATABASE_PATH)
+    return get_connection_pool(DATABASE_PATH).checkout()
+
+
+def release_connection(DATABASE_PATH: str, connect: sqlite3.Connection) -> None:
+    """checkout_connectionで取得した接続を返却する。
+    """
+    if not PERSISTENT_CONNECTION:
+        connect.close()
+        return
+    get_connection_pool(DATABASE_PATH).release(connect)
+
+
+def get_bound_connection(DATABASE_PATH: str) -> BoundConnection:
+    """現在のリクエストに固定されている接続を返す。なければNone。
+    """
+    bound = _bound_connection.get()
+    if bound is None or bound.connection is None or bound.database_path != DATABASE_PATH:
+        return None
+    return bound
+
+
+@contextlib.contextmanager
+def request_connection(DATABASE_PATH: str):
+    """with内（1リクエスト）のDB操作で、同じ接続を使い回す。
+    contextvarsで接続を固定するため、asyncio.to_threadで呼び出した関数からも同じ接続が使われる。
+
+    Args:
+        DATABASE_PATH (str): DBのパス
+    """
+    # 既に固定されている場合はそのまま使う
+    if get_bound_connection(DATABASE_PATH):
+        yield
+        return
+
+    connect = checkout_connection(DATABASE_PATH)
+    bound = BoundConnection(DATABASE_PATH, connect)
+    token = _bound_connection.set(bound)
+    try:
+        yield
+    finally:
+        _bound_connection.reset(token)
+        # with内で作成されたタスクなどが、返却後の接続を使わないようにする
+        with bound.lock:
+            bound.connection = None
+        release_connection(DATABASE_PATH, connect)
+
+
+@contextlib.contextmanager
+def transaction(DATABASE_PATH: str, immediate: bool = False):
+    """with内のDB操作を1つのトランザクションにまとめる。例外が発生した場合はロールバックする。
+    ロックを保持するため、with内はスレッドをまたがない同期処理とすること。
+
+    Args:
+        DATABASE_PATH (str): DBのパス
+        immediate (bool, optional): Trueの場合、開始時に書き込みロックを取得する(BEGIN IMMEDIATE)。
+                                    読み込んだ内容をもとに書き込む処理を、他の接続・プロセスと直列にするため。
+    """
+    with request_connection(DATABASE_PATH):
+        bound = get_bound_connection(DATABASE_PATH)
+        with bound.lock:
+            if bound.transaction_depth == 0:
+                bound.connection.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            bound.transaction_depth += 1
+            try:
+                yield
+            except BaseException:
+                bound.transaction_depth -= 1
+                if bound.transaction_depth == 0:
+                    bound.connection.rollback()
+                raise
+            else:
+                bound.transaction_depth -= 1
+                if bound.transaction_depth == 0:
+                    bound.connection.commit()
+
+
+@contextlib.contextmanager
+def open_cursor(DATABASE_PATH: str):
+    """DB操作用のカーソルを開く。
+    リクエスト中は固定された接続を、それ以外は接続プールの接続を使う。
+    トランザクション外では、with内の処理が終わった時点でコミットする。
+
+    Args:
+        DATABASE_PATH (str): DBのパス
+    """
+    bound = get_bound_connection(DATABASE_PATH)
+
+    # リクエストに固定された接続を使う場合
+    if bound:
+        with bound.lock:
+            cursor = bound.connection.cursor()
+            try:
+                yield cursor
+                if bound.transaction_depth == 0:
+                    bound.connection.commit() # 反映させる
+            except BaseException:
+                if bound.transaction_depth == 0:
+                    bound.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+        return
+
+    # 接続プールの接続を使う場合
+    connect = checkout_connection(DATABASE_PATH)
+    cursor = connect.cursor()
+    try:
+        yield cursor
+        connect.commit() # 反映させる
+    except BaseException:
+        connect.rollback()
+        raise
+    finally:
+        # カーソルをクローズし、接続を返却
+        cursor.close()
+        release_connection(DATABASE_PATH, connect)
+
+
+
 ### ------------------- テーブルの初期作成 ------------------- ###
 
 def create_user_table(DATABASE_PATH: str):
@@ -22,21 +248,22 @@ def create_user_table(DATABASE_PATH: str):
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # 下記項目でUserテーブルを定義して作成
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS User (
-            id TEXT PRIMARY KEY
-        )
-    ''')
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    connect.commit()
+        # 下記項目でUserテーブルを定義して作成
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS User (
+                id TEXT PRIMARY KEY,
+                search_generation INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+        # search_generation列がない(古い)Userテーブルの場合、列を追加する
+        # (Searchレコードを全削除するたびに増やし、取り出したレコードを戻してよいかの判定に使う)
+        cursor.execute('PRAGMA table_info(User)')
+        user_columns = [row[1] for row in cursor.fetchall()]
+        if 'search_generation' not in user_columns:
+            cursor.execute('ALTER TABLE User ADD COLUMN search_generation INTEGER NOT NULL DEFAULT 0')
 
 
 def create_shop_table(DATABASE_PATH: str):
@@ -47,27 +274,27 @@ def create_shop_table(DATABASE_PATH: str):
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # 下記項目でShopテーブルを定義して作成
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Shop (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            img_url TEXT NOT NULL,
-            access TEXT NOT NULL,
-            affiliate_url TEXT NOT NULL,
-            review_score INTEGER,
-            review_quantity INTEGER
-        )
-    ''')
-
-    connect.commit()
-
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+    with open_cursor(DATABASE_PATH) as cursor:
+
+        # 下記項目でShopテーブルを定義して作成
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Shop (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                img_url TEXT NOT NULL,
+                access TEXT NOT NULL,
+                affiliate_url TEXT NOT NULL,
+                review_score INTEGER,
+                review_quantity INTEGER,
+                update_date TEXT
+            )
+        ''')
+
+        # update_date列がない(古い)Shopテーブルの場合、列を追加する
+        cursor.execute('PRAGMA table_info(Shop)')
+        shop_columns = [row[1] for row in cursor.fetchall()]
+        if 'update_date' not in shop_columns:
+            cursor.execute('ALTER TABLE Shop ADD COLUMN update_date TEXT')
 
 
 def create_search_table(DATABASE_PATH: str):
@@ -78,69 +305,94 @@ def create_search_table(DATABASE_PATH: str):
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # 下記項目でSearchテーブルを定義して作成
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Search (
-            id INTEGER PRIMARY KEY,
-            user_id TEXT,
-            shop_id TEXT,
-            UNIQUE (user_id, shop_id),
-            FOREIGN KEY (user_id) REFERENCES User (id),
-            FOREIGN KEY (shop_id) REFERENCES Shop (id)
-        )
-    ''')
-
-    connect.commit()
-
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+    with open_cursor(DATABASE_PATH) as cursor:
+
+        # 下記項目でSearchテーブルを定義して作成
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Search (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT,
+                shop_id TEXT,
+                review_score REAL,
+                review_quantity INTEGER,
+                UNIQUE (user_id, shop_id),
+                FOREIGN KEY (user_id) REFERENCES User (id),
+                FOREIGN KEY (shop_id) REFERENCES Shop (id)
+            )
+        ''')
+
+        # 検索結果ページの一覧に表示された評価の列がない(古い)Searchテーブルの場合、列を追加する
+        # (review_quantityがNULLなら一覧の情報なし、0なら一覧に評価の表示なし)
+        cursor.execute('PRAGMA table_info(Search)')
+        search_columns = [row[1] for row in cursor.fetchall()]
+        if 'review_score' not in search_columns:
+            cursor.execute('ALTER TABLE Search ADD COLUMN review_score REAL')
+            cursor.execute('ALTER TABLE Search ADD COLUMN review_quantity INTEGER')
+
+        # ユーザーごとのSearchレコードを登録順(id順)に引くためのインデックス
+        cursor.execute('CREATE INDEX IF NOT EXISTS search_user_id_index ON Search (user_id, id)')
 
 
 def create_query_table(DATABASE_PATH: str):
     
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Query (
-            user_id TEXT,
-            date TEXT,
-            place TEXT,
-            price INTEGER,
-            freeword TEXT,
-            PRIMARY KEY (user_id, date, place, price, freeword),
-            FOREIGN KEY (user_id) REFERENCES User (id)
-        )
-    ''')
-    connect.commit()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Query (
+                user_id TEXT,
+                date TEXT,
+                place TEXT,
+                price INTEGER,
+                freeword TEXT,
+                PRIMARY KEY (user_id, date, place, price, freeword),
+                FOREIGN KEY (user_id) REFERENCES User (id)
+            )
+        ''')
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+
+SCHEMA_VERSION = 4 # スキーマを変更したら上げる。 (1: Shop.update_date列, 2: search_user_id_index, 3: Search.review_score・review_quantity列, 4: User.search_generation列)
+
+
+def get_schema_version(DATABASE_PATH: str) -> int:
+    """DBに記録したスキーマのバージョン(PRAGMA user_version)を返す。未作成のDBは0。
+    """
+    with open_cursor(DATABASE_PATH) as cursor:
+        cursor.execute('PRAGMA user_version')
+        return cursor.fetchone()[0]
 
 
 def setup_database(DATABASE_PATH: str) -> None:
     """ユーザーと店舗の情報・多対多の関係を記録したノミノミDBの作成。
-    
+    スキーマが最新(SCHEMA_VERSION)のDBでは、バージョンの確認のみで何もしない。
+    作成・更新は1つの接続・1つのトランザクションで行う。
+
     Args:
         DATABASE_PATH (str): DBのパス
 
     Returns:
        None:
     """ 
+    with request_connection(DATABASE_PATH):
+        # 起動のたびにテーブル作成を実行しないよう、バージョンが最新なら終了
+        if get_schema_version(DATABASE_PATH) >= SCHEMA_VERSION:
+            return None
+
+        # 同時に起動した他のプロセスと重ならないよう、書き込みロックを取ってから作成・更新する
+        with transaction(DATABASE_PATH, immediate=True):
+            if get_schema_version(DATABASE_PATH) >= SCHEMA_VERSION:
+                return None
+
+            # カーソルに身作成であれば、各テーブルを初期設定・作成
+            create_user_table(DATABASE_PATH) # Userテーブル
+            create_shop_table(DATABASE_PATH) # Shopテーブル
 
-    # カーソルに身作成であれば、各テーブルを初期設定・作成
-    create_user_table(DATABASE_PATH) # Userテーブル
-    create_shop_table(DATABASE_PATH) # Shopテーブル
+            create_search_table(DATABASE_PATH) # Searchテーブル　（User <-> Shop の中間テーブル）
 
-    create_search_table(DATABASE_PATH) # Searchテーブル　（User <-> Shop の中間テーブル）
+            create_query_table(DATABASE_PATH) # Queryテーブル　（User -> Query の1対多テーブル）
 
-    create_query_table(DATABASE_PATH) # Queryテーブル　（User -> Query の1対多テーブル）
+            with open_cursor(DATABASE_PATH) as cursor:
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
 
     return None
 
@@ -162,15 +414,8 @@ def add_user_record(DATABASE_PATH: str, user_id: str) -> None:
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    cursor.execute('INSERT INTO User (id) VALUES (?)', (user_id,)) # レコードの追加
-    connect.commit() # 反映させる
-
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+    with open_cursor(DATABASE_PATH) as cursor:
+        cursor.execute('INSERT INTO User (id) VALUES (?)', (user_id,)) # レコードの追加
 
     return None
 
@@ -185,29 +430,17 @@ def is_new_user(DATABASE_PATH: str, user_id: str) -> bool:
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # ユーザーの検索条件を取得
-    cursor.execute('SELECT 1 FROM User WHERE id = ?', (user_id,))
+        # ユーザーの検索条件を取得
+        cursor.execute('SELECT 1 FROM User WHERE id = ?', (user_id,))
+        user_record = cursor.fetchone()
 
     # 新規ユーザーの場合
-    if not cursor.fetchone(): # Noneの場合。
-        connect.commit()
-
-        # 接続をクローズ
-        cursor.close()
-        connect.close()
-
+    if not user_record: # Noneの場合。
         return True
     
     # 登録済みのユーザーの場合
-    connect.commit()
-
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
-
     return False # ['user1', '2023-01-01', 'Tokyo', 1000, 'Sample query 1']などの場合。
 
 
@@ -225,19 +458,13 @@ def get_user_queries(DATABASE_PATH: str, user_id: str) -> list:
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # ユーザーの検索条件を取得
-    cursor.execute('SELECT * FROM Query WHERE user_id = ?', (user_id,))
-    
-    # ユーザーの検索条件
-    user_queries = cursor.fetchone() # ['user1', '2023-01-01', 'Tokyo', 1000, 'Sample query 1']
-    connect.commit()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+        # ユーザーの検索条件を取得
+        cursor.execute('SELECT * FROM Query WHERE user_id = ?', (user_id,))
+        
+        # ユーザーの検索条件
+        user_queries = cursor.fetchone() # ['user1', '2023-01-01', 'Tokyo', 1000, 'Sample query 1']
 
     return user_queries
 
@@ -254,16 +481,10 @@ def add_empty_query_record(DATABASE_PATH: str, user_id: str) -> None:
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # user_id以外はNULLで登録
-    cursor.execute('INSERT INTO Query (user_id, date, place, price, freeword) VALUES (?, NULL, NULL, NULL, NULL)', (user_id,))
-    connect.commit()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+        # user_id以外はNULLで登録
+        cursor.execute('INSERT INTO Query (user_id, date, place, price, freeword) VALUES (?, NULL, NULL, NULL, NULL)', (user_id,))
 
 
 def update_query(DATABASE_PATH: str, user_id: str, input_queries: list) -> None:
@@ -279,39 +500,32 @@ def update_query(DATABASE_PATH: str, user_id: str, input_queries: list) -> None:
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # 前回の検索条件を取得
-    cursor.execute('SELECT * FROM Query WHERE user_id = ?', (user_id,))
-    previous_queries = cursor.fetchone()[1:5] # index:0 はキー(shop_id)のため。
-
-    # 検索条件の更新
-    updated_queries = [] # 更新後の検索条件 
-    for previous_query, input_query in zip(previous_queries, input_queries):
-        
-        # 条件入力がない場合
-        if not input_query:
-            updated_queries.append(previous_query) # 前回の指定条件のまま
-            continue
-        
-        # 条件クリアを意図した入力だった場合
-        if input_query == '(clear)':
-            updated_queries.append(None) # 「指定条件なし」に更新 修正・確認 DB側と型で齟齬がないか確認 jump
-            continue
-        
-        # 新規条件指定の場合
-        updated_queries.append(input_query) # 新条件を追加        
-
-    # 検索条件を更新
-    cursor.execute('UPDATE Query SET date = ?, place = ?, price = ?, freeword = ? WHERE user_id = ?', 
-                   (updated_queries[0], updated_queries[1], updated_queries[2], updated_queries[3], user_id))
-
-    connect.commit()
-    
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+    with open_cursor(DATABASE_PATH) as cursor:
+
+        # 前回の検索条件を取得
+        cursor.execute('SELECT * FROM Query WHERE user_id = ?', (user_id,))
+        previous_queries = cursor.fetchone()[1:5] # index:0 はキー(shop_id)のため。
+
+        # 検索条件の更新
+        updated_queries = [] # 更新後の検索条件 
+        for previous_query, input_query in zip(previous_queries, input_queries):
+            
+            # 条件入力がない場合
+            if not input_query:
+                updated_queries.append(previous_query) # 前回の指定条件のまま
+                continue
+            
+            # 条件クリアを意図した入力だった場合
+            if input_query == '(clear)':
+                updated_queries.append(None) # 「指定条件なし」に更新 修正・確認 DB側と型で齟齬がないか確認 jump
+                continue
+            
+            # 新規条件指定の場合
+            updated_queries.append(input_query) # 新条件を追加        
+
+        # 検索条件を更新
+        cursor.execute('UPDATE Query SET date = ?, place = ?, price = ?, freeword = ? WHERE user_id = ?', 
+                       (updated_queries[0], updated_queries[1], updated_queries[2], updated_queries[3], user_id))
 
 
 def fetch_query_record_as_list(DATABASE_PATH: str, user_id: str) -> list:
@@ -325,22 +539,17 @@ def fetch_query_record_as_list(DATABASE_PATH: str, user_id: str) -> list:
         list: QueryRecordを作るための配列。インデックスが　date,place,price,freeword に対応
     """
     # データベースに接続
-    connect = sqlite3.connect(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # Shopテーブルから特定のshop_idの情報を取得
-    cursor.execute('''
-        SELECT date, place, price, freeword
-        FROM Query
-        WHERE user_id = ?
-    ''', (user_id,))
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # 取得した情報をフェッチ
-    fetched_query_record_list = cursor.fetchone()
+        # Shopテーブルから特定のshop_idの情報を取得
+        cursor.execute('''
+            SELECT date, place, price, freeword
+            FROM Query
+            WHERE user_id = ?
+        ''', (user_id,))
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+        # 取得した情報をフェッチ
+        fetched_query_record_list = cursor.fetchone()
 
     # 取得した情報を処理する（例えば、辞書などに変換する）jump
     # query_record = QueryRecord()
@@ -356,117 +565,111 @@ def fetch_query_record_as_list(DATABASE_PATH: str, user_id: str) -> list:
 
 ### ------------------- Shopテーブル、レコード ------------------- ###
 
-def add_shop_record(DATABASE_PATH: str, shop_record) -> None:
-    """Shopテーブルにレコードを追加
+def upsert_shop_records(DATABASE_PATH: str, shop_records: list) -> None:
+    """Shopテーブルに複数のレコードをまとめてアップサート（1回のexecutemany、1トランザクション）
+    "upsert" ：レコードが存在しない場合は新規に挿入し、既に存在する場合は更新する
 
     Args:
         DATABASE_PATH (str): DBへのパス。
-        shop_record (ShopRecord): ShopRecordインスタンス
+        shop_records (list[ShopRecord]): ShopRecordインスタンスのリスト
 
     Returns:
-        _type_: _description_
+        None:
     """
-    
-    # 保存先のDBファイルをカーソル（操作対象）として扱う設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
+    if not shop_records:
+        return None
 
-    cursor.execute(
-        '''INSERT INTO Shop (
-            id,
-            name,
-            img_url,
-            access,
-            affiliate_url,
-            review_score,
-            review_quantity
-        ) VALUES (?, ?, ?, ?, ?, ?, ?)''',
-        (shop_record.shop_id, shop_record.name, shop_record.img_url, shop_record.access, shop_record.affiliate_url, shop_record.review_score, shop_record.review_quantity)
-    ) # レコードの追加
-    connect.commit() # 反映させる
-
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+    # 保存先のDBファイルをカーソル（操作対象）として扱う設定
+    with open_cursor(DATABASE_PATH) as cursor:
+
+        cursor.executemany(
+            '''INSERT INTO Shop (
+                id,
+                name,
+                img_url,
+                access,
+                affiliate_url,
+                review_score,
+                review_quantity,
+                update_date
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name,
+                img_url = excluded.img_url,
+                access = excluded.access,
+                affiliate_url = excluded.affiliate_url,
+                review_score = excluded.review_score,
+                review_quantity = excluded.review_quantity,
+                update_date = excluded.update_date''',
+            [(shop_record.shop_id, shop_record.name, shop_record.img_url, shop_record.access, shop_record.affiliate_url, shop_record.review_score, shop_record.review_quantity, shop_record.update_date)
+             for shop_record in shop_records]
+        ) # レコードをまとめて追加・更新
 
     return None
 
 
-def get_shop_record_list(DATABASE_PATH: str, shop_ids: list) -> list:
-    """ShopRecordインスタンスリストを作成
+def extract_registered_shop_ids(DATABASE_PATH: str, shop_ids: list) -> list: # 修正　見返して何をする関数かわからない
+    """shop_idリストのうち、Shopテーブルに登録済みのshop_idリストを抽出
 
     Args:
-        DATABASE_PATH (str): _description_
-        shop_ids (list): _description_
+        DATABASE_PATH (str): DBのパス
+        shop_ids (list): 元となるshop_idリスト
 
     Returns:
-        list[ShopRecord]: _description_
+        list: DBに既に登録済みのshop_idリスト
     """
-    # データベースに接続
-    connect = sqlite3.connect(DATABASE_PATH)
-    cursor = connect.cursor()
 
-    try:
-        dict_shop_record_list = []
+    # SQLiteへの接続
+    with open_cursor(DATABASE_PATH) as cursor:
 
-        for shop_id in shop_ids: 
-            # Shopテーブルから特定のshop_idの情報を取得
-            cursor.execute('''
-                SELECT id, name, img_url, access, affiliate_url, review_score, review_quantity
-                FROM Shop
-                WHERE id = ?
-            ''', (shop_id,))
+        # Shopテーブルから指定されたshop_idsに存在しないレコードを取得
+        cursor.execute('SELECT id FROM Shop WHERE id IN ({})'.format(','.join(['?'] * len(shop_ids))), shop_ids)
+        registered_shop_ids = [row[0] for row in cursor.fetchall()]
 
-            # 取得した情報をフェッチ
-            shop_record = cursor.fetchone()
+    return registered_shop_ids
 
-            print(shop_record)
 
-            # 取得した情報を処理する（例えば、辞書などに変換する）
-            dict_shop_record_info = {
-                'id': shop_record[0],
-                'name': shop_record[1],
-                'img_url': shop_record[2],
-                'access': shop_record[3],
-                'affiliate_url': shop_record[4],
-                'review_score': shop_record[5],
-                'review_quantity': shop_record[6]
-            }
+def get_shop_review_scores(DATABASE_PATH: str, shop_ids: list) -> dict:
+    """shop_idリストのうち、Shopテーブルで評価の有無がわかっている店舗の評価値をまとめて取得
 
-            dict_shop_record_list.append(dict_shop_record_info)
+    Args:
+        DATABASE_PATH (str): DBのパス
+        shop_ids (list): 元となるshop_idリスト
 
-        return dict_shop_record_list  # 取得した情報を返す
+    Returns:
+        dict: shop_id → review_score (評価のない店舗はNone)。
+              未登録の店舗と、レビューを取得せずに登録した(update_dateがNULLで評価のない)店舗は含まない
+    """
+    if not shop_ids:
+        return {}
 
-    finally:
-        # 接続をクローズ
-        cursor.close()
-        connect.close()
+    with open_cursor(DATABASE_PATH) as cursor:
+        cursor.execute('SELECT id, review_score FROM Shop WHERE (review_score IS NOT NULL OR update_date IS NOT NULL) AND id IN ({})'
+                       .format(','.join(['?'] * len(shop_ids))), shop_ids)
+        return {shop_id: review_score for shop_id, review_score in cursor.fetchall()}
 
 
-def extract_registered_shop_ids(DATABASE_PATH: str, shop_ids: list) -> list: # 修正　見返して何をする関数かわからない
-    """shop_idリストのうち、Shopテーブルに登録済みのshop_idリストを抽出
+def fetch_shop_records_as_list(DATABASE_PATH: str, shop_ids: list) -> list:
+    """DBに登録済みの複数のShopレコードを、1回のクエリ(WHERE id IN (...))で取得
 
     Args:
         DATABASE_PATH (str): DBのパス
-        shop_ids (list): 元となるshop_idリスト
+        shop_ids (list): shop_idリスト
 
     Returns:
-        list: DBに既に登録済みのshop_idリスト
+        list[list]: shop_idsの順に並べた、ShopRecordを作成するためのリストのリスト。
+                    DBに未登録のshop_idは含まない。
     """
+    if not shop_ids:
+        return []
 
-    # SQLiteへの接続
-    connect = sqlite3.connect(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # Shopテーブルから指定されたshop_idsに存在しないレコードを取得
-    cursor.execute('SELECT id FROM Shop WHERE id IN ({})'.format(','.join(['?'] * len(shop_ids))), shop_ids)
-    registered_shop_ids = [row[0] for row in cursor.fetchall()]
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+        cursor.execute('SELECT * FROM Shop WHERE id IN ({})'.format(','.join(['?'] * len(shop_ids))), shop_ids)
+        shop_records_by_id = {row[0]: list(row) for row in cursor.fetchall()}
 
-    return registered_shop_ids
+    # 要求されたshop_idsの順に並べ直す
+    return [shop_records_by_id[shop_id] for shop_id in shop_ids if shop_id in shop_records_by_id]
 
 
 def fetch_shop_record_as_list(DATABASE_PATH: str, shop_id: str) -> list: #jump
@@ -478,51 +681,25 @@ def fetch_shop_record_as_list(DATABASE_PATH: str, shop_id: str) -> list: #jump
 
     Returns:
         list: ShopRecordを作成するためのリスト。 インデックスに応じて、
-                shop_id, name, img_url, access, affiliate_url, review_score, review_quantity
+                shop_id, name, img_url, access, affiliate_url, review_score, review_quantity, update_date
                 を格納しています
     """
-    connect = sqlite3.connect(DATABASE_PATH)
-    cursor = connect.cursor()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # shop_idに基づいてShopテーブルから情報を取得
-    cursor.execute('SELECT * FROM Shop WHERE id = ?', (shop_id,))
-    shop_record_as_list = list(cursor.fetchone()) # タプル型をリスト型に変換
+        # shop_idに基づいてShopテーブルから情報を取得
+        cursor.execute('SELECT * FROM Shop WHERE id = ?', (shop_id,))
+        shop_record = cursor.fetchone()
 
     # 念の為DBに未登録の場合のエラー処理
-    if shop_record_as_list == []:
+    if not shop_record:
         print("Shopテーブルからレコード情報を取得できませんでした。")
         return 
 
-    # 接続終了
-    connect.close()
+    shop_record_as_list = list(shop_record) # タプル型をリスト型に変換
     
     return shop_record_as_list
 
 
-def upsert_shop_info(DATABASE_PATH: str, shop_id: str, shop_info: dict):
-    """店舗レコード情報をDBにアップサート。
-    "upsert" ：レコードが存在しない場合は新規に挿入し、既に存在する場合は更新する
-
-    Args:
-        DATABASE_PATH (str): データベースファイルのパス
-        shop_id (str): 店舗のID
-        shop_info (dict): 更新する店舗情報を含む辞書
-
-    Returns:
-        None
-    """
-    connect = sqlite3.connect(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # レコードが存在しない場合は新規挿入、既存の場合は更新する
-    cursor.execute('INSERT OR REPLACE INTO Shop (id, name, img_url, access, affiliate_url, review_score, review_quantity) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                   (shop_id, shop_info['name'], shop_info['img_url'], shop_info['access'], shop_info['affiliate_url'], shop_info['review_score'], shop_info['review_quantity']))
-
-    connect.commit()
-    cursor.close()
-    connect.close()
-
-
 def shop_reputation(review_score: float) -> str:
     """店舗のreview_scoreに応じて評価(str)を返す
 
@@ -543,33 +720,46 @@ def shop_reputation(review_score: float) -> str:
 
 ### ------------------- Searchテーブル、レコード ------------------- ###
 
-def add_search_records(DATABASE_PATH: str, user_id: str, shop_ids: list) -> None:
+def add_search_records(DATABASE_PATH: str, user_id: str, shop_ids: list, listing_reviews: dict = None) -> None:
     """UserとShopをつなぐ中間テーブルに、関係レコードを追加
 
     Args:
         DATABASE_PATH (str): DBのパス
         user_id (str): ユーザーのLINE_ID
         shop_ids (list[str]): 店舗のHotpepper_IDのリスト
+        listing_reviews (dict, optional): shop_id → 検索結果ページの一覧に表示された (review_score, review_quantity)
     """
+    listing_reviews = listing_reviews or {}
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # ヒットした各shop_idをSearchレコードとして追加
-    for shop_id in shop_ids:
-        cursor.execute('INSERT INTO Search (user_id, shop_id) VALUES (?, ?) ON CONFLICT(user_id, shop_id) DO NOTHING', (user_id, shop_id))
-    
-    # 反映させる
-    connect.commit()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+        # ヒットした各shop_idをSearchレコードとしてまとめて追加
+        cursor.executemany('INSERT INTO Search (user_id, shop_id, review_score, review_quantity) VALUES (?, ?, ?, ?) ON CONFLICT(user_id, shop_id) DO NOTHING',
+                           [(user_id, shop_id, *listing_reviews.get(shop_id, (None, None))) for shop_id in shop_ids])
 
     return None
 
 
+def get_listing_reviews(DATABASE_PATH: str, search_record_ids: list) -> dict:
+    """Searchレコードに保存した、検索結果ページの一覧に表示された評価を取得
+
+    Args:
+        DATABASE_PATH (str): DBのパス
+        search_record_ids (list[int]): Searchレコードのidリスト
+
+    Returns:
+        dict: shop_id → (review_score, review_quantity)。 一覧の情報がない店舗は含まない
+    """
+    if not search_record_ids:
+        return {}
+
+    with open_cursor(DATABASE_PATH) as cursor:
+        cursor.execute('SELECT shop_id, review_score, review_quantity FROM Search WHERE review_quantity IS NOT NULL AND id IN ({})'
+                       .format(','.join(['?'] * len(search_record_ids))), search_record_ids)
+        return {shop_id: (review_score, review_quantity) for shop_id, review_score, review_quantity in cursor.fetchall()}
+
+
 def get_user_shops(DATABASE_PATH: str, user_id: str) -> list:
     """ユーザーが持つshopのidを全て返す。
 
@@ -582,23 +772,16 @@ def get_user_shops(DATABASE_PATH: str, user_id: str) -> list:
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    cursor.execute('''
-        SELECT Shop.name
-        FROM Shop
-        JOIN Search ON Shop.id = Search.shop_id
-        WHERE Search.user_id = ?
-    ''', (user_id,))
+        cursor.execute('''
+            SELECT Shop.name
+            FROM Shop
+            JOIN Search ON Shop.id = Search.shop_id
+            WHERE Search.user_id = ?
+        ''', (user_id,))
 
-    user_shop_ids = [row[0] for row in cursor.fetchall()]
-
-    connect.commit()
-
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+        user_shop_ids = [row[0] for row in cursor.fetchall()]
 
     return user_shop_ids
 
@@ -615,39 +798,44 @@ def delete_select_search_record(DATABASE_PATH: str, selected_search_record_ids:
     """
 
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # 削除対象の ID をカンマで結合して文字列を生成
-    ids_string = ', '.join(map(str, selected_search_record_ids))
+        # 削除対象の ID をカンマで結合して文字列を生成
+        ids_string = ', '.join(map(str, selected_search_record_ids))
 
-    # SQL クエリの実行
-    cursor.execute(f'DELETE FROM Search WHERE id IN ({ids_string})')
-
-    connect.commit()
-
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+        # SQL クエリの実行
+        cursor.execute(f'DELETE FROM Search WHERE id IN ({ids_string})')
 
 
 def delete_all_search_records(DATABASE_PATH: str, user_id: str):
     """ユーザーの検索レコードを全削除する。
+    削除前に取り出したレコードが戻されないよう、ユーザーのsearch_generationを1増やす。
 
     Args:
         DATABASE_PATH (str): DBのパス
         user_id (str): ユーザーのLINE_ID
     """
     # 保存先のDBファイルをカーソル（操作対象）として扱う設定設定
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
+    with open_cursor(DATABASE_PATH) as cursor:
+        cursor.execute('DELETE FROM Search WHERE user_id = ?', (user_id,)) #　ユーザーのレコードを全削除
+        cursor.execute('UPDATE User SET search_generation = search_generation + 1 WHERE id = ?', (user_id,))
 
-    cursor.execute('DELETE FROM Search WHERE user_id = ?', (user_id,)) #　ユーザーのレコードを全削除
-    connect.commit()
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
+def get_search_generation(DATABASE_PATH: str, user_id: str) -> int:
+    """ユーザーのSearchレコードが全削除(新しい検索結果で置き換え)された回数。
+
+    Args:
+        DATABASE_PATH (str): DBのパス
+        user_id (str): ユーザーのLINE_ID
+
+    Returns:
+        int: search_generation。 ユーザーが未登録の場合はNone
+    """
+    with open_cursor(DATABASE_PATH) as cursor:
+        cursor.execute('SELECT search_generation FROM User WHERE id = ?', (user_id,))
+        user_record = cursor.fetchone()
+
+    return user_record[0] if user_record else None
 
 
 def select_shop(DATABASE_PATH: str, user_id: str, max_select_shop_quantity: int):
@@ -662,38 +850,87 @@ def select_shop(DATABASE_PATH: str, user_id: str, max_select_shop_quantity: int)
         tuple: 選出したSearchレコードのidリスト, shop_idのリスト
     """
     
-    connect = sqlite3.Connection(DATABASE_PATH)
-    cursor = connect.cursor()
-
-    # user_idが持つSearchレコードを全て取得
-    cursor.execute('SELECT id, shop_id FROM Search WHERE user_id = ?', (user_id,))
-    search_records = cursor.fetchall()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    # 最大数まで取得（max_select_shop_quantity以下の場合は全てを取得）
-    selected_records = search_records[:max_select_shop_quantity]
+        # user_idが持つSearchレコードを登録順に最大数まで取得（max_select_shop_quantity以下の場合は全てを取得）
+        cursor.execute('SELECT id, shop_id FROM Search WHERE user_id = ? ORDER BY id LIMIT ?', (user_id, max_select_shop_quantity))
+        selected_records = cursor.fetchall()
 
     # IDリストと対応するshop_idリストを作成して返す
     selected_search_record_ids = [record[0] for record in selected_records]
     selected_shop_ids = [record[1] for record in selected_records]
 
-    # 接続をクローズ
-    cursor.close()
-    connect.close()
-
     return selected_search_record_ids, selected_shop_ids
 
 
-def has_search_record(DATABASE_PATH: str, user_id: str) -> bool:
+def take_next_shops(DATABASE_PATH: str, user_id: str, max_select_shop_quantity: int):
+    """ユーザーの次に提案するSearchレコードを選出し、提案済みとして削除する。
+    選出と削除を1トランザクション(BEGIN IMMEDIATE)で行うため、
+    同じユーザーの並列リクエストが(別プロセスからでも)同じレコードを選ぶことはない。
 
-    connect = sqlite3.connect(DATABASE_PATH)
-    cursor = connect.cursor()
+    Args:
+        DATABASE_PATH (str): DBのパス
+        user_id (str): ユーザーのID
+        max_select_shop_quantity (int): 取得する最大のshop_idの数
+
+    Returns:
+        tuple: 選出したSearchレコードのidリスト, shop_idのリスト, shop_id → 一覧に表示された評価 (get_listing_reviews),
+               選出時のsearch_generation (restore_search_recordsに渡す)
+    """
+
+    with transaction(DATABASE_PATH, immediate=True):
+        # 次に提案するSearchレコードを選出
+        selected_search_record_ids, selected_shop_ids = select_shop(DATABASE_PATH, user_id, max_select_shop_quantity)
+        listing_reviews = get_listing_reviews(DATABASE_PATH, selected_search_record_ids)
+        search_generation = get_search_generation(DATABASE_PATH, user_id)
+
+        # 選出したレコードを削除
+        if selected_search_record_ids:
+            delete_select_search_record(DATABASE_PATH, selected_search_record_ids)
+
+    return selected_search_record_ids, selected_shop_ids, listing_reviews, search_generation
+
+
+def restore_search_records(DATABASE_PATH: str, user_id: str, search_generation: int, search_record_ids: list, shop_ids: list,
+                           listing_reviews: dict = None) -> bool:
+    """take_next_shopsで取り出したSearchレコードを、元のidのまま戻す（返信に失敗した場合など）。
+    元のidで戻すため、次回も同じ順番で提案される。
+    取り出した後に新しい検索でSearchレコードが置き換えられていた場合は、前の検索の店舗が先に提案されないよう戻さない。
+
+    Args:
+        DATABASE_PATH (str): DBのパス
+        user_id (str): ユーザーのID
+        search_generation (int): 取り出した時のsearch_generation (take_next_shopsの戻り値)
+        search_record_ids (list): 取り出したSearchレコードのidリスト
+        shop_ids (list): 取り出したshop_idリスト
+        listing_reviews (dict, optional): 取り出した、shop_id → 一覧に表示された評価
+
+    Returns:
+        bool: 戻した場合はTrue。 置き換えられていて戻さなかった場合はFalse
+    """
+    listing_reviews = listing_reviews or {}
+
+    # 置き換えの確認と追加の間に他の接続が置き換えないよう、書き込みロックを取ってから行う
+    with transaction(DATABASE_PATH, immediate=True):
+        if get_search_generation(DATABASE_PATH, user_id) != search_generation:
+            return False
+
+        with open_cursor(DATABASE_PATH) as cursor:
+            # 既に同じレコードがある場合は何もしない
+            cursor.executemany('INSERT INTO Search (id, user_id, shop_id, review_score, review_quantity) VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+                               [(search_record_id, user_id, shop_id, *listing_reviews.get(shop_id, (None, None)))
+                                for search_record_id, shop_id in zip(search_record_ids, shop_ids)])
+
+    return True
+
+
+def has_search_record(DATABASE_PATH: str, user_id: str) -> bool:
 
-    # Searchテーブルからユーザーのレコードを検索
-    cursor.execute('SELECT * FROM Search WHERE user_id = ?', (user_id,))
-    search_records = cursor.fetchall()
+    with open_cursor(DATABASE_PATH) as cursor:
 
-    connect.close()
+        # Searchテーブルにユーザーのレコードが存在するかどうかを判定（1件見つかった時点で終了）
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM Search WHERE user_id = ?)', (user_id,))
+        has_record = cursor.fetchone()[0]
 
-    # レコードが存在するかどうかを判定
-    return bool(search_records)
+    return bool(has_record)
 
@@ -0,0 +1,73 @@
+import contextlib
+import contextvars
+import time
+
+
+class EventDeadline:
+    """1イベントの処理に使える時間(予算)と、時間が足りずに省いた処理(縮退)の記録。
+    LINEのリプライトークンには有効期限があるため、期限内に返信できるよう処理を減らす判断に使う。
+    """
+
+    def __init__(self, budget_seconds: float):
+        """
+        Args:
+            budget_seconds (float): イベントを受け取ってから返信までに使える秒数
+        """
+        self.budget_seconds = budget_seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget_seconds
+        self.degradations = [] # 適用した縮退の名前（適用順、重複なし）
+
+    def elapsed(self) -> float:
+        """開始からの経過秒数"""
+        return time.monotonic() - self.started_at
+
+    def remaining(self) -> float:
+        """期限までの残り秒数。期限切れの場合は0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self, reserve_seconds: float) -> float:
+        """返信などに必要なreserve_seconds秒を残した上で、待つことのできる秒数。
+
+        Args:
+            reserve_seconds (float): 残しておく秒数
+
+        Returns:
+            float: 待つことのできる秒数。余裕がない場合は0
+        """
+        return max(0.0, self.remaining() - reserve_seconds)
+
+    def degrade(self, name: str) -> None:
+        """縮退を適用したことを記録する。
+
+        Args:
+            name (str): 縮退の名前 (skip_shop_review など)
+        """
+        if name not in self.degradations:
+            self.degradations.append(name)
+
+
+_current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+@contextlib.contextmanager
+def event_deadline(budget_seconds: float):
+    """with内（1イベント）の処理に期限を設定する。
+    contextvarsで保持するため、関数の引数で渡さなくても処理の途中からcurrent_deadline()で参照できる。
+    バックグラウンドタスク（空のコンテキストで実行）には期限は引き継がれない。
+
+    Args:
+        budget_seconds (float): イベントの処理に使える秒数
+    """
+    deadline = EventDeadline(budget_seconds)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline() -> EventDeadline:
+    """現在のイベントの期限を返す。イベントの処理中でなければNone。
+    """
+    return _current_deadline.get()
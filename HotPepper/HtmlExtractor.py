@@ -0,0 +1,252 @@
+'''
+ホットペッパーのHTMLから必要な要素だけを取り出す。
+
+ページ全体の木を作らず、SoupStrainerで対象の要素だけを解析する。
+lxmlがインストールされていれば、より高速なlxmlのパーサーを使う。
+起動を速くするため、bs4・lxmlは初めて解析する時(もしくはpreload時)に読み込む。
+'''
+import functools
+import os
+import re # 文字列
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup, SoupStrainer
+
+
+HOTPEPPER_URL_DOMAIN = os.environ.get("HOTPEPPER_URL_DOMAIN", "https://www.hotpepper.jp") # hotpepperのドメイン部分
+
+# 各ページで解析する要素 (SoupStrainerの引数)
+STRAINER_ARGUMENTS = {
+    'shop_name': ('h3', {'class_': 'shopDetailStoreName'}), # 検索結果ページの店舗名(店舗ページへのリンク)
+    'shop_listing': (['h3', 'div'], {'class_': ['shopDetailStoreName', 'ratingWrap']}), # 検索結果ページの店舗名と、各店舗の評価
+    'rating_wrap': ('div', {'class_': 'ratingWrap'}), # 店舗ページの評価
+    'page_info': (['li', 'ul'], {'class_': ['lh27', 'pageLinkLinearBasic cf']}), # 検索結果ページの総ページ数とページリンク
+}
+
+
+@functools.cache
+def get_html_parser() -> str:
+    '''
+    BeautifulSoupで使うパーサー名。lxmlがインストールされていればlxml
+    '''
+    try:
+        import lxml # noqa: F401 (パーサーとして使えるかの確認のみ)
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+
+@functools.cache
+def get_strainer(strainer_name: str) -> 'SoupStrainer':
+    from bs4 import SoupStrainer
+    name, attributes = STRAINER_ARGUMENTS[strainer_name]
+    return SoupStrainer(name, **attributes)
+
+
+def preload() -> None:
+    '''
+    bs4・lxmlを読み込んでおく。 (起動後、最初のリクエストの前にバックグラウンドで呼び出す)
+    '''
+    get_html_parser()
+    for strainer_name in STRAINER_ARGUMENTS:
+        get_strainer(strainer_name)
+
+
+def parse(html: str, strainer_name: str) -> 'BeautifulSoup':
+    """htmlのうち、strainerに該当する要素のみを解析する。
+
+    Args:
+        html (str): ページのHTML
+        strainer_name (str): 解析する要素の条件の名前 (STRAINER_ARGUMENTSのキー)
+
+    Returns:
+        BeautifulSoup: 該当する要素のみからなるsoup
+    """
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, get_html_parser(), parse_only=get_strainer(strainer_name))
+
+
+def extract_shop_ids(search_page_html: str) -> list:
+    """検索結果ページのHTMLから、掲載されているshop_idを取得。
+
+    Args:
+        search_page_html (str): ホットペッパーの検索結果ページのHTML
+
+    Returns:
+        list[str]: shop_idのリスト。 ["J001168707", ... ,"J999999999"] 1店舗もない場合はNoneを返す。
+    """
+    html_shop_lists = parse(search_page_html, 'shop_name').find_all('h3', class_='shopDetailStoreName')
+
+    if not html_shop_lists: # 1店舗もヒットしなかった場合
+        return
+
+    shop_ids = []
+    for html_shop_list in html_shop_lists:
+        # html_shop_list から shop_id の抽出
+        current_href_shop_id = html_shop_list.find('a')['href']  # "/strJ001168707/"
+        current_shop_id = current_href_shop_id[4:len(current_href_shop_id) - 1]  # "J001168707"
+        shop_ids.append(current_shop_id)
+
+    return shop_ids # ["J001168707", ... ,"J999999999"]
+
+
+def extract_shop_listings(search_page_html: str) -> list:
+    """検索結果ページのHTMLから、掲載されているshop_idと、一覧に表示されている評価を取得。
+    評価(ratingWrap)は店舗名(h3)の後に続くため、文書順で直前の店舗名の店舗の評価とする。
+
+    Args:
+        search_page_html (str): ホットペッパーの検索結果ページのHTML
+
+    Returns:
+        list[tuple]: (shop_id, review_score, review_quantity) のリスト（掲載順）。
+                     評価のない店舗と、評価の要素を読み取れなかった店舗は (shop_id, None, None)
+                     1店舗もない場合はNoneを返す。
+    """
+    shop_listings = []
+    for element in parse(search_page_html, 'shop_listing').find_all(['h3', 'div'], class_=['shopDetailStoreName', 'ratingWrap']):
+        # 1店舗の要素が想定と違っても、検索結果全体は失敗させない
+        try:
+            if element.name == 'h3':
+                href_shop_id = element.find('a')['href'] # "/strJ001168707/"
+                shop_listings.append((href_shop_id[4:len(href_shop_id) - 1], None, None))
+            elif shop_listings and shop_listings[-1][1] is None: # 直前の店舗の評価
+                review_score, _, review_quantity = extract_rating_wrap(element)
+                shop_listings[-1] = (shop_listings[-1][0], review_score, review_quantity)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"error: extract_shop_listings : {element.name} : {e!r}")
+            if element.name == 'h3': # shop_idを読み取れない店舗は、続く評価ごと除く
+                shop_listings.append((None, None, None))
+
+    shop_listings = [shop_listing for shop_listing in shop_listings if shop_listing[0] is not None]
+    if not shop_listings: # 1店舗もヒットしなかった場合
+        return
+
+    return shop_listings
+
+
+def extract_shop_review(shop_page_html: str) -> Any:
+    """店舗ページのHTMLから評価を取得。評価がない場合はNoneを返す。
+
+    Args:
+        shop_page_html (str): ホットペッパーの店舗ページのHTML
+
+    Returns:
+        float: review_score : 1.0~5.0 のホットペッパーの評価値
+        str: reputation : VeryGoodとか。
+        int: review_quantity : レビュー総数
+    """
+    # ratingScoreを含む要素 ratingWrap を取得
+    rating_wrap_element = parse(shop_page_html, 'rating_wrap').find('div', class_='ratingWrap')
+
+    # ratingWrap を取得できなかった場合 None でreturn
+    if not rating_wrap_element:
+        return None, None, None
+
+    # 評価の要素を読み取れない場合も、評価なしとして扱う
+    try:
+        return extract_rating_wrap(rating_wrap_element)
+    except (AttributeError, ValueError) as e:
+        print(f"error: extract_shop_review : {e!r}")
+        return None, None, None
+
+
+def extract_rating_wrap(rating_wrap_element) -> tuple:
+    """評価の要素(ratingWrap)から、(review_score, reputation, review_quantity) を取得。
+    店舗ページ・検索結果ページで同じ構造。
+
+    Raises:
+        AttributeError: 評価の値の要素がない場合
+        ValueError: 評価の値が数値でない場合
+    """
+    # レビュー情報を取得。
+    review_score: float = float(rating_wrap_element.find('span', class_='ratingScoreValue').text) # 3.6
+    reputation: str = rating_wrap_element.find('span', class_='ratingScoreText').text # "Very Good"
+    review_quantity_str: str = rating_wrap_element.find('span', class_='ratingReivew').text # '241件のレビューの総評'
+    review_quantity = extract_number_from_string(review_quantity_str) # 241
+
+    return review_score, reputation, review_quantity
+
+
+def extract_search_page_info(search_page_html: str) -> tuple:
+    """検索結果1ページ目のHTMLから、総ページ数とナンバリング短縮検索URLの共通部分を1回の解析で取得。
+
+    Args:
+        search_page_html (str): ホットペッパー検索結果の1ページ目のHTML
+
+    Returns:
+        tuple: (総ページ数, ナンバリング短縮検索URLの共通部分)
+               ヒット0件の時は(None, None)、1ページのみの時は(1, None)を返す。
+    """
+    page_info_soup = parse(search_page_html, 'page_info')
+
+    hit_search_page_quantity = extract_hit_search_page_quantity(page_info_soup)
+    if hit_search_page_quantity == None or hit_search_page_quantity == 1:
+        return hit_search_page_quantity, None
+
+    return hit_search_page_quantity, extract_core_numbering_search_url(page_info_soup)
+
+
+def extract_hit_search_page_quantity(page_info_soup: 'BeautifulSoup') -> int:
+    """ホットペッパー検索でヒットした全店舗がなすページ数
+
+    Args:
+        page_info_soup (BeautifulSoup): 検索結果1ページ目の、'page_info'の条件で解析したsoup
+
+    Returns:
+        int: ホットペッパー検索でヒットした全店舗がなす総ページ数。 ヒット0件の時のみNoneを返す。
+    """
+    # 必ず表示される、ページ数が書かれたタグ
+    page_quantity_element = page_info_soup.find('li', class_='lh27')
+    if page_quantity_element is None:
+        print("None: page quantity element not found : extract_hit_search_page_quantity")
+        return None
+
+    # ページ数部分のみを取得。（"1/nnnページ" → "nnn" → nnn）
+    page_quantity_sentence = page_quantity_element.text # "1/nnnページ"
+    hit_search_page_quantity = int(page_quantity_sentence[len("1/") : len(page_quantity_sentence)-len("ページ")])
+    return hit_search_page_quantity
+
+
+def extract_core_numbering_search_url(page_info_soup: 'BeautifulSoup') -> str:
+    '''
+    該当店舗数が2ページ以上（=店舗数が23以上）の時のみ呼び出すこと。
+    この検索条件のナンバリング短縮検索URLの共通部分を取得する。
+
+    <ul class="pageLinkLinearBasic cf">
+                            <li class="crt">
+                                <span>1</span>
+                            </li>
+                            <li>
+                                <a href="/SA11/fwt%E9%A4%83%E5%AD%90/bgn2/">
+                            ...
+    → "https://www.hotpepper.jp/SA11/fwt%E9%A4%83%E5%AD%90/bgn" を返す。
+    '''
+    second_page_li_index = 2 # lisのこの位置が2ページ目のURLを持ってる。
+
+    ul = page_info_soup.find('ul', class_='pageLinkLinearBasic cf') # ページ数クラスを抽出
+    lis = ul.find_all('li')
+
+    # ページ2 が入った li から、"/SA11/fwt%E9%A4%83%E5%AD%90/bgn" 部分を取得。
+    number2_nubering_search_url = lis[second_page_li_index].find('a')['href']
+
+    # "https://www.hotpepper.jp" + "/SA11/fwt%E9%A4%83%E5%AD%90/bgn"
+    core_numbering_search_url = HOTPEPPER_URL_DOMAIN + number2_nubering_search_url[:len(number2_nubering_search_url)-2]
+
+    return core_numbering_search_url
+
+
+def extract_number_from_string(s: str) -> int:
+    """文字列から数字の部分をint型で返す。("12件の~" → 12、"212件の~" → 212)
+
+    Args:
+        s (str): 数字を含む文字列
+
+    Returns:
+        int: 文字列の初めに連続する数字。ただし数字が見つからないとNone
+    """
+    numbers = re.findall(r'\d+', s)  # 文字列から数字の部分を抽出
+    if numbers:
+        return int(numbers[0])  # 抽出された数字のリストから最初の要素をint型に変換して返す
+    else:
+        return None  # 数字が見つからない場合はNoneを返す
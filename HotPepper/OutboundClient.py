@@ -0,0 +1,257 @@
+'''
+ホットペッパー(hotpepper.jp・グルメAPI)への通信をまとめて行うクライアント。
+
+・接続先のホストごとのトークンバケットで、1秒あたりのリクエスト数を制限する
+・1回のリクエストにタイムアウトを設定する (イベントの期限が近い場合はさらに短くする)
+・429 / 5xx / タイムアウト / 接続エラー / 読めない応答は、ジッター付きの指数バックオフで再試行する
+・ホストごとのサーキットブレーカーで、障害中のホストには通信せずにすぐ失敗する (CircuitOpenError)
+  呼び出し側は UpstreamError を受けて、別の取得方法やDBの情報で代替する
+
+通信に使うセッションは create_http_session で作成し、全ての取得処理(とLINE APIクライアント)で共有する。
+接続をプールして使い回すため、2回目以降のリクエストではDNSの名前解決とTCP・TLSの接続確立を行わない。
+'''
+import asyncio
+import random
+import time
+import urllib.parse
+from typing import Any
+
+import aiohttp
+
+from Deadline import EventDeadline
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504} # 再試行するステータス
+MAX_RETRY_AFTER_SECONDS = 5 # 429のRetry-Afterに従って待つ秒数の上限
+
+
+def create_http_session(limit: int, limit_per_host: int, keepalive_timeout_seconds: float, dns_cache_ttl_seconds: int) -> aiohttp.ClientSession:
+    """接続をプールして使い回す、共有用のセッションを作成する。 イベントループ上で呼び出すこと。
+
+    Args:
+        limit (int): 同時に開く接続数の上限 (全ホストの合計)
+        limit_per_host (int): ホストごとの同時に開く接続数の上限
+        keepalive_timeout_seconds (float): 使い終わった接続を、次のリクエストのために開いておく秒数
+        dns_cache_ttl_seconds (int): 名前解決の結果を使い回す秒数
+
+    Returns:
+        aiohttp.ClientSession: 共有用のセッション
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout_seconds,
+        ttl_dns_cache=dns_cache_ttl_seconds,
+    )
+    # 圧縮したレスポンスを受け取り、自動で展開する (HTMLは圧縮で数分の1になる)
+    return aiohttp.ClientSession(connector=connector, headers={'Accept-Encoding': 'gzip, deflate'}, auto_decompress=True)
+
+
+class UpstreamError(Exception):
+    """再試行しても外部サービスから正常な応答を得られなかった。
+    """
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status # 最後に受け取ったHTTPステータス（タイムアウト・接続エラーの場合はNone）
+
+
+class CircuitOpenError(UpstreamError):
+    """サーキットブレーカーが開いているため、通信せずに失敗した。
+    """
+
+
+class TokenBucket:
+    """1秒あたりrate個のトークンが補充され、最大capacity個まで貯まるバケット。
+    トークンが足りない場合は、先に並んだ分を含めて補充されるまで待つ。
+    """
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        """トークンを1つ予約し、使えるようになるまでの待ち時間(秒)を返す。
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+        self.tokens -= 1 # 足りない場合は負になり、後に並ぶ呼び出しほど長く待つ
+        return max(0.0, -self.tokens / self.rate_per_second)
+
+    def cancel(self) -> None:
+        """reserveで予約したトークンを戻す（待たずに諦めた場合）。
+        """
+        self.tokens += 1
+
+
+class CircuitBreaker:
+    """連続してfailure_threshold回失敗すると開き(open)、reset_timeout_seconds秒の間は通信させない。
+    その後は1回だけ試し(half_open)、成功すれば閉じ(closed)、失敗すればまた開く。
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        """通信してよいかを返す。
+        """
+        if self.state == 'closed':
+            return True
+        # 開いてから(試した呼び出しが結果を記録しないまま)reset_timeout_seconds秒経てば、1回だけ試す
+        if time.monotonic() - self.opened_at >= self.reset_timeout_seconds:
+            self.state = 'half_open'
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = 'closed'
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+
+class OutboundClient:
+    """共有セッションを使って、ホストごとに流量制限・再試行・サーキットブレーカーを行うHTTPクライアント。
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, rate_per_second: float, burst: float, timeout_seconds: float,
+                 max_retries: int, backoff_base_seconds: float, failure_threshold: int, reset_timeout_seconds: float):
+        """
+        Args:
+            session (aiohttp.ClientSession): 共有セッション
+            rate_per_second (float): ホストごとの1秒あたりのリクエスト数の上限。 0以下なら制限しない
+            burst (float): 一時的に超えてよいリクエスト数 (トークンバケットの容量)
+            timeout_seconds (float): 1回のリクエストのタイムアウト(秒)
+            max_retries (int): 再試行の最大回数
+            backoff_base_seconds (float): 再試行までの待ち時間の基準。 n回目は 0〜base*2^n 秒のランダム
+            failure_threshold (int): サーキットブレーカーが開く連続失敗回数
+            reset_timeout_seconds (float): サーキットブレーカーが開いてから、再び試すまでの秒数
+        """
+        self.session = session
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.token_buckets = {} # ホスト : TokenBucket
+        self.circuit_breakers = {} # ホスト : CircuitBreaker
+        self.counts = {'requests': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+
+    async def get_text(self, url: str, params: dict = None) -> str:
+        """GETリクエストを送り、レスポンス本文を返す。
+
+        Raises:
+            UpstreamError: 再試行しても正常な応答が得られなかった場合 (CircuitOpenErrorを含む)
+        """
+        return await self.request(url, params, lambda response: response.text())
+
+    async def get_json(self, url: str, params: dict = None) -> Any:
+        """GETリクエストを送り、レスポンスをjsonとして返す。
+
+        Raises:
+            UpstreamError: 再試行しても正常な応答が得られなかった場合 (CircuitOpenErrorを含む)
+        """
+        return await self.request(url, params, lambda response: response.json(content_type=None))
+
+    async def request(self, url: str, params: dict, read_response) -> Any:
+        host = urllib.parse.urlsplit(url).netloc
+        circuit_breaker = self.get_circuit_breaker(host)
+        deadline = EventDeadline.current_deadline()
+
+        for attempt in range(self.max_retries + 1):
+            if not circuit_breaker.allow():
+                self.counts['rejected'] += 1
+                raise CircuitOpenError(f'circuit open: {host}')
+
+            await self.wait_for_token(host, deadline)
+
+            # イベントの期限を超えて待たないよう、タイムアウトを短くする
+            timeout_seconds = self.timeout_seconds if deadline is None else min(self.timeout_seconds, deadline.remaining())
+            if timeout_seconds <= 0:
+                raise UpstreamError(f'deadline exceeded: {host}')
+            shortened_by_deadline = timeout_seconds < self.timeout_seconds
+            status = None
+            retry_after = None
+            self.counts['requests'] += 1
+            try:
+                async with self.session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout_seconds)) as response:
+                    status = response.status
+                    if status not in RETRY_STATUSES:
+                        result = await read_response(response)
+                        circuit_breaker.record_success() # 404なども、ホストは正常に応答している
+                        return result
+                    retry_after = response.headers.get('Retry-After')
+            # 200でもjsonとして読めない(エラーページのHTMLなど)場合は、失敗として扱う
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+            else:
+                error = None
+
+            # イベントの期限に合わせて短くしたタイムアウトは、ホストの障害ではないためサーキットブレーカーに数えない
+            if isinstance(error, asyncio.TimeoutError) and shortened_by_deadline:
+                raise UpstreamError(f'deadline exceeded: {host}')
+
+            self.record_failure(host, circuit_breaker)
+            message = f'{host}: status {status}' if error is None else f'{host}: {error!r}'
+
+            # 再試行までの待ち時間（429でRetry-Afterの指定があれば、それに従う）
+            backoff_seconds = random.uniform(0, self.backoff_base_seconds * 2 ** attempt)
+            if retry_after and retry_after.isdigit():
+                backoff_seconds = min(int(retry_after), MAX_RETRY_AFTER_SECONDS)
+            if attempt == self.max_retries or (deadline is not None and deadline.remaining() <= backoff_seconds):
+                raise UpstreamError(message, status)
+
+            print(f"outbound retry {attempt + 1}/{self.max_retries}: {message}")
+            self.counts['retries'] += 1
+            await asyncio.sleep(backoff_seconds)
+
+    async def wait_for_token(self, host: str, deadline) -> None:
+        """ホストのトークンバケットからトークンを取得する（足りなければ補充を待つ）。
+        イベントの期限までに取得できない場合は、待たずにUpstreamErrorとする。
+        """
+        if self.rate_per_second <= 0:
+            return
+
+        token_bucket = self.token_buckets.get(host)
+        if token_bucket is None:
+            token_bucket = self.token_buckets[host] = TokenBucket(self.rate_per_second, self.burst)
+
+        wait_seconds = token_bucket.reserve()
+        if deadline is not None and wait_seconds >= deadline.remaining():
+            token_bucket.cancel()
+            self.counts['rejected'] += 1
+            raise UpstreamError(f'rate limited: {host}')
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+
+    def get_circuit_breaker(self, host: str) -> CircuitBreaker:
+        circuit_breaker = self.circuit_breakers.get(host)
+        if circuit_breaker is None:
+            circuit_breaker = self.circuit_breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout_seconds)
+        return circuit_breaker
+
+    def record_failure(self, host: str, circuit_breaker: CircuitBreaker) -> None:
+        self.counts['failures'] += 1
+        was_open = circuit_breaker.state == 'open'
+        circuit_breaker.record_failure()
+        if circuit_breaker.state == 'open' and not was_open:
+            print(f"circuit breaker open: {host} ({self.reset_timeout_seconds}s)")
+
+    def stats(self) -> dict:
+        """リクエスト・再試行・失敗・拒否の回数と、ホストごとのサーキットブレーカーの状態を返す。
+        """
+        return dict(self.counts, circuits={host: circuit_breaker.state for host, circuit_breaker in self.circuit_breakers.items()})
@@ -0,0 +1,222 @@
+'''
+外部サービスを使わずに、/callback のスループットとレイテンシを計測する負荷試験。
+
+1. LoadTest/StandInServer.py の代替サーバーを起動する
+2. DBのコピーと代替サーバーの接続先を環境変数で渡して、uvicornで main:app を起動する
+3. 署名付きのWebhookイベントを /callback に送り続ける
+   1セッション = 新規検索1回 + 「次の5件」--next-per-search回。 同じユーザーのリクエストは順番に送る。
+   新規検索のうち --date-search-rate の割合は日付指定で送る (グルメAPIではなく検索結果ページから検索する)
+4. リクエスト種別ごとの p50 / p95 / p99 レイテンシと requests/sec を表示する
+
+実行方法 (リポジトリのルートで)
+    python LoadTest/LoadTest.py --duration 30 --concurrency 20 --next-per-search 2 --latency-ms 80
+'''
+import argparse
+import asyncio
+import base64
+import datetime
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from StandInServer import add_config_arguments, config_from_arguments, start_stand_in_server
+
+
+root_directory = Path(__file__).resolve().parent.parent
+SOURCE_DATABASE_PATH = root_directory / 'Database' / 'sqlite_database.db'
+CHANNEL_SECRET = 'load-test-channel-secret'
+
+# 新規検索で送るメッセージの場所とフリーワード (組み合わせ数 = 異なる検索条件の数)
+PLACES = ['新橋', '渋谷', '新宿', '池袋', '上野']
+FREEWORDS = ['居酒屋', '焼肉', '寿司', 'ラーメン', 'イタリアン', '焼き鳥', '中華', 'カフェ', '餃子', 'そば']
+
+NEW_SEARCH = 'new search'
+NEXT_SHOPS = '次の5件'
+
+
+def create_webhook_body(user_id: str, text: str, event_index: int) -> str:
+    '''
+    テキストメッセージ1件のWebhookリクエストボディを作る。
+    '''
+    return json.dumps({
+        'destination': 'Uloadtest',
+        'events': [{
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'source': {'type': 'user', 'userId': user_id},
+            'replyToken': f'reply-token-{event_index}',
+            'message': {'type': 'text', 'id': str(event_index), 'text': text},
+            'webhookEventId': f'event-{event_index}',
+            'deliveryContext': {'isRedelivery': False},
+        }],
+    }, ensure_ascii=False)
+
+
+def sign(body: str) -> str:
+    '''
+    LINEと同じ方法 (チャネルシークレットによるHMAC-SHA256のBase64) で署名する。
+    '''
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+async def run_virtual_user(session: aiohttp.ClientSession, app_url: str, user_id: str, deadline: float,
+                           next_per_search: int, date_search_rate: float, event_counter, results: dict) -> None:
+    '''
+    deadlineまで、新規検索 → 「次の5件」×next_per_search のセッションを繰り返す。
+    '''
+    search_date = (datetime.date.today() + datetime.timedelta(days=7)).isoformat() # 日付指定の検索で使う日付
+    while time.perf_counter() < deadline:
+        search_text = f'+{random.choice(PLACES)} ={random.choice(FREEWORDS)}'
+        if random.random() < date_search_rate:
+            search_text = f'/{search_date} {search_text}'
+        session_messages = [(NEW_SEARCH, search_text)]
+        session_messages += [(NEXT_SHOPS, NEXT_SHOPS)] * next_per_search
+
+        for kind, text in session_messages:
+            body = create_webhook_body(user_id, text, next(event_counter))
+            start = time.perf_counter()
+            try:
+                async with session.post(app_url + '/callback', data=body.encode(),
+                                        headers={'Content-Type': 'application/json', 'X-Line-Signature': sign(body)}) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+            results[kind]['latencies' if ok else 'errors'].append(elapsed_ms)
+            if not ok: # 検索に失敗したセッションの「次の5件」は意味がないので次のセッションへ
+                break
+
+
+def percentile(sorted_values: list, rate: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * rate))]
+
+
+def report(results: dict, elapsed_seconds: float) -> None:
+    print(f'{"":<12}{"requests":>9}{"errors":>8}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"mean ms":>9}')
+    all_latencies = []
+    for kind, result in list(results.items()) + [('total', None)]:
+        if result is None:
+            latencies = sorted(all_latencies)
+            errors = sum(len(result['errors']) for result in results.values())
+        else:
+            latencies = sorted(result['latencies'])
+            errors = len(result['errors'])
+            all_latencies += latencies
+        if not latencies:
+            print(f'{kind:<12}{0:>9}{errors:>8}')
+            continue
+        print(f'{kind:<12}{len(latencies):>9}{errors:>8}{len(latencies) / elapsed_seconds:>9.1f}'
+              f'{percentile(latencies, 0.50):>9.1f}{percentile(latencies, 0.95):>9.1f}{percentile(latencies, 0.99):>9.1f}'
+              f'{statistics.mean(latencies):>9.1f}')
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, app_url: str, process: subprocess.Popen) -> None:
+    '''
+    main:app が応答するまで待つ。
+    '''
+    for _ in range(300):
+        if process.poll() is not None:
+            sys.exit('main:app exited before becoming ready (see the app log)')
+        try:
+            async with session.get(app_url + '/openapi.json') as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    sys.exit('main:app did not become ready')
+
+
+async def main(arguments: argparse.Namespace) -> None:
+
+    stand_in_url = f'http://127.0.0.1:{arguments.stand_in_port}'
+    app_url = f'http://127.0.0.1:{arguments.app_port}'
+
+    runner, stand_in_app = await start_stand_in_server(config_from_arguments(arguments), '127.0.0.1', arguments.stand_in_port)
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        # 元のDBを汚さないよう、コピーしたDBで計測する
+        database_path = os.path.join(temporary_directory, 'load_test.db')
+        shutil.copy(SOURCE_DATABASE_PATH, database_path)
+        app_log_path = arguments.app_log or os.path.join(temporary_directory, 'app.log')
+
+        environment = dict(
+            os.environ,
+            DATABASE_PATH=database_path,
+            HOTPEPPER_URL_DOMAIN=stand_in_url,
+            HOTPEPPER_API_BASE_URL=stand_in_url + '/hotpepper/gourmet/v1/',
+            LINE_API_ENDPOINT=stand_in_url,
+            OUTBOUND_RATE_PER_SECOND=str(arguments.outbound_rate),
+            LINE_BOT_CHANNEL_SECRET=CHANNEL_SECRET,
+            LINE_BOT_CHANNEL_ACCESS_TOKEN='load-test-access-token',
+            HOTPEPPRE_API_KEY='load-test-api-key',
+            SEARCH_FORM_LIFF=os.environ.get('SEARCH_FORM_LIFF', 'https://liff.line.me/load-test'),
+            SHARE_LIFF_BASE_URI=os.environ.get('SHARE_LIFF_BASE_URI', 'https://liff.line.me/load-test'),
+        )
+
+        with open(app_log_path, 'w') as app_log:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(arguments.app_port), '--log-level', 'warning'],
+                cwd=root_directory, env=environment, stdout=app_log, stderr=subprocess.STDOUT,
+            )
+            try:
+                connector = aiohttp.TCPConnector(limit=arguments.concurrency)
+                async with aiohttp.ClientSession(connector=connector) as session:
+                    await wait_until_ready(session, app_url, process)
+
+                    results = {NEW_SEARCH: {'latencies': [], 'errors': []}, NEXT_SHOPS: {'latencies': [], 'errors': []}}
+                    event_counter = itertools.count()
+                    start = time.perf_counter()
+                    deadline = start + arguments.duration
+                    await asyncio.gather(*[
+                        run_virtual_user(session, app_url, f'Uloadtest{n:04d}', deadline, arguments.next_per_search,
+                                         arguments.date_search_rate, event_counter, results)
+                        for n in range(arguments.concurrency)
+                    ])
+                    elapsed_seconds = time.perf_counter() - start
+            finally:
+                process.terminate()
+                process.wait()
+
+        print(f'{arguments.duration}s, {arguments.concurrency} users, {arguments.next_per_search} "{NEXT_SHOPS}" per search, '
+              f'date search rate {arguments.date_search_rate}, '
+              f'upstream {arguments.latency_ms}±{arguments.jitter_ms} ms, error rate {arguments.error_rate}')
+        report(results, elapsed_seconds)
+        print('stand-in requests:', dict(stand_in_app['counts']))
+        if arguments.app_log:
+            print('app log:', app_log_path)
+
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+
+    argument_parser = argparse.ArgumentParser(description='代替サーバーを使った /callback の負荷試験')
+    argument_parser.add_argument('--duration', type=float, default=30, help='計測時間(秒)')
+    argument_parser.add_argument('--concurrency', type=int, default=10, help='同時に操作するユーザー数')
+    argument_parser.add_argument('--next-per-search', type=int, default=2, help='新規検索1回あたりの「次の5件」の回数')
+    argument_parser.add_argument('--date-search-rate', type=float, default=0,
+                                 help='新規検索のうち、日付指定で送る(検索結果ページから検索する)割合')
+    argument_parser.add_argument('--app-port', type=int, default=8090)
+    argument_parser.add_argument('--stand-in-port', type=int, default=8091)
+    argument_parser.add_argument('--outbound-rate', type=float, default=0,
+                                 help='main:app のホストごとの流量制限(req/s)。 代替サーバーは1ホストのため、既定は0(制限なし)')
+    argument_parser.add_argument('--app-log', help='main:app の出力を保存するファイル (省略時は破棄)')
+    add_config_arguments(argument_parser)
+
+    asyncio.run(main(argument_parser.parse_args()))
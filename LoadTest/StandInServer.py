@@ -0,0 +1,228 @@
+'''
+負荷試験用に、外部サービス(hotpepper.jpの検索結果ページ・店舗ページ、ホットペッパーグルメAPI、LINEの返信API)を
+ローカルで代替するサーバー。応答の遅延とエラー率を設定できる。
+グルメAPIは店舗id指定と条件検索(keyword / middle_area / count / start)に対応する。
+実際のサービスと同じく、Accept-Encodingに応じてレスポンスを圧縮する。
+
+main.py 側は環境変数で接続先をこのサーバーに向ける。
+    HOTPEPPER_URL_DOMAIN   = http://127.0.0.1:<port>
+    HOTPEPPER_API_BASE_URL = http://127.0.0.1:<port>/hotpepper/gourmet/v1/
+    LINE_API_ENDPOINT      = http://127.0.0.1:<port>
+
+単体で起動する場合 (リポジトリのルートで)
+    python LoadTest/StandInServer.py --port 8081 --latency-ms 80 --error-rate 0.01
+'''
+import argparse
+import asyncio
+import random
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from urllib.parse import quote
+
+from aiohttp import web
+
+
+SHOP_QUANTITY_PER_PAGE = 20 # 検索結果1ページあたりの店舗数 (ホットペッパーと同じ)
+
+
+@dataclass
+class StandInConfig:
+    latency_ms: float = 50 # hotpepper.jp / APIの平均応答時間
+    jitter_ms: float = 20 # 応答時間のばらつき(標準偏差)
+    error_rate: float = 0.0 # hotpepper.jp / APIが503を返す割合
+    line_latency_ms: float = 30 # LINE返信APIの平均応答時間
+    search_page_quantity: int = 5 # 1つの検索条件でヒットするページ数
+    compression: bool = True # Accept-Encodingに応じてレスポンスを圧縮するか
+
+
+def shop_id_of(keyword: str, index: int) -> str:
+    '''
+    検索キーワードとヒット順から、検索ごとに決まったshop_idを作る。 "J0xxxxxxxx"
+    '''
+    return f'J0{(zlib.crc32(keyword.encode()) + index) % 100000000:08d}'
+
+
+def has_review(shop_id: str) -> bool:
+    '''
+    2/3の店舗に評価がある。
+    '''
+    return zlib.crc32(shop_id.encode()) % 3 != 0
+
+
+def render_search_page(keyword: str, page: int, page_quantity: int) -> str:
+    '''
+    ホットペッパーの検索結果ページと同じ要素構造のHTMLを作る。
+    '''
+    keyword_path = '/SA11/fwt' + quote(keyword) + '/bgn'
+    pager_links = ''.join(
+        f'<li><a href="{keyword_path}{n}/">{n}</a></li>' for n in range(2, min(page_quantity, 10) + 1)
+    )
+    pager = (
+        '<div class="pageLinkWrap"><ul class="pageLinkLinearBasic cf">'
+        f'<li class="crt"><span>{page}</span></li>{pager_links}</ul>'
+        f'<ul class="pageLinkCounter"><li class="lh27">{page}/{page_quantity}ページ</li></ul></div>'
+    )
+
+    shops = []
+    for n in range(SHOP_QUANTITY_PER_PAGE):
+        shop_id = shop_id_of(keyword, (page - 1) * SHOP_QUANTITY_PER_PAGE + n)
+        rating = (
+            '<div class="ratingWrap"><span class="ratingScoreValue">4.0</span>'
+            '<span class="ratingScoreText">Very Good</span><span class="ratingReivew">12件のレビューの総評</span></div>'
+        ) if has_review(shop_id) else ''
+        shops.append(
+            '<div class="shopDetailTop"><p class="shopDetailGenre">居酒屋｜駅 徒歩5分</p>'
+            f'<h3 class="shopDetailStoreName"><a href="/str{shop_id}/">{keyword} {shop_id}</a></h3>{rating}'
+            + '<ul class="shopDetailInfo">' + '<li>営業時間 17:00～23:30</li>' * 8 + '</ul></div>'
+        )
+
+    return f'<html><head><title>検索結果</title></head><body>{pager}{"".join(shops)}{pager}</body></html>'
+
+
+def render_shop_page(shop_id: str) -> str:
+    '''
+    ホットペッパーの店舗ページと同じ要素構造のHTMLを作る。
+    '''
+    rating = (
+        '<div class="ratingWrap"><span class="ratingScoreValue">4.1</span>'
+        '<span class="ratingScoreText">Very Good</span><span class="ratingReivew">241件のレビューの総評</span></div>'
+    ) if has_review(shop_id) else ''
+    return f'<html><head><title>{shop_id}</title></head><body><h1 class="shopName">{shop_id}</h1>{rating}</body></html>'
+
+
+def shop_json(shop_id: str) -> dict:
+    '''
+    ホットペッパーグルメAPIの店舗情報のうち、main.pyで使う項目。
+    '''
+    photo_url = f'https://imgfp.hotp.jp/IMGH/{shop_id}.jpg'
+    return {
+        'id': shop_id,
+        'name': f'代替店舗 {shop_id}',
+        'photo': {'pc': {'l': photo_url, 'm': photo_url, 's': photo_url}, 'mobile': {'l': photo_url, 's': photo_url}},
+        'mobile_access': '新橋駅徒歩5分',
+        'access': '新橋駅 徒歩5分',
+        'urls': {'pc': f'https://www.hotpepper.jp/str{shop_id}/'},
+    }
+
+
+def create_app(config: StandInConfig) -> web.Application:
+    '''
+    代替サーバーのアプリケーションを作る。 app['counts'] にルートごとのリクエスト数を記録する。
+    '''
+    counts = Counter()
+
+    async def simulate_upstream(route: str) -> None:
+        '''
+        外部サービスの応答時間を再現し、error_rateの割合で503を返す。
+        '''
+        counts[route] += 1
+        await asyncio.sleep(max(0.0, random.gauss(config.latency_ms, config.jitter_ms)) / 1000)
+        if random.random() < config.error_rate:
+            counts[route + ' 503'] += 1
+            raise web.HTTPServiceUnavailable(text='stand-in error')
+
+    async def search_first_page(request: web.Request) -> web.Response:
+        await simulate_upstream('search page')
+        keyword = request.query.get('FWT', '')
+        return web.Response(text=render_search_page(keyword, 1, config.search_page_quantity), content_type='text/html')
+
+    async def search_numbering_page(request: web.Request) -> web.Response:
+        await simulate_upstream('search page')
+        keyword = request.match_info['keyword'][len('fwt'):]
+        page = int(request.match_info['page'][len('bgn'):])
+        return web.Response(text=render_search_page(keyword, page, config.search_page_quantity), content_type='text/html')
+
+    async def shop_page(request: web.Request) -> web.Response:
+        await simulate_upstream('shop page')
+        shop_id = request.match_info['shop'][len('str'):]
+        return web.Response(text=render_shop_page(shop_id), content_type='text/html')
+
+    async def gourmet_api(request: web.Request) -> web.Response:
+        if 'id' in request.query: # 店舗id指定
+            await simulate_upstream('gourmet api')
+            shop_ids = [shop_id for shop_id in request.query['id'].split(',') if shop_id]
+            results_available = len(shop_ids)
+            start = 1
+        else: # 条件検索 (HTML検索と同じキーワードなら同じ店舗を返す)
+            await simulate_upstream('gourmet api search')
+            keyword = ' '.join(filter(None, [request.query.get('middle_area'), request.query.get('keyword')]))
+            results_available = config.search_page_quantity * SHOP_QUANTITY_PER_PAGE
+            start = int(request.query.get('start', 1))
+            end = min(start - 1 + int(request.query.get('count', 10)), results_available)
+            shop_ids = [shop_id_of(keyword, index) for index in range(start - 1, end)]
+
+        shops = [shop_json(shop_id) for shop_id in shop_ids]
+        return web.json_response({'results': {
+            'api_version': '1.30',
+            'results_available': results_available,
+            'results_returned': str(len(shops)),
+            'results_start': start,
+            'shop': shops,
+        }})
+
+    async def line_reply(request: web.Request) -> web.Response:
+        counts['line reply'] += 1
+        await request.read()
+        await asyncio.sleep(max(0.0, random.gauss(config.line_latency_ms, config.jitter_ms)) / 1000)
+        return web.json_response({})
+
+    @web.middleware
+    async def compress_response(request: web.Request, handler) -> web.StreamResponse:
+        response = await handler(request)
+        if config.compression:
+            response.enable_compression() # Accept-Encodingがなければ圧縮しない
+        return response
+
+    app = web.Application(middlewares=[compress_response])
+    app['counts'] = counts
+    app.router.add_get('/CSP/psh010/doBasic', search_first_page)
+    app.router.add_get('/SA11/{keyword}/{page}/', search_numbering_page)
+    app.router.add_get('/{shop}/', shop_page)
+    app.router.add_get('/hotpepper/gourmet/v1/', gourmet_api)
+    app.router.add_post('/v2/bot/message/reply', line_reply)
+    return app
+
+
+async def start_stand_in_server(config: StandInConfig, host: str, port: int, ssl_context=None) -> tuple:
+    '''
+    代替サーバーを起動し、(runner, app) を返す。 停止は await runner.cleanup()
+    ssl_contextを渡した場合はHTTPSで待ち受ける。
+    '''
+    app = create_app(config)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port, ssl_context=ssl_context).start()
+    return runner, app
+
+
+def add_config_arguments(argument_parser: argparse.ArgumentParser) -> None:
+    defaults = StandInConfig()
+    argument_parser.add_argument('--latency-ms', type=float, default=defaults.latency_ms, help='hotpepper.jp / APIの平均応答時間')
+    argument_parser.add_argument('--jitter-ms', type=float, default=defaults.jitter_ms, help='応答時間の標準偏差')
+    argument_parser.add_argument('--error-rate', type=float, default=defaults.error_rate, help='hotpepper.jp / APIが503を返す割合')
+    argument_parser.add_argument('--line-latency-ms', type=float, default=defaults.line_latency_ms, help='LINE返信APIの平均応答時間')
+    argument_parser.add_argument('--search-page-quantity', type=int, default=defaults.search_page_quantity, help='1つの検索条件でヒットするページ数')
+    argument_parser.add_argument('--no-compression', action='store_true', help='レスポンスを圧縮しない')
+
+
+def config_from_arguments(arguments: argparse.Namespace) -> StandInConfig:
+    return StandInConfig(
+        latency_ms=arguments.latency_ms,
+        jitter_ms=arguments.jitter_ms,
+        error_rate=arguments.error_rate,
+        line_latency_ms=arguments.line_latency_ms,
+        search_page_quantity=arguments.search_page_quantity,
+        compression=not arguments.no_compression,
+    )
+
+
+if __name__ == "__main__":
+
+    argument_parser = argparse.ArgumentParser(description='hotpepper.jp / ホットペッパーグルメAPI / LINE返信APIの代替サーバー')
+    argument_parser.add_argument('--host', default='127.0.0.1')
+    argument_parser.add_argument('--port', type=int, default=8081)
+    add_config_arguments(argument_parser)
+    arguments = argument_parser.parse_args()
+
+    web.run_app(create_app(config_from_arguments(arguments)), host=arguments.host, port=arguments.port, access_log=None)
@@ -0,0 +1,115 @@
+'''
+HotPepperTablesの都道府県・中エリアの表から、場所の検索条件をホットペッパーのエリアコードに変換する。
+
+表の地名をトライ木にまとめておき、入力された場所の中で最も長く一致する地名を探す。
+("新橋駅前" → 新橋 : 中エリア Y005、 "大阪" → 大阪 : 都道府県 SA23)
+CSVの読み込みは起動時の1回のみで、pandasは使わない。
+'''
+import csv
+import os
+from typing import NamedTuple
+
+
+PREFECTURE_TABLE_CSV_NAME = 'PrefctureTable.csv'
+DISTRICT_TABLE_CSV_NAME = 'DistrictTable.csv'
+DISTRICT_PREFECTURE_CODE = 'SA11' # DistrictTable.csvは東京都内の地名のみ
+
+# 地名のあとにこれらが続くだけの場合は、地名と同じ場所とみなす ("新橋駅" → 新橋)
+PLACE_SUFFIXES = ['駅周辺', '駅前', '周辺', '駅', '都', '府', '県']
+
+TERMINAL = '' # トライ木のノードで、地名の終わりを表すキー (1文字のキーと重ならない)
+
+
+class ResolvedPlace(NamedTuple):
+    name: str # 一致した表の地名
+    prefecture_code: str # 都道府県のコード (SA11など)
+    middle_area_code: str # 中エリアのコード (Y005など)。 都道府県のみ一致した場合はNone
+    keyword: str # エリアで絞った上で、キーワードとして検索する文字列。 地名だけの入力ならNone
+
+
+class PlaceResolver:
+    '''
+    地名 → エリアコード のトライ木。
+    '''
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, name: str, resolved_place: ResolvedPlace) -> None:
+        node = self.root
+        for char in name:
+            node = node.setdefault(char, {})
+        node[TERMINAL] = resolved_place
+
+    def find_longest_match(self, text: str) -> ResolvedPlace:
+        '''
+        textに含まれる地名のうち、最も長いものを返す。 見つからなければNone
+        同じ長さなら中エリアを都道府県より優先し ("東京都 新宿" → 新宿)、それも同じなら先に現れたものを返す。
+        '''
+        longest_match = None
+        longest_match_rank = (0, False) # (地名の長さ, 中エリアか)
+        for start in range(len(text)):
+            node = self.root
+            for end in range(start, len(text)):
+                node = node.get(text[end])
+                if node is None:
+                    break
+                if TERMINAL in node:
+                    match_rank = (end + 1 - start, node[TERMINAL].middle_area_code is not None)
+                    if match_rank > longest_match_rank:
+                        longest_match = node[TERMINAL]
+                        longest_match_rank = match_rank
+        return longest_match
+
+    def resolve(self, place: str) -> ResolvedPlace:
+        '''
+        場所の検索条件をエリアコードに変換する。表の地名を含まない場合はNone
+
+        Args:
+            place (str): 場所の検索条件 ("新橋", "新橋駅前 大衆酒場" など)
+
+        Returns:
+            ResolvedPlace: エリアコードと、エリアで絞った上で検索するキーワード
+        '''
+        if not place:
+            return None
+
+        resolved_place = self.find_longest_match(place)
+        if resolved_place is None:
+            return None
+
+        # 地名(+駅などの接尾語)だけの入力なら、キーワードは不要
+        if place == resolved_place.name or place in [resolved_place.name + suffix for suffix in PLACE_SUFFIXES]:
+            return resolved_place
+        return resolved_place._replace(keyword=place)
+
+
+def read_csv_rows(csv_path: str) -> list:
+    with open(csv_path, encoding='utf-8', newline='') as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def load_place_resolver(hotpepper_tables_directory: str, normalize=None) -> PlaceResolver:
+    '''
+    PrefctureTable.csvとDistrictTable.csvからPlaceResolverを作る。
+    同じ地名がある場合は、より狭い中エリアを優先する。
+
+    Args:
+        hotpepper_tables_directory (str): CSVのあるディレクトリ
+        normalize (function, optional): 地名を入力メッセージと同じ形にそろえる関数 (半角変換など)
+
+    Returns:
+        PlaceResolver: 地名 → エリアコード のトライ木
+    '''
+    normalize = normalize or (lambda name: name)
+    place_resolver = PlaceResolver()
+
+    for row in read_csv_rows(os.path.join(hotpepper_tables_directory, PREFECTURE_TABLE_CSV_NAME)):
+        name = normalize(row['prefecture_name'])
+        place_resolver.add(name, ResolvedPlace(name, row['prefecture_code'], None, None))
+
+    for row in read_csv_rows(os.path.join(hotpepper_tables_directory, DISTRICT_TABLE_CSV_NAME)):
+        name = normalize(row['MidArea_name'])
+        place_resolver.add(name, ResolvedPlace(name, DISTRICT_PREFECTURE_CODE, row['MidArea_code'], None))
+
+    return place_resolver
@@ -1,9 +1,12 @@
 from linebot.models import TextSendMessage # 必要なライブラリのインポート
 
+import os
 import re # 正規表現を扱う
 import unicodedata # 記号全般に対応したライブラリ
 import jaconv # 全角→半角変換ライブラリ(¥は対応してない)
 
+from SearchQuery import PlaceResolver
+
 
 def calculate_budget_from_text(user_input_price_string, grade_range):
     '''
@@ -50,176 +53,79 @@ def calculate_budget_from_text(user_input_price_string, grade_range):
     return str(budget_min), str(budget_max)
 
 
-def get_sorted_mark_positions(standardized_text, query_marks):
-    '''
-    query_marks = [["#",0], ["@",0], ["¥",0], ["*",1]] が含まれている文字の位置と、スペースを含むかを取得(記号の区別なし)
-    standardized_text:"*ワイン¥
-    return:[[-1, 0], [1, 1], [5, 0], [8, 0]]
+class QueryTokenizer:
     '''
-    mark_positions = {} # returnに使う変数
-
-    for query_mark, include_space_flag in query_marks:
-        # standardized_textにquery_markが含まれる場合。("clear"を含む。)
-        if query_mark in standardized_text:
-            # 該当するインデックス番号を出力。
-            mark_positions[query_mark] = [standardized_text.index(query_mark), include_space_flag]
-        
-        # query_markが含まれない場合。
-        else:
-            mark_positions[query_mark] = [-1, include_space_flag] # mark_positionがない場合は、記号位置を-1で返す。
-    
-    # ソートのため、辞書型をリスト型に変換
-    mark_positions = list(mark_positions.values())  # {'#': [5, 0], '@': [-1, 0], '¥': [8, 0], '*': [1, 1]}
-    # 記号位置を小さい順にソート。(include_space_flagも合わせてソート)
-    mark_positions.sort() # [[-1, 0], [1, 1], [5, 0], [8, 0]]
-    
-    return mark_positions
-
+    メッセージを検索条件記号ごとの条件に分ける。 query_marks = [[記号, スペースを条件に含むか], ...]
+    記号は正規表現にまとめてコンパイルし、メッセージを1回走査するだけで分割する。(記号の追加はquery_marksのみで行える)
 
-def extract_query_text_until_return(text):
-    '''
-    概要；最初の改行までの文字列を取り出す。
-        textに改行文字が含まれる場合、1文字目〜最初の改行文字 を返す。
-        textに改行文字が含まれない場合、そのままtextを返す。
-    '''
-    for i, char in enumerate(text):
-        if char == '\n':
-            return text[:i]
-    return text
-    
-
-def extract_query_text_until_space_or_return(text):
-    '''
-    最初の改行or空白までの文字列を取り出す。
-        textに改行文字もしくは空白文字が含まれる場合、1文字目〜最初の改行or空白文字 を返す。
-        textに改行or空白文字が含まれない場合、そのままtextを返す。
-    '''
-    for i, char in enumerate(text):
-        if char == ' ' or char == '\n':
-            return text[:i]
-    return text
-    
-
-def extract_query_text_for_search(seperated_query_text, include_space_flag):
-    '''
-    概要；入力された１つの検索条件文字列について、スペースや改行までの文字列を取り出す。
-
-    seperated_query_text: （検索条件記号で挟まれた）1つの文字列
-    include_space_flag: seperated_query_text 
-    
-    例)
-    seperated_query_text = "新橋　有楽町" → extract_query_text = "新橋" : include_spaace_flag = Flaseの場合
-    seperated_query_text = "ワイン　ステーキ  " → extract_query_text = "ワイン ステーキ" : include_spaace_flag = Trueの場合
+    ・各記号は最初に現れた位置のみを区切りとして扱う。(2回目以降は条件の文字列の一部)
+    ・条件は、記号の直後から次の記号(の最初の位置)または文末まで。
+      スペースを含まない記号は最初の空白・改行まで、スペースを含む記号は最初の改行までを条件とする。
+    ・記号の直後に何もない場合は "(clear)" (条件クリア)、記号がない場合は "" (条件を維持)
     '''
 
-    # 検索条件が入力されていなかった場合
-    if seperated_query_text == "":
-        # 条件クリアのための値を代入(例："# "　→　#の条件をクリア)
-        return "(clear)"
+    def __init__(self, query_marks):
+        self.marks = [query_mark for query_mark, _ in query_marks]
+        self.mark_indexes = {query_mark: i for i, query_mark in enumerate(self.marks)}
+        # 記号ごとの、条件の終わりまでに一致する正規表現
+        self.query_text_patterns = [
+            re.compile(r'[^\n]*') if include_space_flag else re.compile(r'[^ \n]*')
+            for _, include_space_flag in query_marks
+        ]
+        # 長い記号を優先して一致させる
+        self.mark_pattern = re.compile('|'.join(re.escape(query_mark) for query_mark in sorted(self.marks, key=len, reverse=True)))
+
+    def split(self, standardized_text: str) -> list:
+        '''
+        「#+新橋=海鮮 個室」 →  ['', '新橋', '', '海鮮 個室']
+        '''
+        # 各記号の最初の位置を、文中に現れた順に取得 [(記号のindex, 記号の開始位置, 条件の開始位置), ...]
+        first_marks = []
+        found_mark_indexes = set()
+        for match in self.mark_pattern.finditer(standardized_text):
+            mark_index = self.mark_indexes[match.group()]
+            if mark_index in found_mark_indexes:
+                continue
+            found_mark_indexes.add(mark_index)
+            first_marks.append((mark_index, match.start(), match.end()))
+            if len(found_mark_indexes) == len(self.marks): # 全ての記号が見つかったら残りは走査しない
+                break
 
-    # スペースを含んでいい文字列の場合。
-    if include_space_flag == True:
-        # 改行のみを取り除く
-        extract_query_text = extract_query_text_until_return(seperated_query_text)
-    else:
-        # スペースと改行を取り除く
-        extract_query_text = extract_query_text_until_space_or_return(seperated_query_text)
+        queries = [''] * len(self.marks)
+        for order, (mark_index, _, query_start) in enumerate(first_marks):
+            # 次の記号の位置(最後の記号なら文末)までが条件
+            query_end = first_marks[order + 1][1] if order + 1 < len(first_marks) else len(standardized_text)
+            if query_start == query_end: # 記号の直後に条件がない場合は条件クリア
+                queries[mark_index] = '(clear)'
+            else:
+                queries[mark_index] = self.query_text_patterns[mark_index].match(standardized_text, query_start, query_end).group()
 
-    return extract_query_text
-    
+        return queries
 
-def separate_each_query_text_at_mark(standardized_text, sorted_mark_positions, query_marks):
-    '''
-    standardized_textをmark_positionsごとに区切って抜き出す。
-    ユーザーのキーボード入力に対しての使用を想定。
-    query_marksの順番で文字列から検索するため、ユーザーの記号入力順序に関係なく対応。
-    
-    sorted_mark_positions = [[-1, 0], [1, 1], [5, 0], [8, 0]]
-        → [query_mark(種類不問)の文字位置(昇順), spaceをどう扱うかのフラグ]
-    '''
-    separated_query_texts = [] # returnの入れ物
-    last_positon_in_query_text = len(standardized_text) # standardized_textの文末が何文字目か。
-
-    # 各query_marksに対してループを回す。：query_marks = [["/", False], ["+", False], ["¥", False], ["=", True]]
-    # appendはquery_marks順に行われる。
-    for mark_appearance_order in range(len(query_marks)):
-        
-        if sorted_mark_positions[mark_appearance_order][0] == -1: # 文章中にない記号を、はじめに処理しきる。
-            
-            separated_query_texts.append('') # 後工程では、条件クリアではなく、検測条件の維持をする。 
-        
-        else: # 対象の記号が文章にあったとき(記号位置が正)
-
-            # 検索条件抜き出しの終了位置を取得
-            current_query_end_position = get_current_query_end_position(mark_appearance_order, sorted_mark_positions, last_positon_in_query_text)
-            # 検索条件の抜き出し
-            separated_text = standardized_text[sorted_mark_positions[mark_appearance_order][0]+1:current_query_end_position]
-            # 検索条件文の標準化。(改行文字やスペースの削除。ただし、sorted_mark_positions[i][1] (= include_space_flag) == Flaseなら、スペースを残す。)
-            current_include_space_flag = sorted_mark_positions[mark_appearance_order][1]
-            current_query_text = extract_query_text_for_search(separated_text, current_include_space_flag)
-            
-            # 今回の記号に対応する検索条件文を、検索条件集に追加。
-            separated_query_texts.append(current_query_text)
 
-    return separated_query_texts #['', '新橋', '2500', '海鮮 個室']
+query_tokenizers = {} # id(query_marks) : (query_marksのコピー, QueryTokenizer)
 
 
-def get_current_query_end_position(current_mark_index, sorted_mark_positions, last_positon_in_query_text):
+def get_query_tokenizer(query_marks) -> QueryTokenizer:
     '''
-    current_mark_index個目の条件の、末尾位置を返す。
+    query_marksごとにコンパイル済みのQueryTokenizerを使い回す。
+    query_marksが書き換えられていた場合は作り直す。
     '''
-    query_mark_quantity = len(sorted_mark_positions) #　検索記号の総数。[/,+,¥,=]なら4。
-
-    if current_mark_index == query_mark_quantity - 1: # 文章中の最後の記号の場合
- 
-        # 文末をquery_end_positionとする。
-        end_position = last_positon_in_query_text
-    
-    else: # 文章中の最後の記号でない場合
-
-        # 次の記号位置をquery_end_positionとする。
-        end_position = sorted_mark_positions[current_mark_index+1][0]
+    cached = query_tokenizers.get(id(query_marks))
+    if cached is not None and cached[0] == query_marks:
+        return cached[1]
 
-    return end_position # 位置が+1となっているが、のちの処理で綺麗に処理できる。
-
-
-def sort_queries(standardiized_text, sorted_mark_positions, query_marks, queries):
-    '''
-    sorted_mark_positionsの記号を返す(?)
-    '''
-    sorted_queries = ["","","",""]
-    for i in range(len(sorted_mark_positions)):
-        
-        if sorted_mark_positions[i][0] == None:
-            continue
-
-        mark = standardiized_text[sorted_mark_positions[i][0]] #mark: i番目の記号
-        # sorted_query[j]
-        # j=0:"#"に対応する条件, j=1:"@"に対応する条件, j=2:"¥"に対応する条件, j=3:"*"に対応する条件
-        for j, query_mark in enumerate(query_marks):
-            if mark == query_mark[0]:
-                sorted_queries[j] = queries[i]
-                break
-
-    return sorted_queries
+    query_tokenizer = QueryTokenizer(query_marks)
+    query_tokenizers[id(query_marks)] = ([list(query_mark) for query_mark in query_marks], query_tokenizer)
+    return query_tokenizer
 
 
 def split_to_each_query_texts(standardized_text, query_marks):
     '''
     standardized_textから、query_marksに対応して、マーク間の条件を取得する。
-    「#+新橋=海鮮 個室」 →  ['(clear)', '新橋', '', '海鮮 個室']
+    「#+新橋=海鮮 個室」 →  ['', '新橋', '', '海鮮 個室']
     '''
-    # standardized_text : @新橋 富士山 #\n *海鮮 個室
-    # 記号位置を取得、小さい順位ソート（standardized_textに含まれていない記号は位置：-1と扱う。）
-    sorted_mark_positions = get_sorted_mark_positions(standardized_text, query_marks)
-
-    # 記号位置ごとに文章を分割, スペースや改行の適宜無視も行う。
-    queries = separate_each_query_text_at_mark(standardized_text, sorted_mark_positions, query_marks)
-    print(f'quaries:{queries}')
-    # 記号位置ごとに記号を取得
-    sorted_queries = sort_queries(standardized_text, sorted_mark_positions, query_marks, queries)
-    
-    return sorted_queries # sorted_queries : ['(clear)', '新橋', '', '海鮮 個室']
+    return get_query_tokenizer(query_marks).split(standardized_text)
 
 
 def has_query_marks(text, query_marks):
@@ -232,22 +138,55 @@ def has_query_marks(text, query_marks):
     return False
 
 
-def convert_to_half_width(text):
+def convert_char_to_half_width(char):
     '''
-    与えらえれた文字列の各文字を半角に変換する。（漢字以外）
+    1文字を半角に変換する。（漢字以外）
+    "¥"への変換 → NFKC正規化 → jaconvで記号、スペース、数字などを半角に変換
     '''
-    converted_text = ""
     # "¥"のみこちらで変換
-    for char in text:
-        if char in ["＼", "\\", "￥"]:
-            char = "¥"
-        # "¥"以外を変換
-        char = unicodedata.normalize("NFKC", char)
-        converted_text += char
+    if char in ["＼", "\\", "￥"]:
+        char = "¥"
+    # "¥"以外を変換
+    char = unicodedata.normalize("NFKC", char)
     # その他の記号、スペース、数字など変換
-    converted_text = jaconv.z2h(converted_text, digit=True, ascii=True, kana=False)
-    
-    return converted_text
+    return jaconv.z2h(char, digit=True, ascii=True, kana=False)
+
+
+class HalfWidthTable(dict):
+    '''
+    str.translate用の、文字コード → 半角変換後の文字列 の変換表。
+    表にない文字は、初めて現れた時にconvert_char_to_half_widthで変換して表に追加する。
+    '''
+    def __missing__(self, code_point):
+        converted_char = convert_char_to_half_width(chr(code_point))
+        self[code_point] = converted_char
+        return converted_char
+
+
+# 全角・半角の区別がある文字を含むブロックは、あらかじめ変換表に入れておく
+PRECOMPUTED_HALF_WIDTH_RANGES = [
+    range(0x0000, 0x0250), # ASCII、ラテン文字
+    range(0x2000, 0x2070), # 一般句読点
+    range(0x2100, 0x2200), # 文字様記号、数字の形
+    range(0x2460, 0x2500), # 囲み英数字
+    range(0x3000, 0x3100), # CJKの記号及び句読点、ひらがな、カタカナ
+    range(0xFF00, 0xFFF0), # 半角・全角形
+]
+HALF_WIDTH_TABLE = HalfWidthTable(
+    (code_point, convert_char_to_half_width(chr(code_point)))
+    for code_point_range in PRECOMPUTED_HALF_WIDTH_RANGES for code_point in code_point_range
+)
+# standardize_message用。 半角変換に加えて改行を削除する
+STANDARDIZE_TABLE = HalfWidthTable(HALF_WIDTH_TABLE)
+STANDARDIZE_TABLE[ord("\n")] = None
+
+
+def convert_to_half_width(text):
+    '''
+    与えらえれた文字列の各文字を半角に変換する。（漢字以外）
+    変換は1文字ごとに行うため、変換表を使ってstr.translateの1回で変換する。
+    '''
+    return text.translate(HALF_WIDTH_TABLE)
 
 
 def standardize_message(text: str):
@@ -256,16 +195,55 @@ def standardize_message(text: str):
     ・改行を削除
     ・各文字を半角に変換（漢字以外）
     '''
-    text = text.replace("\n","") # 改行を削除
-    standardized_message = convert_to_half_width(text) # (おそらく)すべての文字を全角→半角変換
-    
-    return standardized_message
+    return text.translate(STANDARDIZE_TABLE) # 改行の削除と全角→半角変換を1回で行う
 
 
 
+def normalize_query_value(query):
+    '''
+    検索条件1つを比較用に正規化する。(None・空文字は条件なしとして None を返す)
+    '''
+    if query is None:
+        return None
+    normalized_query = " ".join(str(query).split()).casefold()
+    return normalized_query or None
+
+
+# ホットペッパーのマスタを保存したCSV (HotPepperTables/MakeCsvTable.pyで作成)
+HOTPEPPER_TABLES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'HotPepperTables')
+# 場所の検索条件 → 都道府県・中エリアコード。 地名はメッセージと同じく半角変換しておく
+place_resolver = PlaceResolver.load_place_resolver(HOTPEPPER_TABLES_DIRECTORY, normalize=convert_to_half_width)
+
+# ホットペッパーグルメAPIの予算コード。 (予算の上限, コード) を予算の安い順に並べたもの。 (最後は上限なし)
+BUDGET_CODES = [
+    (500, 'B009'), (1000, 'B010'), (1500, 'B011'), (2000, 'B001'), (3000, 'B002'), (4000, 'B003'), (5000, 'B008'),
+    (7000, 'B004'), (10000, 'B005'), (15000, 'B006'), (20000, 'B012'), (30000, 'B013'), (None, 'B014')
+]
+MAX_BUDGET_CODE_QUANTITY = 2 # APIで同時に指定できる予算コードの数
+
+
+def get_budget_codes(price):
+    '''
+    予算の上限(HTML検索のCBT)を、ホットペッパーグルメAPIの予算コードに変換する。
+    上限を含む予算帯と、その1つ下の予算帯のコードを返す。数値でない場合はNone
+    ex) "3000" → "B001,B002" (1501～2000円, 2001～3000円)
+    '''
+    try:
+        price_int = int(price)
+    except (TypeError, ValueError):
+        return None
+
+    for i, (budget_max, _) in enumerate(BUDGET_CODES):
+        if budget_max is None or price_int <= budget_max:
+            break
+
+    budget_codes = [code for _, code in BUDGET_CODES[max(0, i - MAX_BUDGET_CODE_QUANTITY + 1):i + 1]]
+    return ",".join(budget_codes)
+
+
 class UserQuery:
 
-    HOTPEPPER_SEARCH_BASE_URL = "https://www.hotpepper.jp/CSP/psh010/doBasic?"
+    HOTPEPPER_SEARCH_BASE_URL = os.environ.get("HOTPEPPER_URL_DOMAIN", "https://www.hotpepper.jp") + "/CSP/psh010/doBasic?"
     PREFECTURE = "SA=SA11"
 
     def __init__(self, user_query_list):
@@ -297,11 +275,74 @@ class UserQuery:
             "location_and_freeword_query": hotpepper_search_url_location_and_freeword
         }
     
+    def search_cache_key(self) -> tuple:
+        '''
+        検索結果キャッシュのキーとなる、正規化した検索条件を返す。
+        前後の空白・連続する空白・英字の大文字小文字の違いは同じ条件として扱う。
+        '''
+        return tuple(normalize_query_value(query) for query in (self.date, self.place, self.price, self.freeword))
+
+    def can_search_by_gourmet_api(self):
+        '''
+        ホットペッパーグルメAPIで検索できる条件か。 APIには予約日の条件がないため、日付指定がある場合はHTML検索を使う。
+        '''
+        return not self.date
+
+    def gourmet_api_params(self, api_key, count, start=1):
+        '''
+        検索条件を、ホットペッパーグルメAPIのパラメータに変換する。
+        場所はplace_resolverで中エリア・都道府県コードに変換し、表にない場所はキーワードとして検索する。
+
+        Args:
+            api_key (str): APIキー
+            count (int): 取得する店舗数 (最大100)
+            start (int, optional): 何件目から取得するか
+
+        Returns:
+            dict: APIのクエリパラメータ
+        '''
+        params = {
+            'key': api_key,
+            'format': 'json',
+            'count': count,
+            'start': start
+        }
+
+        # 場所が表の地名を含む場合はエリアで絞り、残りをキーワードとして検索する
+        resolved_place = place_resolver.resolve(self.place)
+        if resolved_place and resolved_place.middle_area_code:
+            params['middle_area'] = resolved_place.middle_area_code
+        else:
+            params['service_area'] = self.prefecture_code(resolved_place)
+
+        keywords = []
+        place_keyword = resolved_place.keyword if resolved_place else self.place
+        if place_keyword:
+            keywords.append(place_keyword)
+        if self.freeword:
+            keywords.append(self.freeword)
+        if keywords:
+            params['keyword'] = " ".join(keywords)
+
+        budget_codes = get_budget_codes(self.price)
+        if budget_codes:
+            params['budget'] = budget_codes
+
+        return params
+
+    def prefecture_code(self, resolved_place=None):
+        '''
+        検索する都道府県のコード。場所が都道府県・中エリアの表になければ、東京都(SA11)
+        '''
+        if resolved_place is None:
+            resolved_place = place_resolver.resolve(self.place)
+        return resolved_place.prefecture_code if resolved_place else self.PREFECTURE[len("SA="):]
+
     def hotpepper_search_url(self):
 
         query_url = self.initialize_query_url()
         hotpepper_search_url = self.HOTPEPPER_SEARCH_BASE_URL \
-                                + "&" + self.PREFECTURE \
+                                + "&" + "SA=" + self.prefecture_code() \
                                 + "&" + query_url["date_query"] \
                                 + "&" + query_url["price_query"] \
                                 + "&" + query_url["location_and_freeword_query"]
@@ -3,8 +3,9 @@ import dotenv
 import os
 
 from linebot import (
-    LineBotApi, WebhookHandler
+    AsyncLineBotApi, WebhookParser
 )
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
 from linebot.exceptions import (
     InvalidSignatureError
 )
@@ -13,12 +14,17 @@ from linebot.models import (
     JoinEvent
 )
 
-import re # 文字列
 import datetime # 登録日など日付
 
+# 非同期処理（イベントループを止めないための並行処理）
+import asyncio
+import contextlib
+import contextvars
+import aiohttp
+
 ### Hotpepperでのウェブスクレイピング用
-import requests
-from bs4 import BeautifulSoup
+from HotPepper import HtmlExtractor # 必要な要素だけを解析する高速な抽出
+from HotPepper import OutboundClient # 流量制限・再試行・サーキットブレーカー付きの通信
 
 # カルーセルURIでのエスケープ用
 import urllib.parse
@@ -27,12 +33,49 @@ import urllib.parse
 import sqlite3
 from Database import sqlite as db
 
+# 検索条件の解析
+from SearchQuery import SearchQuery
+
+# 検索結果のキャッシュ
+from Cache.LruTtlCache import LruTtlCache
+from Cache.SingleFlight import SingleFlight
+
+# 1イベントの処理時間の予算
+from Deadline import EventDeadline
+
 dotenv.load_dotenv(verbose=True)
-line_bot_api = LineBotApi(os.environ["LINE_BOT_CHANNEL_ACCESS_TOKEN"])
-handler = WebhookHandler(os.environ["LINE_BOT_CHANNEL_SECRET"])
+LINE_BOT_CHANNEL_ACCESS_TOKEN = os.environ["LINE_BOT_CHANNEL_ACCESS_TOKEN"]
+parser = WebhookParser(os.environ["LINE_BOT_CHANNEL_SECRET"])
 SEARCH_FORM_LIFF = os.environ['SEARCH_FORM_LIFF']
 SHARE_LIFF_BASE_URI = os.environ["SHARE_LIFF_BASE_URI"]
 HOTPEPPRE_API_KEY = os.environ["HOTPEPPRE_API_KEY"]
+# 外部APIの接続先（負荷試験ではLoadTest/StandInServer.pyの代替サーバーに向ける）
+HOTPEPPER_API_BASE_URL = os.environ.get("HOTPEPPER_API_BASE_URL", "http://webservice.recruit.co.jp/hotpepper/gourmet/v1/")
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+# 1の場合、スクレイピング用のモジュール(bs4・lxml)の読み込みを待たずにリクエストを受け付け、バックグラウンドで読み込む
+# 0の場合、読み込みが終わってからリクエストを受け付ける（最初のリクエストが読み込みを待たない）
+FAST_BOOT = os.environ.get("FAST_BOOT", "1") == "1"
+
+# 外部通信の接続プールの設定。 接続は全ての取得処理とLINE APIクライアントで使い回す
+HTTP_CONNECTION_LIMIT = int(os.environ.get("HTTP_CONNECTION_LIMIT", 100)) # 同時に開く接続数の上限 (全ホストの合計)
+HTTP_CONNECTION_LIMIT_PER_HOST = int(os.environ.get("HTTP_CONNECTION_LIMIT_PER_HOST", 30)) # ホストごとの同時に開く接続数の上限
+HTTP_KEEPALIVE_TIMEOUT_SECONDS = 30 # 使い終わった接続を開いておく秒数
+HTTP_DNS_CACHE_TTL_SECONDS = 300 # 名前解決の結果を使い回す秒数
+
+# ホットペッパー(hotpepper.jp・グルメAPI)への通信の設定。 流量制限はホストごと
+OUTBOUND_RATE_PER_SECOND = float(os.environ.get("OUTBOUND_RATE_PER_SECOND", 20)) # 1秒あたりのリクエスト数の上限 (0以下で制限なし)
+OUTBOUND_BURST = 40 # 一時的に超えてよいリクエスト数
+OUTBOUND_TIMEOUT_SECONDS = 5 # 1回のリクエストのタイムアウト
+OUTBOUND_MAX_RETRIES = 2 # 429/5xx/タイムアウト時の再試行回数
+OUTBOUND_BACKOFF_BASE_SECONDS = 0.2 # 再試行までの待ち時間の基準 (ジッター付きの指数バックオフ)
+OUTBOUND_FAILURE_THRESHOLD = 5 # サーキットブレーカーが開く連続失敗回数
+OUTBOUND_RESET_TIMEOUT_SECONDS = 30 # サーキットブレーカーが開いてから、再び試すまでの秒数
+UPSTREAM_UNAVAILABLE_MESSAGE = "ただいまホットペッパーに接続できません。しばらくしてから、もう一度お試しください。"
+
+# 外部通信用のセッションとLINE APIクライアント（イベントループ上で作成するため、起動時に設定）
+http_session: aiohttp.ClientSession = None
+hotpepper_client: OutboundClient.OutboundClient = None
+line_bot_api: AsyncLineBotApi = None
 
 ##################################
 import json
@@ -42,7 +85,41 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from starlette.exceptions import HTTPException
 
-app = FastAPI(debug=True)
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """起動時に外部通信用のセッションを作成し、終了時に閉じる。
+    """
+    global http_session, hotpepper_client, line_bot_api
+
+    http_session = OutboundClient.create_http_session(
+        HTTP_CONNECTION_LIMIT, HTTP_CONNECTION_LIMIT_PER_HOST, HTTP_KEEPALIVE_TIMEOUT_SECONDS, HTTP_DNS_CACHE_TTL_SECONDS,
+    )
+    hotpepper_client = OutboundClient.OutboundClient(
+        http_session, OUTBOUND_RATE_PER_SECOND, OUTBOUND_BURST, OUTBOUND_TIMEOUT_SECONDS, OUTBOUND_MAX_RETRIES,
+        OUTBOUND_BACKOFF_BASE_SECONDS, OUTBOUND_FAILURE_THRESHOLD, OUTBOUND_RESET_TIMEOUT_SECONDS,
+    )
+    line_bot_api = AsyncLineBotApi(LINE_BOT_CHANNEL_ACCESS_TOKEN, AiohttpAsyncHttpClient(http_session), endpoint=LINE_API_ENDPOINT)
+
+    # スクレイピング用のモジュールは使う直前まで読み込まないため、起動後に読み込んでおく
+    if FAST_BOOT:
+        run_in_background(asyncio.to_thread(HtmlExtractor.preload))
+    else:
+        HtmlExtractor.preload()
+
+    yield
+
+    # 先読み・更新中のタスクがセッションを使い終わるまで少し待ち、終わらないものは取り消してから閉じる
+    if background_tasks:
+        _, pending_tasks = await asyncio.wait(set(background_tasks), timeout=BACKGROUND_TASK_SHUTDOWN_TIMEOUT_SECONDS)
+        for pending_task in pending_tasks:
+            pending_task.cancel()
+        await asyncio.gather(*pending_tasks, return_exceptions=True)
+
+    await http_session.close()
+    db.close_all_connections()
+
+
+app = FastAPI(debug=True, lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -52,7 +129,7 @@ app.add_middleware(
 )
 
 # DBの初期設定
-DATABASE_PATH = 'Database/sqlite_database.db' # DBのパス
+DATABASE_PATH = os.environ.get("DATABASE_PATH", 'Database/sqlite_database.db') # DBのパス
 db.setup_database(DATABASE_PATH)
 
 # 検索対象の記号を設定[記号,False:スペースを削除,True:スペースを文字列に含む]
@@ -60,6 +137,48 @@ QUERY_MARKS = [["/", False], ["+", False], ["¥", False], ["=", True]]
 
 MAX_DISPLAY_SHOP_QUANTITY = 5 # 1回に提案する店舗数の上限
 MAX_HIT_PAGE_STOCK_QUANTITY = 3 # 検索結果のうち、ユーザーが保持できるページ数
+MAX_CONCURRENT_PAGE_FETCH_QUANTITY = 3 # 検索結果ページを同時に取得する数の上限
+MAX_CONCURRENT_SHOP_FETCH_QUANTITY = 5 # 店舗情報を同時に取得する数の上限
+PREFETCH_SHOP_QUANTITY = MAX_DISPLAY_SHOP_QUANTITY # 紹介後にバックグラウンドで先読みする店舗数 (次の5件の分)
+
+SEARCH_RESULT_CACHE_MAX_SIZE = 256 # 検索結果キャッシュに保持する検索条件数の上限
+SEARCH_RESULT_CACHE_TTL_SECONDS = 15 * 60 # 検索結果キャッシュの有効期限(秒)
+# 検索条件(正規化済み) → ヒットしたshop_idのタプル。 同じ条件の検索はユーザーをまたいで使い回す
+search_result_cache = LruTtlCache(SEARCH_RESULT_CACHE_MAX_SIZE, SEARCH_RESULT_CACHE_TTL_SECONDS)
+
+SEARCH_PAGE_SHOP_QUANTITY = 20 # 検索結果ページ1ページに掲載される店舗数
+GOURMET_API_SEARCH_COUNT = MAX_HIT_PAGE_STOCK_QUANTITY * SEARCH_PAGE_SHOP_QUANTITY # ホットペッパーグルメAPIの1回の検索で取得する店舗数 (HTML検索の保持ページ分。最大100)
+SHOP_DETAIL_CACHE_MAX_SIZE = 2048 # 店舗情報キャッシュに保持する店舗数の上限
+GOURMET_API_MAX_ID_QUANTITY = 20 # ホットペッパーグルメAPIの1回の呼び出しで指定できるshop_idの上限
+# shop_id → ホットペッパーグルメAPIの店舗情報。 APIで検索した店舗は、紹介時に店舗情報を取り直さない
+shop_detail_cache = LruTtlCache(SHOP_DETAIL_CACHE_MAX_SIZE, SEARCH_RESULT_CACHE_TTL_SECONDS)
+# 一覧の評価キャッシュに保持する店舗数の上限。 検索結果キャッシュにある全ての検索の店舗分を保持し、
+# キャッシュした検索結果を使う時に一覧の評価が先に追い出されていないようにする
+LISTING_REVIEW_CACHE_MAX_SIZE = SEARCH_RESULT_CACHE_MAX_SIZE * MAX_HIT_PAGE_STOCK_QUANTITY * SEARCH_PAGE_SHOP_QUANTITY
+# shop_id → 検索結果ページの一覧に表示された (review_score, review_quantity)。 評価の表示がない店舗は (None, None) で、評価は不明として扱う
+# Searchレコードに保存し、紹介時に店舗ページをスクレイピングしない
+listing_review_cache = LruTtlCache(LISTING_REVIEW_CACHE_MAX_SIZE, SEARCH_RESULT_CACHE_TTL_SECONDS)
+
+# リプライトークンの期限内に返信するための、1イベントの処理時間の予算(秒)。 残りが少なくなると処理を省く(縮退)
+REPLY_DEADLINE_SECONDS = float(os.environ.get("REPLY_DEADLINE_SECONDS", 10))
+REPLY_RESERVE_SECONDS = 1.5 # カルーセルの作成と返信のために残しておく秒数
+SEARCH_FIRST_PAGE_BUDGET_SECONDS = 4.5 # 検索結果の1ページ目のみで検索し、新規店舗の情報を取得するために残しておく秒数
+# 全ページの検索はこの秒数を残すところまで待ち、終わらなければ1ページ目のみ使う
+SEARCH_CRAWL_MIN_REMAINING_SECONDS = REPLY_RESERVE_SECONDS + SEARCH_FIRST_PAGE_BUDGET_SECONDS
+SHOP_REVIEW_MIN_REMAINING_SECONDS = 4 # 残りがこれ未満なら、新規店舗のレビューをスクレイピングしない
+
+# 同時に来た同じ処理を1回の実行にまとめる（グループで同じ条件を同時に送った場合や、検索間で店舗が重なる場合）
+search_flight = SingleFlight() # 検索条件(正規化済み) → 実行中の検索
+search_page_flight = SingleFlight() # 検索結果ページURL → 実行中のページ取得
+shop_flight = SingleFlight() # shop_id → 実行中の店舗情報の取得
+loading_shop_details = {} # shop_id → グルメAPIで複数店舗の情報をまとめて取得中のタスク
+
+# Shopレコードの有効期限。 これより古いレコードはそのまま返しつつ、バックグラウンドで更新する
+SHOP_RECORD_TTL = datetime.timedelta(days=int(os.environ.get("SHOP_RECORD_TTL_DAYS", 7)))
+
+background_tasks = set() # 実行中のバックグラウンドタスク（完了前にGCされないよう参照を保持）
+BACKGROUND_TASK_SHUTDOWN_TIMEOUT_SECONDS = 5 # 終了時に、実行中のバックグラウンドタスクの完了を待つ秒数
+refreshing_shop_ids = set() # バックグラウンドで取得・更新中のshop_id（同じ店舗の取得を重複させない）
 
 ##################################
 
@@ -110,18 +229,36 @@ async def callback(request: Request, x_line_signature=Header(None)):
     body = await request.body()
 
     try:
-        handler.handle(body.decode("utf-8"), x_line_signature)
+        events = parser.parse(body.decode("utf-8"), x_line_signature)
 
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="InvalidSignatureError")
 
+    # テキストメッセージのイベントを並行して処理（イベントループは止めない）
+    await asyncio.gather(*[
+        handle_text_message_event(event) for event in events
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+    ])
+
     return "OK"
 
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
+async def handle_text_message_event(event):
+    '''
+    1イベントを処理する。処理中のDB操作は全て同じ接続で行う。
+    処理時間の予算を設定し、時間が足りずに省いた処理(縮退)をイベントごとに記録する。
+    '''
+    with db.request_connection(DATABASE_PATH), EventDeadline.event_deadline(REPLY_DEADLINE_SECONDS) as deadline:
+        try:
+            await handle_message(event)
+        finally:
+            print(f"event_deadline: elapsed {deadline.elapsed():.2f}s / {deadline.budget_seconds}s degradations:{deadline.degradations}")
+
+
+async def handle_message(event):
     '''
     メッセージに反応する。実質main関数
+    HTTP通信は非同期で、DB操作とHTML解析は別スレッドで行い、イベントループを止めない。
     '''
     # ユーザーidを取得
     user_id = get_user_id_from_event(event)
@@ -132,15 +269,20 @@ def handle_message(event):
 
     # 次の5件を表示する場合
     if standardized_message == "次の5件":
-        if not db.has_search_record(DATABASE_PATH, user_id):
+        if not await asyncio.to_thread(db.has_search_record, DATABASE_PATH, user_id):
             # 店舗検索がヒットしなかった際のフィードバックメッセージ作成
-            cannot_introduce_message = create_has_no_more_shop_message(db.get_query_record(DATABASE_PATH, user_id))
+            # まだ検索したことがない(Queryレコードがない)ユーザーの場合は、空の検索条件で伝える
+            query_record = QueryRecord()
+            query_record_as_list = await asyncio.to_thread(db.fetch_query_record_as_list, DATABASE_PATH, user_id)
+            if query_record_as_list is not None:
+                query_record.set_attributes(query_record_as_list)
+            cannot_introduce_message = create_has_no_more_shop_message(query_record)
             # ユーザーにメッセージ送信
-            line_bot_api.reply_message(event.reply_token, cannot_introduce_message)
+            await line_bot_api.reply_message(event.reply_token, cannot_introduce_message)
             return
         
         # ユーザーに店舗を紹介（DBより店舗選出、店舗情報upsert、カルーセルメッセージ作成&送信）
-        introduce_shops_by_user_id(event, DATABASE_PATH, user_id)
+        await introduce_shops_by_user_id(event, DATABASE_PATH, user_id)
         return
     
     # お気に入り店舗を表示する場合
@@ -152,57 +294,271 @@ def handle_message(event):
     if not SearchQuery.has_query_marks(standardized_message, QUERY_MARKS):
         return
 
-    # 新規ユーザーの場合、初期Queryレコードを設定
-    if db.is_new_user(DATABASE_PATH, user_id):
-        db.add_user_record(DATABASE_PATH, user_id) # ユーザーUserテーブルに登録
-        db.add_empty_query_record(DATABASE_PATH, user_id) # 条件NULLのみのQueryレコードを作成。
-
     # 検索条件の更新
     input_queries = SearchQuery.split_to_each_query_texts(standardized_message, QUERY_MARKS) # 検索条件をリストで作成　修正　SearchQueryクラスのメソッドにしたい。
     input_queries[0] = input_queries[0].replace("-","") # yyyy-mm-dd を yyyymmdd に変更
     print(f'input_queries:{input_queries}')
-    db.update_query(DATABASE_PATH, user_id, input_queries) # Queryレコードを更新
-
-    # 検索条件からホットペッパー検索URLを生成
-    queries = db.get_user_queries(DATABASE_PATH, user_id) # ユーザーの検索条件を取得
+    queries = await asyncio.to_thread(update_user_queries, DATABASE_PATH, user_id, input_queries) # 更新後の検索条件を取得
     print(f'queries: {queries[1]}  ')
     print(f'queries: {queries[2]}  ')
     print(f'queries: {queries[3]}  ')
     print(f'queries: {queries[4]}  ')
 
+    # 検索条件からホットペッパー検索でヒットしたshop_idsを取得
     user_query = SearchQuery.UserQuery(queries) # 検索条件情報を持つインスタンスを作成
-    original_search_url = user_query.hotpepper_search_url() # 検索URLを生成
-
-    # 検索URLをもとに、複数のヒット店舗一覧ページURLのリストを取得
-    original_search_url_response = requests.get(original_search_url)
-    original_search_url_soup = BeautifulSoup(original_search_url_response.text, 'html.parser')
-    search_result_urls = get_search_result_urls(original_search_url, original_search_url_soup, MAX_HIT_PAGE_STOCK_QUANTITY)
+    try:
+        search_hit_shop_ids = await get_search_hit_shop_ids(user_query)
+    except OutboundClient.UpstreamError as e:
+        # ホットペッパーが応答しない場合はすぐに知らせる（以前の検索結果は残すため、「次の5件」は使える）
+        print(f"error: get_search_hit_shop_ids : {e!r}")
+        await line_bot_api.reply_message(event.reply_token, TextSendMessage(text=UPSTREAM_UNAVAILABLE_MESSAGE))
+        return
 
     ## 一件も店がヒットしなかった時 # 「店舗としてはヒットするが、情報が入っていない」店が除去できていない(要修正)
-    if search_result_urls == None:
+    if search_hit_shop_ids == None:
         # 店舗検索がヒットしなかった際のフィードバックメッセージ作成
         query_record = QueryRecord()
-        query_record_as_list = db.fetch_query_record_as_list(DATABASE_PATH, user_id)
+        query_record_as_list = await asyncio.to_thread(db.fetch_query_record_as_list, DATABASE_PATH, user_id)
         query_record.set_attributes(query_record_as_list)
         cannot_introduce_message = create_shop_not_hit_carousel_column(query_record)
     
         # ユーザーにメッセージ送信
-        line_bot_api.reply_message(event.reply_token, cannot_introduce_message)
+        await line_bot_api.reply_message(event.reply_token, cannot_introduce_message)
         return
         
     ## 1店舗以上ヒットした時 
-    # 紹介候補となる shop_ids をurlから取得　（修正）それをSearchレコードとして追加。
-    search_hit_shop_ids = get_shop_ids_by_search_urls(search_result_urls)
     # Searchレコードの更新
-    db.delete_all_search_records(DATABASE_PATH, user_id) # 以前のSearchレコードを全削除。
-    db.add_search_records(DATABASE_PATH, user_id, search_hit_shop_ids)
+    await asyncio.to_thread(replace_search_records, DATABASE_PATH, user_id, search_hit_shop_ids)
 
     # ユーザーに店舗を紹介（DBより店舗選出、店舗情報upsert、カルーセルメッセージ作成&送信、送信済みDB更新）
-    introduce_shops_by_user_id(event, DATABASE_PATH, user_id)
+    await introduce_shops_by_user_id(event, DATABASE_PATH, user_id)
 
     return
 
 
+def update_user_queries(DATABASE_PATH: str, user_id: str, input_queries: list) -> list:
+    """新規ユーザーの登録と検索条件の更新を行い、更新後の検索条件を返す。
+    DB操作のみを行うため、asyncio.to_threadで別スレッドから呼び出す。
+
+    Args:
+        DATABASE_PATH (str): DBのファイルパス
+        user_id (str): user_id
+        input_queries (list): 新規に入力された検索条件 ['(clear)', '新橋', '', '海鮮 個室']
+
+    Returns:
+        list: 更新後の検索条件 ['user1', '20240101', '新橋', None, '海鮮 個室']
+    """
+    # 1トランザクションで更新する。読み込んだ結果で書き込むため、開始時に書き込みロックを取る
+    # (BEGINのままだと、他の接続の書き込みと重なった時に待たずに database is locked になる)
+    with db.transaction(DATABASE_PATH, immediate=True):
+        # 新規ユーザーの場合、初期Queryレコードを設定
+        if db.is_new_user(DATABASE_PATH, user_id):
+            db.add_user_record(DATABASE_PATH, user_id) # ユーザーUserテーブルに登録
+            db.add_empty_query_record(DATABASE_PATH, user_id) # 条件NULLのみのQueryレコードを作成。
+
+        db.update_query(DATABASE_PATH, user_id, input_queries) # Queryレコードを更新
+
+        return db.get_user_queries(DATABASE_PATH, user_id) # ユーザーの検索条件を取得
+
+
+def replace_search_records(DATABASE_PATH: str, user_id: str, shop_ids: list) -> None:
+    """ユーザーのSearchレコードを、新しい検索結果のshop_idリストで置き換える。
+    評価のわかっている店舗のうち、レビューのある店舗から紹介されるよう並べ替えて登録する。
+    DB操作のみを行うため、asyncio.to_threadで別スレッドから呼び出す。
+
+    Args:
+        DATABASE_PATH (str): DBのファイルパス
+        user_id (str): user_id
+        shop_ids (list[str]): 検索でヒットしたshop_idリスト
+    """
+    # 検索結果ページの一覧で評価がわかった店舗は、その評価もSearchレコードに保存する
+    listing_reviews = {}
+    for shop_id in shop_ids:
+        listing_review = listing_review_cache.get(shop_id)
+        if listing_review is not None and listing_review[1] is not None: # (None, None) は評価が不明のため保存しない
+            listing_reviews[shop_id] = listing_review
+
+    # 評価のある店舗から紹介するよう並べ替える（わかっている評価のみで並べ、スクレイピングはしない）
+    shop_ids = sort_shop_ids_by_rated(DATABASE_PATH, shop_ids)
+
+    # 削除と追加を1トランザクションで行う（途中の状態を他のリクエストから見せない）
+    with db.transaction(DATABASE_PATH):
+        db.delete_all_search_records(DATABASE_PATH, user_id) # 以前のSearchレコードを全削除。
+        db.add_search_records(DATABASE_PATH, user_id, shop_ids, listing_reviews)
+
+
+async def get_search_hit_shop_ids(user_query) -> list:
+    """検索条件でホットペッパー検索を行い、ヒットしたshop_idリストを返す。
+    同じ検索条件の結果はsearch_result_cacheから返し、外部への通信を行わない。
+    同じ検索条件の検索が実行中の場合は、その結果を待って使う。
+    返信の期限までに検索が終わらない場合は、検索結果の1ページ目の店舗のみ返す(first_search_page_only)。
+
+    Args:
+        user_query (SearchQuery.UserQuery): ユーザーの検索条件
+
+    Returns:
+        list[str]: ヒットしたshop_idリスト（検索結果順）。 1つもヒットしない場合はNoneを返す。
+    """
+    # 同じ検索条件の結果がキャッシュにあればそれを使う
+    search_cache_key = user_query.search_cache_key()
+    cached_shop_ids = search_result_cache.get(search_cache_key)
+    if cached_shop_ids is not None:
+        return list(cached_shop_ids)
+
+    # 検索はどのイベントの期限にも縛られずに行い、このイベントでは1ページ目のみで検索できる時間を残すところまで待つ
+    deadline = EventDeadline.current_deadline()
+    flight_timeout = None if deadline is None else deadline.timeout(SEARCH_CRAWL_MIN_REMAINING_SECONDS)
+    try:
+        search_hit_shop_ids = await search_flight.do(search_cache_key, search_and_cache_shop_ids, user_query, timeout=flight_timeout)
+    except asyncio.TimeoutError:
+        # 検索はバックグラウンドで続けてキャッシュし、このイベントは検索結果の1ページ目の店舗のみ使う
+        deadline.degrade('first_search_page_only')
+        return await get_shop_ids_by_search_html(user_query, first_search_page_only=True)
+
+    # 呼び出し元ごとに書き換えられるよう、共有した結果をコピーして返す
+    return list(search_hit_shop_ids) if search_hit_shop_ids is not None else None
+
+
+async def search_and_cache_shop_ids(user_query) -> list:
+    """検索条件でホットペッパー検索を行い、結果をsearch_result_cacheに保存して返す。
+
+    Args:
+        user_query (SearchQuery.UserQuery): ユーザーの検索条件
+
+    Returns:
+        list[str]: ヒットしたshop_idリスト（検索結果順）。 1つもヒットしない場合はNoneを返す。
+    """
+    # 日付指定がなければホットペッパーグルメAPIで、あればHTMLの検索結果ページから検索する
+    if user_query.can_search_by_gourmet_api():
+        search_hit_shop_ids = await get_shop_ids_by_gourmet_api(user_query)
+    else:
+        search_hit_shop_ids = await get_shop_ids_by_search_html(user_query)
+
+    # 一件も店がヒットしなかった時
+    if search_hit_shop_ids == None:
+        return None
+
+    # 他のユーザーも使えるようにキャッシュ（書き換えられないようタプルで保存）
+    search_result_cache.set(user_query.search_cache_key(), tuple(search_hit_shop_ids))
+
+    return search_hit_shop_ids
+
+
+async def get_shop_ids_by_gourmet_api(user_query) -> list:
+    """ホットペッパーグルメAPIで検索し、ヒットしたshop_idリストを返す。
+    レスポンスに含まれる店舗情報はshop_detail_cacheに保存し、紹介時のAPI呼び出しを省く。
+    APIがエラーを返した場合や応答しない場合は、HTML検索で代替する。
+
+    Args:
+        user_query (SearchQuery.UserQuery): ユーザーの検索条件
+
+    Returns:
+        list[str]: ヒットしたshop_idリスト（検索結果順）。 1つもヒットしない場合はNoneを返す。
+    """
+    params = user_query.gourmet_api_params(HOTPEPPRE_API_KEY, GOURMET_API_SEARCH_COUNT)
+    try:
+        shops = await fetch_gourmet_api_shops(params)
+    except OutboundClient.UpstreamError as e:
+        # HTML検索でも応答がなければ、UpstreamErrorとして呼び出し元に伝える
+        print(f"gourmet api unavailable: {e!r} : get_shop_ids_by_gourmet_api")
+        return await get_shop_ids_by_search_html(user_query)
+
+    if not shops: # 1店舗もヒットしなかった場合
+        return None
+
+    for shop in shops:
+        shop_detail_cache.set(shop['id'], shop)
+
+    return [shop['id'] for shop in shops]
+
+
+async def fetch_gourmet_api_shops(params: dict) -> list:
+    """ホットペッパーグルメAPIを呼び出し、レスポンスの店舗情報のリストを返す。
+
+    Args:
+        params (dict): APIのパラメータ
+
+    Returns:
+        list[dict]: 店舗情報のリスト。 1店舗もない場合は空のリスト
+
+    Raises:
+        OutboundClient.UpstreamError: 応答がない場合と、APIがエラーや想定外の形式のレスポンスを返した場合
+    """
+    datum = await fetch_json(HOTPEPPER_API_BASE_URL, params)
+
+    results = datum.get('results') if isinstance(datum, dict) else None
+    if not isinstance(results, dict):
+        raise OutboundClient.UpstreamError('gourmet api: no results in response')
+    if 'error' in results:
+        raise OutboundClient.UpstreamError(f"gourmet api error: {results['error']}")
+    shops = results.get('shop')
+    if not isinstance(shops, list):
+        raise OutboundClient.UpstreamError('gourmet api: no shop list in results')
+
+    return shops
+
+
+async def get_shop_ids_by_search_html(user_query, first_search_page_only: bool = False) -> list:
+    """ホットペッパーの検索結果ページ(HTML)から、ヒットしたshop_idリストを返す。
+
+    Args:
+        user_query (SearchQuery.UserQuery): ユーザーの検索条件
+        first_search_page_only (bool, optional): Trueの場合、他のページを取得せず1ページ目の店舗のみ返す（返信の期限が近い場合）
+
+    Returns:
+        list[str]: ヒットしたshop_idリスト（検索結果順）。 1つもヒットしない場合はNoneを返す。
+    """
+    original_search_url = user_query.hotpepper_search_url() # 検索URLを生成
+
+    # 検索URLをもとに、複数のヒット店舗一覧ページURLのリストを取得
+    original_search_url_html = await fetch_text(original_search_url)
+
+    # 他のページを取得せず1ページ目の店舗のみ使う
+    if first_search_page_only:
+        return await asyncio.to_thread(extract_and_cache_shop_listings, original_search_url_html) # 1つもヒットしない場合はNone
+
+    search_result_urls = await asyncio.to_thread(get_search_result_urls, original_search_url, original_search_url_html, MAX_HIT_PAGE_STOCK_QUANTITY) # HTMLの解析は別スレッドで行う
+
+    # 一件も店がヒットしなかった時
+    if search_result_urls == None:
+        return None
+
+    # 紹介候補となる shop_ids をurlから取得
+    return await get_shop_ids_by_search_urls(search_result_urls)
+
+
+async def fetch_text(url: str, params: dict = None) -> str:
+    """ホットペッパーへGETリクエストを送り、レスポンス本文を返す。（流量制限・タイムアウト・再試行あり）
+
+    Args:
+        url (str): リクエスト先URL
+        params (dict, optional): クエリパラメータ
+
+    Returns:
+        str: レスポンス本文
+
+    Raises:
+        OutboundClient.UpstreamError: 再試行しても応答が得られない場合、サーキットブレーカーが開いている場合
+    """
+    return await hotpepper_client.get_text(url, params)
+
+
+async def fetch_json(url: str, params: dict = None) -> Any:
+    """ホットペッパーへGETリクエストを送り、レスポンスをjsonとして返す。（流量制限・タイムアウト・再試行あり）
+
+    Args:
+        url (str): リクエスト先URL
+        params (dict, optional): クエリパラメータ
+
+    Returns:
+        Any: jsonを変換したオブジェクト
+
+    Raises:
+        OutboundClient.UpstreamError: 再試行しても応答が得られない場合、サーキットブレーカーが開いている場合
+    """
+    return await hotpepper_client.get_json(url, params)
+
+
 class QueryMarks:
     def __init__(self):
         self._date = DateMark()
@@ -285,6 +641,7 @@ class ShopRecord:
         self.affiliate_url = None
         self.review_score = None
         self.review_quantity = None
+        self.update_date = None
     
     def set_attributes(self, shop_record_as_list: list):
         """リスト型で取得したshop_recordをプロパティとして設定
@@ -299,6 +656,7 @@ class ShopRecord:
         self.affiliate_url = shop_record_as_list[4]
         self.review_score = shop_record_as_list[5]
         self.review_quantity = shop_record_as_list[6]
+        self.update_date = shop_record_as_list[7] if len(shop_record_as_list) > 7 else None
 
 
     def to_json(self):
@@ -325,6 +683,7 @@ class ShopRecord:
         self.affiliate_url = shop_detail.affiliate_url
         self.review_score = shop_detail.review_score
         self.review_quantity = shop_detail.review_quantity
+        self.update_date = shop_detail.update_date.isoformat() if shop_detail.update_date else None # DBに保存するため文字列にする
 
 
 class ShopDetail:
@@ -333,46 +692,141 @@ class ShopDetail:
 
     def __init__(self, shop_id):
         self.shop_id = shop_id
-        self.set_shop_record_info_by_hotpepper_api()
 
 
-    def set_shop_record_info_by_hotpepper_api(self):        
+    async def set_shop_record_info_by_hotpepper_api(self, with_review: bool = True, listing_review: tuple = None):
         '''
         DBに登録する情報を設定する。（shop_idのみインスタンス時に設定済み。）
+        検索結果ページの一覧の評価(listing_review)がある場合は、それを使い店舗ページをスクレイピングしない。
+        with_review=Falseの場合はレビューをスクレイピングせず、更新日時をNoneにする（次に参照された時に更新される）。
         '''
-        # ショップの全情報をプロパティに格納(HotpepperAPIによる)
-        self.set_shop_detail_by_hotpepper_api() 
+        if listing_review is not None:
+            await self.set_shop_detail_by_hotpepper_api()
+            self.review_score, self.review_quantity = listing_review
+            with_review = True
+        elif not with_review:
+            await self.set_shop_detail_by_hotpepper_api()
+            self.review_score, self.review_quantity = None, None
+        else:
+            # ショップの全情報(HotpepperAPIによる)と、レビュー(APIで取れないのでスクレイピング)を並行して取得
+            shop_detail_result, shop_review_result = await asyncio.gather(
+                self.set_shop_detail_by_hotpepper_api(),
+                get_shop_review(self.shop_id),
+                return_exceptions=True
+            )
+            if isinstance(shop_detail_result, BaseException):
+                raise shop_detail_result
+            # hotpepper.jpが応答しない場合は、レビューなしで登録する（更新日時なしにして、後で更新する）
+            if isinstance(shop_review_result, OutboundClient.UpstreamError):
+                print(f"error: get_shop_review : {self.shop_id} : {shop_review_result!r}")
+                shop_review_result, with_review = (None, None, None), False
+            elif isinstance(shop_review_result, BaseException):
+                raise shop_review_result
+            self.review_score, _, self.review_quantity = shop_review_result
         
         # カルーセルに必要な情報や更新日時などをプロパティに設定
         self.name = trim_text(self.shop_detail['name'])
         self.img_url = self.shop_detail['photo']['pc']['l']
         self.access = self.shop_detail['mobile_access']
         self.affiliate_url = get_affiliate_url(self.shop_id)
-        self.review_score, _, self.review_quantity = get_shop_review(self.shop_id) # レビューのみAPIで取れないのでスクレイピング
         
-        self.update_date = datetime.datetime.now(datetime.timezone.utc) # 現在を更新日時に設定（一応タイムゾーンあり）
+        # 現在を更新日時に設定（一応タイムゾーンあり）。 レビューを取得していない場合は、古いレコードとして扱う
+        self.update_date = datetime.datetime.now(datetime.timezone.utc) if with_review else None
 
 
-    def set_shop_detail_by_hotpepper_api(self):
+    async def set_shop_detail_by_hotpepper_api(self):
         '''
         ショップの全情報をプロパティに格納(HotpepperAPIによる)
+        APIでの検索時に取得済みの場合は、キャッシュしたものを使う。
+        まとめて取得中の場合は、その結果を使う。
         '''
-        # APIを使うための初期設定。
-        HOTPEPPER_API_BASE_URL = 'http://webservice.recruit.co.jp/hotpepper/gourmet/v1/'
+        cached_shop_detail = shop_detail_cache.get(self.shop_id)
+        if cached_shop_detail is not None:
+            self.shop_detail = cached_shop_detail
+            return
 
-        # 検索内容の定義。
+        shop_details, missing_shop_ids = None, None
+        loading_task = loading_shop_details.get(self.shop_id)
+        if loading_task is not None:
+            try:
+                shop_details, missing_shop_ids = await asyncio.shield(loading_task)
+            except (OutboundClient.UpstreamError, KeyError) as e:
+                print(f"error: load_shop_details : {e!r}") # この店舗のみで取得し直す
+
+        if shop_details is None:
+            shop_details, missing_shop_ids = await load_shop_details([self.shop_id])
+
+        if self.shop_id in missing_shop_ids:
+            raise LookupError(f"shop not found by gourmet api: {self.shop_id}")
+        self.shop_detail = shop_details[self.shop_id]
+
+
+def start_loading_shop_details(shop_ids: list) -> None:
+    """load_shop_detailsをタスクとして開始し、完了まで loading_shop_details に登録する。
+    店舗ごとの取得(ShopDetail.set_shop_detail_by_hotpepper_api)は、登録されたタスクの結果を使う。
+
+    Args:
+        shop_ids (list[str]): まとめて取得するshop_idリスト
+    """
+    if not shop_ids:
+        return
+
+    # 複数のshop_flightで共有するため、shop_flightの処理と同じく空のコンテキストで実行する
+    loading_task = contextvars.Context().run(asyncio.create_task, load_shop_details(shop_ids))
+    for shop_id in shop_ids:
+        loading_shop_details[shop_id] = loading_task
+
+    def discard(done_task: asyncio.Task) -> None:
+        for shop_id in shop_ids:
+            if loading_shop_details.get(shop_id) is done_task:
+                del loading_shop_details[shop_id]
+        if not done_task.cancelled():
+            done_task.exception() # 待つ店舗がなくなった場合に、未取得の例外として警告されないようにする
+
+    loading_task.add_done_callback(discard)
+
+
+async def load_shop_details(shop_ids: list) -> tuple:
+    """ホットペッパーグルメAPIで、複数の店舗情報をまとめて取得する。
+    1回の呼び出しでGOURMET_API_MAX_ID_QUANTITY店舗までをカンマ区切りのidで指定し、結果をshop_idで対応づける。
+    取得した店舗情報はshop_detail_cacheに保存する。
+
+    Args:
+        shop_ids (list[str]): shop_idリスト
+
+    Returns:
+        dict: shop_id → 店舗情報
+        list[str]: APIが店舗情報を返さなかったshop_idリスト
+                   (J000132150のように、なぜか取れない店舗がある。 {'results': {..., 'results_available': 0, 'shop': []}})
+    """
+    shop_details = {}
+    missing_shop_ids = []
+
+    async def load_chunk(chunk_shop_ids: list) -> None:
         params = {
             'key': HOTPEPPRE_API_KEY,
-            'id': self.shop_id,
+            'id': ','.join(chunk_shop_ids),
             'format': 'json',
-            'count': 1
+            'count': len(chunk_shop_ids)
         }
-        # 店舗情報取得(公式テンプレ)
-        response = requests.get(HOTPEPPER_API_BASE_URL, params)
-        datum = response.json()
-        # J000132150のように、なぜか取れない奴がいる。 {'results': {'api_version': '1.30', 'results_available': 0, 'results_returned': '0', 'results_start': 0, 'shop': []}}
-        
-        self.shop_detail = datum['results']['shop'][0]
+        returned_shop_details = {shop['id']: shop for shop in await fetch_gourmet_api_shops(params)}
+
+        for shop_id in chunk_shop_ids:
+            shop_detail = returned_shop_details.get(shop_id)
+            if shop_detail is None:
+                missing_shop_ids.append(shop_id)
+                continue
+            shop_details[shop_id] = shop_detail
+            shop_detail_cache.set(shop_id, shop_detail)
+
+    await asyncio.gather(*[
+        load_chunk(shop_ids[start:start + GOURMET_API_MAX_ID_QUANTITY]) for start in range(0, len(shop_ids), GOURMET_API_MAX_ID_QUANTITY)
+    ])
+
+    if missing_shop_ids:
+        print(f"missing_shop_ids (gourmet api returned no shop):{missing_shop_ids}")
+
+    return shop_details, missing_shop_ids
 
 
 class QueryRecord:
@@ -409,9 +863,9 @@ class QueryRecord:
         return display_text_for_carousel
 
 
-def introduce_shops_by_user_id(event, DATABASE_PATH: str, user_id: str):
+async def introduce_shops_by_user_id(event, DATABASE_PATH: str, user_id: str):
     """ ユーザーに店舗を紹介（DBより店舗選出、店舗情報upsert、カルーセルメッセージ作成&送信、送信済みDB更新）
-
+    店舗の選出と提案済みSearchレコードの削除は1トランザクションで行い、返信に失敗した場合はレコードを戻す。
 
     Args:
         event (Any): ラインボットのメッセージイベント
@@ -419,25 +873,44 @@ def introduce_shops_by_user_id(event, DATABASE_PATH: str, user_id: str):
         user_id (str): user_id
     """
 
-    # Searchレコードと対応するshop_idの選出
-    selected_search_record_ids, selected_shop_ids = db.select_shop(DATABASE_PATH, user_id, MAX_DISPLAY_SHOP_QUANTITY)
+    # Searchレコードと対応するshop_idの選出、提案済みとして削除（並列リクエストで同じ店舗を選ばないよう1トランザクションで行う）
+    # 検索結果ページの一覧で評価がわかっている店舗は、その評価も取り出す
+    # search_generationは、戻す前に新しい検索でSearchレコードが置き換えられていないかの確認に使う
+    selected_search_record_ids, selected_shop_ids, listing_reviews, search_generation = await asyncio.to_thread(
+        db.take_next_shops, DATABASE_PATH, user_id, MAX_DISPLAY_SHOP_QUANTITY)
+
+    try:
+        # 検索条件の取得
+        query_record_as_list = await asyncio.to_thread(db.fetch_query_record_as_list, DATABASE_PATH, user_id) 
+        query_record = QueryRecord()
+        query_record.set_attributes(query_record_as_list)
 
-    # 検索条件の取得
-    query_record_as_list = db.fetch_query_record_as_list(DATABASE_PATH, user_id) 
-    query_record = QueryRecord()
-    query_record.set_attributes(query_record_as_list)
+        # 紹介するShopRecordリストの取得
+        shop_records = await create_shop_records(DATABASE_PATH, selected_shop_ids, listing_reviews)
 
-    # 紹介するShopRecordリストの取得
-    shop_records = create_shop_records(DATABASE_PATH, selected_shop_ids)
+        # 時間内に情報を取得できず紹介しない店舗（まだ取得中の店舗）は、Searchレコードを戻して次回紹介する
+        # (縮退の記録はイベントごとのため、返ってきたShopRecordと比べて判定する。 取得に失敗した店舗は戻さない)
+        introduced_shop_ids = {shop_record.shop_id for shop_record in shop_records}
+        deferred_search_records = [(search_record_id, shop_id) for search_record_id, shop_id in zip(selected_search_record_ids, selected_shop_ids)
+                                   if shop_id not in introduced_shop_ids and shop_id in shop_flight]
+        if deferred_search_records:
+            deferred_search_record_ids, deferred_shop_ids = map(list, zip(*deferred_search_records))
+            await asyncio.to_thread(db.restore_search_records, DATABASE_PATH, user_id, search_generation, deferred_search_record_ids, deferred_shop_ids, listing_reviews)
 
-    # 店舗紹介カルーセルメッセージ作成
-    carousel_messages = create_carousel_messages(shop_records, query_record)
+        # 店舗紹介カルーセルメッセージ作成
+        carousel_messages = create_carousel_messages(shop_records, query_record)
+
+        # ユーザーにメッセージ送信
+        await line_bot_api.reply_message(event.reply_token, carousel_messages)
 
-    # ユーザーにメッセージ送信
-    line_bot_api.reply_message(event.reply_token, carousel_messages)
+    except Exception:
+        # 返信できなかった場合は、取り出したSearchレコードを戻す（次回また提案できるように）
+        await asyncio.to_thread(db.restore_search_records, DATABASE_PATH, user_id, search_generation, selected_search_record_ids, selected_shop_ids, listing_reviews)
+        raise
 
-    # 提案済みのSearchレコードを削除
-    db.delete_select_search_record(DATABASE_PATH, selected_search_record_ids) # Searchレコードの削除　(確認 複数人の並列処理でsearch_record_idがずれることがあるか？ 
+    # 次に紹介する店舗を、返信後にバックグラウンドでDBに登録しておく
+    # (先読み中の店舗を次の紹介で使う場合は、shop_flightで先読みの取得結果を待つ)
+    run_in_background(prefetch_next_shop_records(DATABASE_PATH, user_id))
 
 
 def create_carousel_messages(shop_records: list, query_record) -> TemplateSendMessage:
@@ -464,91 +937,241 @@ def create_carousel_messages(shop_records: list, query_record) -> TemplateSendMe
     return carousel_messages
 
 
-def create_shop_records(DATABASE_PATH: str, shop_ids: list) -> list:
+async def create_shop_records(DATABASE_PATH: str, shop_ids: list, listing_reviews: dict = None) -> list:
     """店舗idリストからShopRecordリストを取得
 
     Args:
         DATABASE_PATH (str): DBのファイルパス
         shop_ids (list): shop_idリスト
+        listing_reviews (dict, optional): shop_id → 検索結果ページの一覧に表示された評価。 ある店舗は店舗ページをスクレイピングしない
 
     Returns:
         list[ShopRecord]: ShopRecordリスト
     """
+    # Shopテーブルに登録済みの店舗は、1回のクエリでまとめてShopRecordリストを作成
+    registered_shop_record_list = await asyncio.to_thread(create_registered_shop_records, DATABASE_PATH, shop_ids)
+
     # shop_idsを Shopテーブルにある/ない で分ける 
-    registered_shop_ids = db.extract_registered_shop_ids(DATABASE_PATH, shop_ids) # DBに登録済みのshop_idリスト 修正:更新が古いものはnew扱いしたいかも
+    registered_shop_ids = [shop_record.shop_id for shop_record in registered_shop_record_list] # DBに登録済みのshop_idリスト
     new_shop_ids = list_subtract(shop_ids, registered_shop_ids) # DBに未登録のshop_idリスト
 
-    # Shopテーブルにある/ない のそれぞれで Shopレコードリストを作成
-    registered_shop_record_list = create_registered_shop_records(DATABASE_PATH, registered_shop_ids)
-    new_shop_record_list = create_new_shop_records(DATABASE_PATH, new_shop_ids) # DBへの登録も行う
+    # Shopテーブルにない店舗は、apiとスクレイピングでShopRecordリストを作成
+    new_shop_record_list = await create_new_shop_records_within_deadline(DATABASE_PATH, new_shop_ids, listing_reviews) # DBへの登録も行う
+
+    # 更新が古い登録済み店舗は、今回はそのまま返し、バックグラウンドで情報を更新する
+    stale_before = (datetime.datetime.now(datetime.timezone.utc) - SHOP_RECORD_TTL).isoformat()
+    stale_shop_ids = [shop_record.shop_id for shop_record in registered_shop_record_list
+                      if shop_record.update_date is None or shop_record.update_date < stale_before]
+    if stale_shop_ids:
+        run_in_background(refresh_shop_records(DATABASE_PATH, stale_shop_ids))
 
     return registered_shop_record_list + new_shop_record_list # 要素を足し合わせたリスト
 
 
 
-def create_registered_shop_records(DATABASE_PATH: str, registered_shop_ids: list) -> list:
-    """DBに登録のある店舗idリストについて、DBからShopRecordリストを取得
+async def create_new_shop_records_within_deadline(DATABASE_PATH: str, new_shop_ids: list, listing_reviews: dict = None) -> list:
+    """イベントの処理時間の予算内で、create_new_shop_recordsを行う。
+    残り時間が少ない場合はレビューのスクレイピングを省き(skip_shop_review)、
+    返信に必要な時間までに取得が終わらない店舗は紹介しない(fewer_shops)。
+    取得が終わらなかった店舗も、バックグラウンドで取得を続けてDBに登録する。
 
     Args:
         DATABASE_PATH (str): DBのファイルパス
         new_shop_ids (list): DBに登録のないshop_idリスト
+        listing_reviews (dict, optional): shop_id → 検索結果ページの一覧に表示された評価
 
     Returns:
-        list[ShopRecord]: ShopRecordリスト
+        list[ShopRecord]: 時間内に取得できたShopRecordリスト
+    """
+    deadline = EventDeadline.current_deadline()
+    if deadline is None or not new_shop_ids:
+        return await create_new_shop_records(DATABASE_PATH, new_shop_ids, listing_reviews=listing_reviews)
+
+    with_review = deadline.remaining() >= SHOP_REVIEW_MIN_REMAINING_SECONDS
+    if not with_review:
+        deadline.degrade('skip_shop_review')
+
+    # 返信に必要な時間までに取得できた店舗だけを返す（残りの店舗はバックグラウンドで取得を続ける）
+    return await create_new_shop_records(DATABASE_PATH, new_shop_ids, with_review, listing_reviews, timeout=deadline.timeout(REPLY_RESERVE_SECONDS))
+
+
+async def refresh_shop_records(DATABASE_PATH: str, stale_shop_ids: list) -> None:
+    """更新が古いShopレコードを、apiとスクレイピングで取得し直してDBを更新する。
+    バックグラウンドで実行するため、返信には影響しない。
+
+    Args:
+        DATABASE_PATH (str): DBのファイルパス
+        stale_shop_ids (list): 更新が古いshop_idリスト
+    """
+    # 既に他のリクエストで更新中の店舗は除く
+    refresh_shop_ids = [shop_id for shop_id in stale_shop_ids if shop_id not in refreshing_shop_ids]
+    if not refresh_shop_ids:
+        return
+
+    refreshing_shop_ids.update(refresh_shop_ids)
+    try:
+        # 新規店舗と同じ手順で取得し、DBに上書き登録する
+        refreshed_shop_records = await create_new_shop_records(DATABASE_PATH, refresh_shop_ids)
+        print(f"refreshed_shop_ids:{[shop_record.shop_id for shop_record in refreshed_shop_records]}")
+    except Exception as e:
+        print(f"error: refresh_shop_records : {e!r}")
+    finally:
+        refreshing_shop_ids.difference_update(refresh_shop_ids)
+
+
+async def prefetch_next_shop_records(DATABASE_PATH: str, user_id: str) -> None:
+    """ユーザーに次に紹介するSearchレコードの店舗のうち、Shopテーブルにない店舗をapiとスクレイピングで取得してDBに登録する。
+    紹介の返信後にバックグラウンドで実行し、次の「次の5件」をDBの情報だけで返せるようにする。
+    Searchレコードは削除せず、参照のみ行う。
+
+    Args:
+        DATABASE_PATH (str): DBのファイルパス
+        user_id (str): user_id
+    """
+    try:
+        # 次に紹介する店舗のうち、DBに未登録で、他のタスクで取得中でないもの
+        next_search_record_ids, next_shop_ids = await asyncio.to_thread(db.select_shop, DATABASE_PATH, user_id, PREFETCH_SHOP_QUANTITY)
+        if not next_shop_ids:
+            return
+        registered_shop_ids = await asyncio.to_thread(db.extract_registered_shop_ids, DATABASE_PATH, next_shop_ids)
+        prefetch_shop_ids = [shop_id for shop_id in list_subtract(next_shop_ids, registered_shop_ids) if shop_id not in refreshing_shop_ids]
+        if not prefetch_shop_ids:
+            return
+
+        listing_reviews = await asyncio.to_thread(db.get_listing_reviews, DATABASE_PATH, next_search_record_ids)
+
+        refreshing_shop_ids.update(prefetch_shop_ids)
+        try:
+            prefetched_shop_records = await create_new_shop_records(DATABASE_PATH, prefetch_shop_ids, listing_reviews=listing_reviews)
+            print(f"prefetched_shop_ids:{[shop_record.shop_id for shop_record in prefetched_shop_records]}")
+        finally:
+            refreshing_shop_ids.difference_update(prefetch_shop_ids)
+
+    except Exception as e:
+        print(f"error: prefetch_next_shop_records : {e!r}")
+
+
+def run_in_background(coroutine) -> asyncio.Task:
+    """コルーチンを、リクエストの処理とは切り離してバックグラウンドで実行する。
+    リクエストに固定したDB接続を引き継がないよう、空のコンテキストでタスクを作成する。
+
+    Args:
+        coroutine (Coroutine): 実行するコルーチン
+
+    Returns:
+        asyncio.Task: 作成したタスク
+    """
+    task = contextvars.Context().run(asyncio.create_task, coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def create_registered_shop_records(DATABASE_PATH: str, shop_ids: list) -> list:
+    """店舗idリストのうちDBに登録のある店舗について、DBからShopRecordリストを取得
+    1回のクエリでまとめて取得する。
+
+    Args:
+        DATABASE_PATH (str): DBのファイルパス
+        shop_ids (list): shop_idリスト
+
+    Returns:
+        list[ShopRecord]: ShopRecordリスト（shop_idsの順。DBに登録のない店舗は含まない）
     """
     # ShopCarousel作成用のShopRecordリスト
     shop_records = []
 
-    # DBに登録済みの店舗のShopRecordリストを取得
-    if registered_shop_ids:
-        for shop_id in registered_shop_ids:
-            # DBからShopRecordインスタンスを作成
-            shop_record_as_list = db.fetch_shop_record_as_list(DATABASE_PATH, shop_id)
+    # DBに登録済みの店舗のレコードをまとめて取得
+    for shop_record_as_list in db.fetch_shop_records_as_list(DATABASE_PATH, shop_ids):
+        # ShopRecordインスタンス作成
+        shop_record = ShopRecord()
+        # プロパティの更新
+        shop_record.set_attributes(shop_record_as_list)
 
-            # ShopRecordインスタンス作成 jump
-            shop_record = ShopRecord()
-            # プロパティの更新
-            shop_record.set_attributes(shop_record_as_list)
-
-            # ShopRecordリストに追加
-            shop_records.append(shop_record)
-            # インスタンスの解放
-            del shop_record
+        # ShopRecordリストに追加
+        shop_records.append(shop_record)
 
     return shop_records
 
 
-def create_new_shop_records(DATABASE_PATH: str, new_shop_ids: list) -> list:
+async def create_new_shop_records(DATABASE_PATH: str, new_shop_ids: list, with_review: bool = True, listing_reviews: dict = None, timeout: float = None) -> list:
     """DBに登録のない店舗idリストについて、apiとスクレイピングでShopRecordリストを取得
     新規店舗なため、得た情報のDB登録も行う。
+    全店舗の情報を店舗ごとのタスクで並行して取得し、この呼び出しで取得した店舗をまとめて1回でDBに登録する（同じ店舗の取得を待っただけの呼び出し元では登録しない）。
+    timeout秒までに取得が終わらなかった店舗は返さず、バックグラウンドで取得を続けて、終わった後にまとめてDBに登録する。
 
     Args:
         DATABASE_PATH (str): DBのファイルパス
         new_shop_ids (list): DBに登録のないshop_idリスト
+        with_review (bool, optional): Falseの場合はレビューをスクレイピングしない（更新日時なしで登録し、後で更新される）
+        listing_reviews (dict, optional): shop_id → 検索結果ページの一覧に表示された評価。 ある店舗はwith_reviewによらずこれを使い、スクレイピングしない
+        timeout (float, optional): 取得を待つ秒数。 省略時は全店舗の取得が終わるまで待つ
 
     Returns:
-        list[ShopRecord]: ShopRecordリスト
+        list[ShopRecord]: ShopRecordリスト（取得に失敗した店舗、timeout秒までに取得が終わらなかった店舗は含まない）
     """
-    shop_records = []
+    # 新規店舗がなければ何もしない
+    if not new_shop_ids:
+        return []
+    listing_reviews = listing_reviews or {}
 
-    # 新規店舗があれば、情報を取得してDBに登録
-    if new_shop_ids:
-        for shop_id in new_shop_ids:
-            print(shop_id)
-            # 店舗レコード登録に必要な情報を設定
-            shop_detail = ShopDetail(shop_id) # apiとスクレイピングでカルーセル作成に十分な情報を取得
-            shop_record = ShopRecord() # ShopRecordをプロパティNoneでインスタンス化
-            shop_record.retrieve_propaties_from_shop_detail(shop_detail)
-            # 店舗レコードをDBに登録
-            db.add_shop_record(DATABASE_PATH, shop_record)
-            # ShopRecordリストに追加
-            shop_records.append(shop_record)
-
-        # インスタンスへの参照を削除
-        del shop_detail
-        del shop_record
+    # APIの店舗情報は、キャッシュになく他で取得中でない店舗の分をまとめて取得する（店舗ごとのレビュー取得と並行して行う）
+    start_loading_shop_details([shop_id for shop_id in new_shop_ids if shop_id not in shop_flight and shop_detail_cache.get(shop_id) is None])
 
-    return shop_records
+    # 同時に情報を取得する店舗数を制限
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SHOP_FETCH_QUANTITY)
+    fetched_shop_ids = set() # この呼び出しのshop_flightで取得した(DBに登録する)shop_id
+
+    async def create_new_shop_record(shop_id: str) -> ShopRecord:
+        async with semaphore:
+            # 店舗レコード登録に必要な情報を設定
+            shop_detail = ShopDetail(shop_id)
+            await shop_detail.set_shop_record_info_by_hotpepper_api(with_review, listing_reviews.get(shop_id)) # apiとスクレイピングでカルーセル作成に十分な情報を取得
+        shop_record = ShopRecord() # ShopRecordをプロパティNoneでインスタンス化
+        shop_record.retrieve_propaties_from_shop_detail(shop_detail)
+        fetched_shop_ids.add(shop_id)
+        return shop_record
+
+    async def store_shop_records(shop_ids: list) -> list:
+        # 取得が終わった店舗のShopRecordを集め、この呼び出しで取得したものだけを1回でDBに登録する
+        shop_records = []
+        failed_shop_ids = [] # 情報を取得できなかったshop_idリスト
+        for shop_id in shop_ids:
+            shop_task = shop_tasks[shop_id]
+            if shop_task.cancelled() or shop_task.exception() is not None:
+                print(f"error: create_new_shop_records : {shop_id} : {'cancelled' if shop_task.cancelled() else repr(shop_task.exception())}")
+                failed_shop_ids.append(shop_id)
+                continue
+            shop_records.append(shop_task.result())
+
+        if failed_shop_ids:
+            print(f"failed_shop_ids:{failed_shop_ids}")
+
+        upsert_shop_records = [shop_record for shop_record in shop_records if shop_record.shop_id in fetched_shop_ids]
+        if upsert_shop_records:
+            await asyncio.to_thread(db.upsert_shop_records, DATABASE_PATH, upsert_shop_records)
+        return shop_records
+
+    async def store_pending_shop_records(pending_shop_ids: list) -> None:
+        await asyncio.wait([shop_tasks[shop_id] for shop_id in pending_shop_ids])
+        await store_shop_records(pending_shop_ids)
+
+    # 全店舗の情報を店舗ごとのタスクで並行して取得（一部の店舗で失敗しても他の店舗の取得は続ける）
+    # 同じ店舗を他のリクエストや先読みが取得中なら、その結果を使う
+    # 待つのをやめた店舗も取得を続けるよう、バックグラウンドタスクとして実行する
+    shop_tasks = {shop_id: run_in_background(shop_flight.do(shop_id, create_new_shop_record, shop_id)) for shop_id in new_shop_ids}
+    _, pending = await asyncio.wait(shop_tasks.values(), timeout=timeout)
+
+    done_shop_ids = [shop_id for shop_id in new_shop_ids if shop_tasks[shop_id] not in pending]
+    pending_shop_ids = [shop_id for shop_id in new_shop_ids if shop_tasks[shop_id] in pending]
+    if pending_shop_ids:
+        print(f"pending_shop_ids:{pending_shop_ids}")
+        deadline = EventDeadline.current_deadline()
+        if deadline is not None:
+            deadline.degrade('fewer_shops')
+        run_in_background(store_pending_shop_records(pending_shop_ids))
+
+    return await store_shop_records(done_shop_ids)
 
 
 def create_shop_carousel_columns(shop_records: list) -> list:
@@ -596,23 +1219,7 @@ def create_shop_discription_for_carousel(shop_record: ShopRecord) -> str:
     return discription_text
 
 
-def extract_number_from_string(s: str) -> int:
-    """文字列から数字の部分をint型で返す。("12件の~" → 12、"212件の~" → 212)
-
-    Args:
-        s (str): _description_
-
-    Returns:
-        int: 文字列の初めに連続する数字。ただし数字から始まらないとNone
-    """
-    numbers = re.findall(r'\d+', s)  # 文字列から数字の部分を抽出
-    if numbers:
-        return int(numbers[0])  # 抽出された数字のリストから最初の要素をint型に変換して返す
-    else:
-        return None  # 数字が見つからない場合はNoneを返す（またはエラー処理など）
-    
-
-def get_shop_review(shop_id: str) -> Any:
+async def get_shop_review(shop_id: str) -> Any:
     """shop_idから評価を取得。評価がない場合はNoneを返す。
 
     Args:
@@ -625,99 +1232,60 @@ def get_shop_review(shop_id: str) -> Any:
     """
   
     #店舗URL
-    shop_url = "https://www.hotpepper.jp/str" + shop_id + "/"
+    shop_url = HtmlExtractor.HOTPEPPER_URL_DOMAIN + "/str" + shop_id + "/"
     
     # HTTP GETリクエストを送信してHTMLを取得
-    response = requests.get(shop_url)
-    html = response.text
-    
-    # BeautifulSoupを使用してHTMLを解析
-    soup = BeautifulSoup(html, 'html.parser')
-    
-    # ratingScoreを含む要素 ratingWrap を検索して取得
-    rating_wrap_element = soup.find('div', class_='ratingWrap')
-
-    # ratingWrap を取得できなかった場合 None でreturn
-    if not rating_wrap_element:
-        return None, None, None
-    
-    # --- 以下、ratingWrap を取得できた場合 ----
-    # レビュー情報を取得。
-    review_score: float = float(rating_wrap_element.find('span', class_='ratingScoreValue').text) # 3.6
-    reputation: str = rating_wrap_element.find('span', class_='ratingScoreText').text # "Very Good"
-    review_quantity_str: str = rating_wrap_element.find('span', class_='ratingReivew').text # '241件のレビューの総評'
-    review_quantity = extract_number_from_string(review_quantity_str) # 241
+    html = await fetch_text(shop_url)
     
-    return review_score, reputation, review_quantity
+    # 評価部分のみを解析して取得（イベントループを止めないよう別スレッドで実行）
+    return await asyncio.to_thread(HtmlExtractor.extract_shop_review, html)
 
 
-def sort_shop_ids_by_rated(stock_shop_ids: list) -> list:
-    """ 店舗リストを レビューあり→レビューなしの順にソートする。
+def sort_shop_ids_by_rated(DATABASE_PATH: str, stock_shop_ids: list) -> list:
+    """ 店舗リストを レビューあり → 評価の有無が不明 → レビューなし の順にソートする。（それぞれの中では元の順）
+    評価は get_known_review_scores でまとめて参照し、店舗ページはスクレイピングしない。
+    DB操作を含むため、asyncio.to_threadで別スレッドから呼び出す。
 
     Args:
+        DATABASE_PATH (str): DBのファイルパス
         stock_shop_ids (list[str]): ホットペッパー検索で取得した店舗idリスト。
 
     Returns:
-        list[str]: レビューあり → レビューなし の順に並べ直した店舗idリスト。
+        list[str]: レビューあり → 不明 → レビューなし の順に並べ直した店舗idリスト。
     """
-    # レビューありの shop_id のみ抽出
-    rated_shop_ids = get_rated_shop_ids(stock_shop_ids)
-
-    # レビューなし店舗リスト。（stock_shop_ids から rated_shop_ids の要素を取り除いたリスト）
-    not_rated_shop_ids = [x for x in stock_shop_ids if x not in rated_shop_ids]
+    review_scores = get_known_review_scores(DATABASE_PATH, stock_shop_ids)
 
-    # レビューあり店舗id → レビューなし店舗id となるようソート
-    sorted_shop_ids = rated_shop_ids + not_rated_shop_ids
+    def rating_rank(shop_id: str) -> int:
+        if shop_id not in review_scores:
+            return 1 # 不明（紹介時に評価を取得する）
+        return 0 if review_scores[shop_id] is not None else 2
 
-    return sorted_shop_ids
+    # sortedは安定ソートのため、同じ順位の中では元の順が保たれる
+    return sorted(stock_shop_ids, key=rating_rank)
 
 
-def extract_introduce_shop_ids(stock_shop_ids: list) -> list:
-    """実際に紹介するshop_idsを選択して返す。
+def get_known_review_scores(DATABASE_PATH: str, shop_ids: list) -> dict:
+    """shop_ids のうち、評価の有無がわかっている店舗の評価値を返す。
+    検索結果ページの一覧(listing_review_cache) → Shopテーブル の順にまとめて参照する。
 
     Args:
-        stock_shop_ids (list[str]): ホットペッパーの検索結果urlから取得したshop_idリスト。
+        DATABASE_PATH (str): DBのファイルパス
+        shop_ids (list[str]): 元となるshop_idリスト
 
     Returns:
-        list[str]: 実際に紹介するshop_ids 
+        dict: shop_id → review_score (評価のない店舗はNone)。 どちらにもない店舗は含まない
     """
+    review_scores = {}
+    for shop_id in shop_ids:
+        listing_review = listing_review_cache.get(shop_id)
+        if listing_review is not None and listing_review[1] is not None: # (None, None) は評価が不明
+            review_scores[shop_id] = listing_review[0]
 
-    # 店舗リストを レビューあり→レビューなしの順にソートする。
-    sorted_shop_ids = sort_shop_ids_by_rated(stock_shop_ids)
-
-    # 表示可能な最大店舗数を取得
-    display_shop_quantity = min(len(stock_shop_ids), MAX_DISPLAY_SHOP_QUANTITY)
+    # 一覧の評価がない店舗は、DBに登録済みの評価を1回のクエリで取得
+    unlisted_shop_ids = [shop_id for shop_id in shop_ids if shop_id not in review_scores]
+    review_scores.update(db.get_shop_review_scores(DATABASE_PATH, unlisted_shop_ids))
 
-    return sorted_shop_ids[:display_shop_quantity] # 表示可能な最大数のレビューなし店舗リスト
-
-
-def get_rated_shop_ids(shop_ids: list) -> list:
-    """shop_ids のうち、レビューのある shop_id のみをappendして返す。
-
-    Args:
-        shop_ids (list): _description_
-
-    Returns:
-        list: _description_
-    """
-    '''
-    
-    '''
-
-    has_rate_shop_ids = []
-
-    for current_shop_id in shop_ids:
-        # shop_id からレビューを取得
-        shop_rate = get_shop_review(current_shop_id)
-        # レビューがあればappend
-        if shop_rate:
-            has_rate_shop_ids.append(current_shop_id)
-        
-        # 最終的なカルーセル表示数に到達したら抜き出しを終了
-        if len(has_rate_shop_ids) >= MAX_DISPLAY_SHOP_QUANTITY:
-            break
-
-    return has_rate_shop_ids
+    return review_scores
 
 
 def create_shop_not_hit_carousel_column(query_record) -> TemplateSendMessage:
@@ -762,7 +1330,7 @@ def create_has_no_more_shop_message(query_record) -> TemplateSendMessage:
     shop_not_hit_carousel_column = CarouselColumn(
         thumbnail_image_url="https://document.intra-mart.jp/library/rpa/public/im_rpa_usage_guide/_images/winactor_tutorial_5_4_1.png",
         title="もうお店がありません。",
-        text = "条件を変えて検索してみてください！\n" + QUERY_MARKS.ext_for_carousel(),
+        text = trim_text("条件を変えて検索してみてください！\n" + query_record.text_for_carousel(), max_length=60),
         actions=[
             {
                 "type": "uri",
@@ -799,20 +1367,20 @@ def get_hit_shop_quantity(original_search_url_soup):
     return hit_shop_quantity
 
 
-def get_search_result_urls(original_search_url: str, original_search_url_soup: BeautifulSoup, max_page_quantity: int) -> list:
+def get_search_result_urls(original_search_url: str, original_search_url_html: str, max_page_quantity: int) -> list:
     """ホットペッパー検索にヒットした複数ページ（上限あり）のurlリスト。
 
     Args:
         original_search_url (str): ユーザーのクエリを元に生成したホットペッパー検索url
-        original_search_url_soup (BeautifulSoup): ホットペッパー検索結果の1ページ目のスクレイピングデータ。
+        original_search_url_html (str): ホットペッパー検索結果の1ページ目のHTML。
         max_page_quantity (int): 取得する検索結果ページurlの最大数。
         
     Returns:
         list: 検索結果ページurlのリスト。最大max_page_quantity個。 1つもヒットしない場合はNoneを返す。
     """
 
-    # 検索結果の総ページ数を取得
-    hit_search_page_quantity = get_hit_search_page_quantity(original_search_url_soup)        
+    # 検索結果の総ページ数と、短縮ナンバリングURLの共通部分を取得（1回の解析で行う）
+    hit_search_page_quantity, core_numbering_search_url = HtmlExtractor.extract_search_page_info(original_search_url_html)
 
     # 該当店舗が１つもない場合、Noneを返す。
     if hit_search_page_quantity == None:
@@ -825,8 +1393,6 @@ def get_search_result_urls(original_search_url: str, original_search_url_soup: B
         return [original_search_url]
 
     # 検索結果が複数ページの場合、各ページを数字で表せる短縮ナンバリングURLに変換して扱う。
-    # 短縮ナンバリングURLの共通部分を取得
-    core_numbering_search_url = get_core_numbering_search_url(original_search_url_soup)
     # 短縮ナンバリングURLの配列作成
     search_result_urls = append_numbering_search_urls(core_numbering_search_url, hit_search_page_quantity, max_page_quantity)
 
@@ -849,61 +1415,6 @@ def append_numbering_search_urls(core_numbering_search_url, hit_search_page_quan
     return numbering_search_urls
 
 
-def get_core_numbering_search_url(original_search_url_soup):
-    '''
-    該当店舗数が2ページ以上（=店舗数が23以上）の時のみ呼び出すこと。
-    original_search_url_soupから、この検索条件のナンバリング短縮検索URLの共通部分を取得する。
-    
-    <ul class="pageLinkLinearBasic cf">
-                            <li class="crt">
-                                <span>1</span>
-                            </li>
-                            <li>
-                                <a href="/SA11/fwt%E9%A4%83%E5%AD%90/bgn2/">
-                            ...
-    → "https://www.hotpepper.jp/SA11/fwt%E9%A4%83%E5%AD%90/bgn" を返す。
-    '''
-
-    second_page_li_index = 2 # lisのこの位置が2ページ目のURLを持ってる。
-    hotpepper_url_domain = "https://www.hotpepper.jp" # hotpepperのドメイン部分
-
-    # htmlのネストを掘っていく（修正）これだと該当店舗数が1ページの時で機能しない。もしくは複数ページの時と処理が変わる。
-    ul = original_search_url_soup.find('ul', class_='pageLinkLinearBasic cf') # HTML全体からページ数クラスを抽出
-    lis = ul.find_all('li')
-
-    # ページ2 が入った li から、"/SA11/fwt%E9%A4%83%E5%AD%90/bgn" 部分を取得。
-    number2_nubering_search_url = lis[second_page_li_index].find('a')['href']
-
-    # "https://www.hotpepper.jp" + "/SA11/fwt%E9%A4%83%E5%AD%90/bgn"
-    core_numbering_search_url = hotpepper_url_domain + number2_nubering_search_url[:len(number2_nubering_search_url)-2]
-
-    return core_numbering_search_url
-
-
-def get_hit_search_page_quantity(original_search_url_soup: BeautifulSoup) -> int:
-    """ホットペッパー検索でヒットした全店舗がなすページ数
-
-    Args:
-        original_search_url_soup (BeautifulSoup): ホットペッパー検索結果の1ページ目のスクレイピングデータ。
-
-    Returns:
-        int: ホットペッパー検索でヒットした全店舗がなす総ページ数。 ヒット0件の時のみNoneを返す。
-    """
-    try:
-        # 必ず表示される、ページ数が書かれたタグの内容(文字列)を取得　修正　findの結果がNoneのことがある
-        page_quantity_sentence = original_search_url_soup.find('li', class_='lh27').text # "1/nnnページ"
-    
-    except AttributeError as e:
-        # エラーが発生した場合の処理を記述します
-        print(f"An error occurred: {e}")
-        return None
-    
-    else:
-        # ページ数部分のみを取得。（"1/nnnページ" → "nnn" → nnn）
-        hit_search_page_quantity = int(page_quantity_sentence[len("1/") : len(page_quantity_sentence)-len("ページ")])
-        return hit_search_page_quantity
-
-
 def get_numbering_search_urls(original_search_url_soup): #リファクタリング
     '''
     検索条件URLでヒットしたshop_idを、MAX_DISPLAY_SHOP_QUANTITY個取得。(確認済み)
@@ -945,39 +1456,6 @@ def trim_text(text: str, max_length=40) -> str:
     return truncated_text
 
 
-def get_carousel_info(shop_detail: tuple) -> dict:
-    '''
-    選ばれた店舗に対して、カルーセル表示用店舗情報の抽出
-    対象店舗は extract_introduce_shop_ids() で先に決める。
-    '''
-    if shop_detail:
-
-        affiliate_url = get_affiliate_url(shop_detail['id']) # affiliate_urlを生成
-
-        # 店舗詳細表示情報の設定。店舗評価が取得できれば後ろにつける。
-        shop_rate = get_shop_review(shop_detail['id'])
-        if shop_rate:
-            detail_message = shop_detail['mobile_access'] + "\n" + shop_rate
-        else:
-            detail_message = shop_detail['mobile_access']
-
-        carousel_info = {
-            'id': shop_detail['id'],
-            'name': trim_text(shop_detail['name']),
-            'rate':shop_rate,
-            'detail_message':detail_message,
-            'url': affiliate_url,
-            'pic_url': shop_detail['photo']['pc']['l']
-        }
-
-        return carousel_info
-
-    # デバッグ用
-    else:
-        print("Error: cant get CarouselInfo : func get_carousel_info")
-        return False
-
-
 def get_affiliate_url(shop_id):
     '''
     affiliate_urlを作成
@@ -1047,7 +1525,7 @@ def encode_uri_parameters(shop_id):
     return encoded_query
 
 
-def get_shop_ids_by_search_urls(numbering_search_urls: list) -> list:
+async def get_shop_ids_by_search_urls(numbering_search_urls: list) -> list:
     """ numbering_seach_urls のURL中のshop_idのリスト。
 
     Args:
@@ -1057,12 +1535,34 @@ def get_shop_ids_by_search_urls(numbering_search_urls: list) -> list:
         list[str]: numbering_seach_urls のURL中のshop_id全てをappendして返す。
     """
 
+    # 同時に取得するページ数を制限
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_PAGE_FETCH_QUANTITY)
+
+    async def get_page_shop_ids(numbering_search_url: str) -> list:
+        async with semaphore:
+            # 同じページを他の検索が取得中なら、その結果を使う
+            return await search_page_flight.do(numbering_search_url, get_shop_ids_by_search_url, numbering_search_url)
+
+    # 各ナンバリングURLのページを並行して取得。(gatherは引数の順で結果を返すため、ページ順が保たれる)
+    pages_shop_ids = await asyncio.gather(*[
+        get_page_shop_ids(current_numbering_search_url) for current_numbering_search_url in numbering_search_urls
+    ], return_exceptions=True)
+
     shop_ids = [] # return変数
 
-    # 各ナンバリングURLに含まれる shop_ids をappendしていく。
-    for current_numbering_search_url in numbering_search_urls:
-        # 各ナンバリングURLに含まれるshop_idsを取得
-        current_page_shop_ids = get_shop_ids_by_search_url(current_numbering_search_url)
+    # 各ナンバリングURLに含まれる shop_ids をページ順にappendしていく。
+    for current_numbering_search_url, current_page_shop_ids in zip(numbering_search_urls, pages_shop_ids):
+        # 応答のなかったページは飛ばす（全ページ応答がなければ検索の失敗とする）
+        if isinstance(current_page_shop_ids, OutboundClient.UpstreamError):
+            print(f"error: get_shop_ids_by_search_url : {current_numbering_search_url} : {current_page_shop_ids!r}")
+            if all(isinstance(page_shop_ids, OutboundClient.UpstreamError) for page_shop_ids in pages_shop_ids):
+                raise current_page_shop_ids
+            continue
+        if isinstance(current_page_shop_ids, BaseException):
+            raise current_page_shop_ids
+        # 店舗が取得できなかったページは飛ばす
+        if not current_page_shop_ids:
+            continue
         # current_shop_id に分けてappend
         for current_shop_id in current_page_shop_ids:
             shop_ids.append(current_shop_id)
@@ -1070,7 +1570,7 @@ def get_shop_ids_by_search_urls(numbering_search_urls: list) -> list:
     return shop_ids
 
 
-def get_shop_ids_by_search_url(search_url: str) -> list:
+async def get_shop_ids_by_search_url(search_url: str) -> list:
     """検索条件URLでヒットしたshop_idを、MAX_DISPLAY_SHOP_QUANTITY個取得。
 
     Args:
@@ -1081,36 +1581,33 @@ def get_shop_ids_by_search_url(search_url: str) -> list:
     """
 
 
-    request = requests.get(search_url) # 検索条件URLでリクエスト
-    soup = BeautifulSoup(request.text, 'html.parser') # BSでスクレイピング、リクエスト結果を取得
-
-    html_shop_lists = soup.find_all('h3', class_='shopDetailStoreName') # スクレイピングでヒットした店舗リストを取得(最大でmax_shop_quantity店舗。)
+    html = await fetch_text(search_url) # 検索条件URLでリクエスト
 
-    if not html_shop_lists: # スクレイピングで1店舗もヒットしなかった場合
-        return
-    
-    shop_ids = get_shop_ids_from_html_shop_lists(html_shop_lists) # HTMLの店舗リストから、shop_idを取得
+    # 店舗名と評価の要素のみを解析し、shop_idを取得（別スレッドで解析）。1店舗もヒットしなかった場合はNone
+    shop_ids = await asyncio.to_thread(extract_and_cache_shop_listings, html)
 
     return shop_ids # ["J001168707", ... ,"J999999999"]
 
 
-def get_shop_ids_from_html_shop_lists(html_shop_lists):
-    '''
-    スクレイピングで取得した html_shop_lists から shop_ids を抜きだす。
-    '''
+def extract_and_cache_shop_listings(search_page_html: str) -> list:
+    """検索結果ページのHTMLからshop_idを取得し、一覧に表示された評価をlisting_review_cacheに保存する。
+    HTMLの解析を含むため、asyncio.to_threadで別スレッドから呼び出す。
+
+    Args:
+        search_page_html (str): ホットペッパーの検索結果ページのHTML
 
-    # return変数
-    shop_ids = []
+    Returns:
+        list[str]: shop_idのリスト（掲載順）。 1店舗もヒットしなかった場合はNone
+    """
+    shop_listings = HtmlExtractor.extract_shop_listings(search_page_html)
+    if shop_listings is None:
+        return None
 
-    # HTMLの店舗リストから、shop_idを取得
-    for html_shop_list in html_shop_lists:
-        # html_shop_list から shop_id の抽出
-        current_href_shop_id = html_shop_list.find('a')['href']  # "/strJ001168707/"
-        current_shop_id = current_href_shop_id[4:len(current_href_shop_id) - 1]  # "J001168707"
-        # shop_idsに追加
-        shop_ids.append(current_shop_id)
+    for shop_id, review_score, review_quantity in shop_listings:
+        # 一覧に評価の表示がない(読み取れない)店舗は (None, None) として保存し、紹介時に店舗ページから評価を取得する
+        listing_review_cache.set(shop_id, (review_score, review_quantity))
 
-    return shop_ids # ["J001168707", ... ,"J999999999"]
+    return [shop_id for shop_id, _, _ in shop_listings]
 
 
 def get_user_id_from_event(event):
@@ -1162,7 +1659,8 @@ def list_subtract(larger_list: list, smaller_list: list) -> list:
         list: 引き算後のリスト
     """
 
-    return [item for item in larger_list if item not in smaller_list]
+    smaller_set = set(smaller_list) # 要素の有無の確認をO(1)で行う
+    return [item for item in larger_list if item not in smaller_set]
 
 
 if __name__ == "__main__":